@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" ACL取得処理のマイクロベンチマーク
+
+- 機器に接続せずに、各セッションクラスのget_snmp_acl()の解析処理を計測
+-- 記録したデータ、またはエントリ数を指定して生成したデータを再生 (cm_sess.replay)
+-- 機種ごと、エントリ数ごとに処理時間(最小値)、毎秒のエントリ数、メモリ使用量を出力
+-- メモリ使用量はtracemallocがあれば割り当てのピーク(peak)
+-- tracemallocがない場合(2.7)は計測前後の最大RSSの増加量(rss+)で、近似値
+   (最大RSSはプロセス全体で減らないので、それまでの計測のピークを超えた分だけ)
+
+ $ python bench_snmp_acl.py -h
+ usage: bench_snmp_acl.py [-h] [-m MODEL] [-n N] [-r REPEAT] [--replay FILE]
+                          [--record IPADDR] [-o FILE]
+
+ optional arguments:
+   -h, --help            show this help message and exit
+   -m MODEL, --model MODEL
+                         cisco, brocade_netiron, juniper_telnet, arista,
+                         brocade_vdx or juniper (default: all)
+   -n N, --entries N     number of synthetic ACL entries (default: 10, 100,
+                         1000, 10000, 100000)
+   -r REPEAT, --repeat REPEAT
+                         number of runs per measurement (default: 3)
+   --replay FILE         benchmark a recorded transcript (default: None)
+   --record IPADDR       record get_snmp_acl() of a live device (default:
+                         None)
+   -o FILE, --output FILE
+                         transcript file to write with --record (default:
+                         ./IPADDR.json)
+
+- 記録する場合は '--model' で機種を指定 (パスワードは標準入力から取得)
+ $ python bench_snmp_acl.py --record 192.168.11.101 -m cisco
+ $ python bench_snmp_acl.py --replay ./192.168.11.101.json
+"""
+
+import sys
+import gc
+import time
+import json
+import getpass
+import logging
+import argparse
+import resource
+from ipaddr import IPv4Network
+
+import cm_agent
+from cm_sess.telnet_sess import TelnetSess
+from cm_sess.replay import Transcript, record_sess, replay_sess
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+logger_name = 'bench_snmp_acl'
+logging.getLogger(logger_name).addHandler(logging.NullHandler())
+
+acl_name = 'SNMP-ACCESS'
+
+# 機種ごとの (通信方式, エージェントのクラス)
+models = (
+    ('cisco', 'telnet', cm_agent.Cisco),
+    ('brocade_netiron', 'telnet', cm_agent.BrocadeNetiron),
+    ('juniper_telnet', 'telnet', cm_agent.Juniper),
+    ('arista', 'eapi', cm_agent.Arista),
+    ('brocade_vdx', 'netconf', cm_agent.BrocadeVdx),
+    ('juniper', 'netconf', cm_agent.Juniper),
+    )
+
+def get_sess(model):
+  """ 機種に対応するセッション (接続はしない)
+  """
+  name, transport, agent_class = [m for m in models if m[0] == model][0]
+  agent = agent_class('192.0.2.1')
+  if model == 'juniper_telnet':
+    return TelnetSess(agent, None, None, logger_name, user_login='admin')
+  return agent.get_sess(None, None, logger_name)
+
+def synthetic_acl(n):
+  """ n個のエントリ: 9割はホスト(/32)、1割は/24
+  """
+  acl = list()
+  for i in range(n):
+    if i % 10:
+      acl.append(IPv4Network("10.%d.%d.%d/32" % ((i >> 16) & 255, (i >> 8) & 255, i & 255)))
+    else:
+      k = i // 10
+      acl.append(IPv4Network("11.%d.%d.0/24" % ((k >> 8) & 255, k & 255)))
+  return acl
+
+def synthetic_transcript(model, acl):
+  """ aclを返す機器の応答を生成
+  """
+  if model == 'cisco':
+    lines = ["show ip access-lists %s | inc [0-9]+_permit_" % (acl_name, )]
+    for i, n in enumerate(acl):
+      if n.prefixlen == 32:
+        lines.append("    %d permit %s" % ((i + 1) * 10, n.network))
+      else:
+        lines.append("    %d permit %s, wildcard bits %s" % ((i + 1) * 10, n.network, n.hostmask))
+    return Transcript('telnet', model, ["\r\n".join(lines) + "\r\nrouter#"])
+  if model == 'brocade_netiron':
+    lines = ["show access-list name %s | inc ^_+sequence" % (acl_name, )]
+    for i, n in enumerate(acl):
+      if n.prefixlen == 32:
+        lines.append("sequence %d permit host %s" % ((i + 1) * 10, n.network))
+      else:
+        lines.append("sequence %d permit %s %s" % ((i + 1) * 10, n.network, n.hostmask))
+    return Transcript('telnet', model, ["\r\n".join(lines) + "\r\ntelnet@router#"])
+  if model == 'juniper_telnet':
+    lines = ["show configuration policy-options prefix-list %s | no-more" % (acl_name, )]
+    lines.extend(["%s;" % (n.with_prefixlen, ) for n in acl])
+    return Transcript('telnet', model, ["\r\n".join(lines) + "\r\nadmin@router> "])
+  if model == 'arista':
+    sequence = [dict([('sequenceNumber', (i + 1) * 10),
+                      ('action', 'permit'),
+                      ('source', dict(ip=str(n.network), mask=int(n.netmask))),
+                      ('destination', dict(ip='0.0.0.0', mask=0)), ]) for i, n in enumerate(acl)]
+    body = json.dumps(dict([('jsonrpc', '2.0'),
+                            ('result', [dict(), dict(aclList=[dict(name=acl_name, standard=True, sequence=sequence)])]),
+                            ('id', 1), ]))
+    return Transcript('eapi', model, [(1, body)])
+  if model == 'brocade_vdx':
+    seqs = ''.join(["<seq><seq-id>%d</seq-id><action>permit</action><src-host-any-sip>%s</src-host-any-sip>"
+                    "<src-host-ip>0.0.0.0</src-host-ip><src-mask>%s</src-mask></seq>" % ((i + 1) * 10, n.network, n.netmask)
+                    for i, n in enumerate(acl)])
+    xml = ('<rpc-reply xmlns="urn:ietf:params:xml:ns:netconf:base:1.0" message-id="1"><data>'
+           '<ip-acl xmlns="urn:brocade.com:mgmt:brocade-ip-access-list"><ip><access-list><standard>'
+           '<name>%s</name><hide-ip-acl-std>%s</hide-ip-acl-std></standard></access-list></ip></ip-acl>'
+           '</data></rpc-reply>' % (acl_name, seqs))
+    return Transcript('netconf', model, [xml])
+  if model == 'juniper':
+    items = ''.join(["<prefix-list-item><name>%s</name></prefix-list-item>" % (n.with_prefixlen, ) for n in acl])
+    xml = ('<configuration><policy-options><prefix-list><name>%s</name>%s</prefix-list>'
+           '</policy-options></configuration>' % (acl_name, items))
+    return Transcript('netconf', model, [xml])
+  raise ValueError("unknown model: %s" % (model, ))
+
+def measure(func, repeat):
+  """ funcの処理時間の最小値(秒)、メモリ使用量(バイト)、戻値
+  """
+  best = None
+  for i in range(repeat):
+    gc.collect()
+    started = time.time()
+    result = func()
+    elapsed = time.time() - started
+    best = best is None and elapsed or min(best, elapsed)
+  gc.collect()
+  if tracemalloc:
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+  else:
+    # 最大RSS(KB)はプロセス全体の値なので、計測前からの増加量 (近似)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    func()
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxrss) * 1024
+  return best, peak, result
+
+def bench(model, transcript, repeat):
+  sess = get_sess(model)
+  replay_sess(sess, transcript)
+  def get():
+    transcript.rewind()
+    return sess.get_snmp_acl()
+  elapsed, peak, acl = measure(get, repeat)
+  print "%-16s %8d %10.4f %12.0f %10.1f" % (model, len(acl), elapsed, len(acl) / max(elapsed, 1e-9), peak / 1048576.0, )
+
+def record(ipaddr, model, output):
+  """ 機器に接続してget_snmp_acl()の受信データを記録
+  """
+  name, transport, agent_class = [m for m in models if m[0] == model][0]
+  pass_login = getpass.getpass(prompt='ログインパスワードを入力:').strip()
+  pass_enable = getpass.getpass(prompt='イネーブルパスワードを入力:').strip()
+  agent = agent_class(ipaddr)
+  if model == 'juniper_telnet':
+    sess = TelnetSess(agent, pass_login, None, logger_name, user_login='admin')
+  else:
+    sess = agent.get_sess(pass_login, pass_enable, logger_name)
+  sess.open()
+  transcript = Transcript(transport, agent.model)
+  record_sess(sess, transcript)
+  acl = sess.get_snmp_acl()
+  # close()のやりとりは記録しない
+  records = list(transcript.records)
+  sess.close()
+  Transcript(transport, model, records).save(output)
+  print "%s: %d entries recorded to %s" % (ipaddr, len(acl), output, )
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-m', '--model', choices=[m[0] for m in models], dest='model', default=None,
+                      help='cisco, brocade_netiron, juniper_telnet, arista, brocade_vdx or juniper (default: all)' )
+  parser.add_argument('-n', '--entries', metavar='N', type=int, action='append', dest='entries', default=None,
+                      help='number of synthetic ACL entries (default: 10, 100, 1000, 10000, 100000)' )
+  parser.add_argument('-r', '--repeat', type=int, dest='repeat', default=3,
+                      help='number of runs per measurement (default: 3)' )
+  parser.add_argument('--replay', metavar='FILE', dest='replay', default=None,
+                      help='benchmark a recorded transcript (default: None)' )
+  parser.add_argument('--record', metavar='IPADDR', dest='record', default=None,
+                      help='record get_snmp_acl() of a live device (default: None)' )
+  parser.add_argument('-o', '--output', metavar='FILE', dest='output', default=None,
+                      help='transcript file to write with --record (default: ./IPADDR.json)' )
+  args = parser.parse_args()
+
+  if args.record:
+    if not args.model:
+      parser.error("--record requires --model")
+    record(args.record, args.model, args.output or './%s.json' % (args.record, ))
+    return
+
+  print "%-16s %8s %10s %12s %10s" % ('model', 'entries', 'sec', 'entries/sec', 
+                                      tracemalloc and 'peak(MB)' or 'rss+(MB)', )
+  if args.replay:
+    transcript = Transcript.load(args.replay)
+    bench(transcript.model, transcript, args.repeat)
+    return
+  for model in [m[0] for m in models if not args.model or m[0] == args.model]:
+    for n in args.entries or (10, 100, 1000, 10000, 100000, ):
+      bench(model, synthetic_transcript(model, synthetic_acl(n)), args.repeat)
+
+
+if __name__ == '__main__':
+  main()
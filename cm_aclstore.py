@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+""" ACLの内容をハッシュで共有するストア
+
+- 同じ内容のACLは1つだけ保持し、機器からはハッシュで参照する
+- (変更前のハッシュ, 変更後のハッシュ) ごとの差分をメモ化するので、
+  差分の計算とログ出力はACLの種類数に比例し、機器数には比例しない
+
+ >>> store = AclStore()
+ >>> cur_key = store.intern(current_acl)
+ >>> acl_diff_dict = store.diff(cur_key, store.intern(new_acl))
+"""
+
+import hashlib
+import threading
+
+class AclStore(object):
+  """ ハッシュ -> ACL と、差分のメモ
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.acls = dict()
+    self.diffs = dict()
+    self.logged = set()
+    # pin=Trueで登録したリストオブジェクト(新しいACLなど)はハッシュを再計算しない
+    self.pinned = dict()
+
+  def __len__(self):
+    return len(self.acls)
+
+  def intern(self, acl, pin=False):
+    """ ACLを登録してハッシュを返す (エントリの順序と重複は区別しない)
+    pin: 同じリストオブジェクトを何度も渡す場合はTrue (登録後に内容を変更しないこと)
+    """
+    pinned = self.pinned.get(id(acl))
+    if pinned and pinned[0] is acl: return pinned[1]
+    entries = sorted(set(acl))
+    key = hashlib.sha1("\n".join([n.with_prefixlen for n in entries])).hexdigest()
+    with self.lock:
+      if key not in self.acls:
+        self.acls[key] = entries
+      if pin:
+        self.pinned[id(acl)] = (acl, key)
+    return key
+
+  def get(self, key):
+    """ ハッシュに対応するACL (ソート済)
+    """
+    return list(self.acls[key])
+
+  def diff(self, cur_key, new_key):
+    """ cur_keyのACLをnew_keyのACLにするための差分 {'add': [...], 'del': [...]}
+    """
+    with self.lock:
+      if (cur_key, new_key) not in self.diffs:
+        cur, new = set(self.acls[cur_key]), set(self.acls[new_key])
+        self.diffs[(cur_key, new_key)] = dict([('add', sorted(new - cur)), ('del', sorted(cur - new)), ])
+      diff_dict = self.diffs[(cur_key, new_key)]
+    # 呼び出し側で変更してもメモに影響しないようにコピーを返す
+    return dict([(k, list(v)) for k, v in diff_dict.items()])
+
+  def first_seen(self, key):
+    """ keyのACLを初めてログ出力する場合はTrue (以降は同じACLをハッシュだけで出力)
+    """
+    with self.lock:
+      if key in self.logged: return False
+      self.logged.add(key)
+      return True
+
+  def describe(self, key):
+    """ ログ出力用の文字列: 初回はハッシュとエントリ、以降はハッシュのみ
+    """
+    if self.first_seen(key):
+      return "%s (%s)" % (key[:12], ", ".join([n.with_prefixlen for n in self.acls[key]]), )
+    return key[:12]
@@ -8,42 +8,93 @@ from cm_sess.netconf_juniper_sess import NetconfJuniperSess
 from cm_sess.netconf_vdx_sess import NetconfVdxSess
 from cm_sess.telnet_sess import TelnetSess
 
-class Agent:
+class AgentMeta(type):
+  """ Agentのメタクラス
+  - クラス名から機種名(model)をクラスの作成時に1回だけ求める (例: BrocadeNetiron -> brocade_netiron)
+  - __slots__を定義していないサブクラスは __slots__ = () にして、インスタンスの__dict__を持たない
+  """
+  def __new__(mcs, name, bases, attrs):
+    attrs.setdefault('__slots__', ())
+    attrs['model'] = re.sub('([a-z0-9])([A-Z])', 
+                            r'\1_\2', 
+                            re.sub('(.)([A-Z][a-z0-9]+)', 
+                                   r'\1_\2', 
+                                   name, ), 
+                           ).lower()
+    return type.__new__(mcs, name, bases, attrs)
+
+
+class Agent(object):
   """設定変更対象エージェント
+  機器ごとのインスタンスはIPアドレスのみ保持 (機種ごとの設定はクラス属性で共有)
   """
+  __metaclass__ = AgentMeta
+  __slots__ = ('ipaddr', )
+
+  # ACLをSNMPで取得するためのベンダーMIB (cm_sess.pysnmp_sess_v2c.snmpwalk_acl()のmib)
+  # Noneの場合はCLI/APIのセッションで取得する
+  snmp_acl_mib = None
+
+  # セッションで接続する管理ポート (cm_probe.probe()で到達性を確認)
+  # 機種を特定する前は全機種のポートを確認する (モジュールの最後で全サブクラスの和集合にする)
+  mgmt_ports = ()
+
+  # get_sess()で返すセッションのクラス
+  sess_class = None
+
   def __init__(self, ipaddr):
     self.ipaddr = ipaddr
-    self.model = re.sub('([a-z0-9])([A-Z])', 
-                        r'\1_\2', 
-                        re.sub('(.)([A-Z][a-z0-9]+)', 
-                               r'\1_\2', 
-                               self.__class__.__name__, ), 
-                       ).lower()
 
 class Arista(Agent):
+  mgmt_ports = (80, )
+  sess_class = EapiHttpSess
+
   def get_sess(self, pass_login, pass_enable, logger_name, **kw):
     return EapiHttpSess(self, 'admin', pass_login, logger_name, )
 
 class BrocadeNetiron(Agent):
+  mgmt_ports = (23, )
+  sess_class = TelnetSess
+  # FOUNDRY-SN-IP-ACL-MIB::snAgAclTable (マスクはCLIと同じワイルドカード形式)
+  snmp_acl_mib = dict([
+      ('addr', '1.3.6.1.4.1.1991.1.2.2.15.2.1.6'),     # snAgAclSourceIp
+      ('mask', '1.3.6.1.4.1.1991.1.2.2.15.2.1.7'),     # snAgAclSourceMask
+      ('name', '1.3.6.1.4.1.1991.1.2.2.15.2.1.3'),     # snAgAclName
+      ('action', '1.3.6.1.4.1.1991.1.2.2.15.2.1.4'),   # snAgAclFilterAction
+      ('permit', 1),                                    # deny(0), permit(1)
+      ('wildcard', True), 
+      ])
+
   def get_sess(self, pass_login, pass_enable, logger_name, **kw):
     screen_dump  = kw.get('dump_telnet', False)  and splitext(__file__)[0]+"_telnet_dump" or None
     return TelnetSess(self, pass_login, pass_enable, logger_name, 
                       screen_dump=screen_dump, )
 
 class BrocadeVdx(Agent):
+  mgmt_ports = (830, )
+  sess_class = NetconfVdxSess
+
   def get_sess(self, pass_login, pass_enable, logger_name, **kw):
     return NetconfVdxSess(self, 'admin', pass_login, logger_name, )
 
 class Cisco(Agent):
+  mgmt_ports = (23, )
+  sess_class = TelnetSess
+
   def get_sess(self, pass_login, pass_enable, logger_name, **kw):
     screen_dump  = kw.get('dump_telnet', False)  and splitext(__file__)[0]+"_telnet_dump" or None
     return TelnetSess(self, pass_login, pass_enable, logger_name, 
                       screen_dump=screen_dump, )
 
 class Juniper(Agent):
+  mgmt_ports = (830, )
+  sess_class = NetconfJuniperSess
+
   def get_sess(self, pass_login, pass_enable, logger_name, **kw):
     #screen_dump  = kw.get('dump_telnet', False)  and splitext(__file__)[0]+"_telnet_dump" or None
     #return TelnetSess(self, pass_login, None, logger_name, user_login='admin', 
     #                  screen_dump=screen_dump, )
     return NetconfJuniperSess(self, 'admin', pass_login, logger_name, )
 
+
+Agent.mgmt_ports = tuple(sorted(set([port for cls in Agent.__subclasses__() for port in cls.mgmt_ports])))
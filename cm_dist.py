@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+
+""" 複数ホストで分散実行するためのコーディネータとワーカー
+
+- コーディネータが機器ごとのリース(有効期限つきの担当割り当て)をTCPで配布
+- ワーカーはリースを取得してセッションを実行し、結果を返す
+- ワーカーは実行中に定期的にリースを延長、延長されずに期限切れになったリースや
+  接続が切れたワーカーのリースは他のワーカーに再割り当て
+  (延長できなかったワーカーは、そのリースの以降の処理状態と結果を通知しない)
+- メッセージは1行1件のJSON
+- 共有鍵(secret)を指定した場合は、接続ごとにチャレンジ/レスポンスで認証 (HMAC-SHA256)
+  認証しない接続はリースの取得やジャーナルへの記録ができない
+
+ ワーカー → コーディネータ          コーディネータ → ワーカー
+                                    {"challenge": ..} (secretを指定した場合、接続直後)
+ {"op": "auth", "digest": ..}       {"ok": true} / 認証に失敗した場合は {"error": ..} を返して切断
+ {"op": "lease"}                    {"lease_id": .., "ipaddr": .., "kw": {..}, "payload": .., "ttl": ..}
+                                    {"wait": 秒} (実行中のリースの完了待ち) / {"done": true}
+ {"op": "renew", "lease_id": ..}    {"ok": true|false}
+ {"op": "record", "ipaddr": .., "state": .., "note": ..}
+                                    {"ok": true} (処理状態をコーディネータのジャーナルに記録)
+ {"op": "observe", "ipaddr": .., "model": .., "acl_size": .., "duration": ..}
+                                    {"ok": true} (所要時間をコーディネータの履歴に記録)
+ {"op": "snapshot", "ipaddr": .., "model": .., "current_acl": [..], "target_acl": [..]}
+                                    {"ok": true} (変更前のACLをコーディネータのスナップショットに記録)
+ {"op": "result", "lease_id": .., "state": ..}
+                                    {"ok": true|false} (falseは期限切れで再割り当て済)
+"""
+
+import os
+import time
+import json
+import hmac
+import socket
+import hashlib
+import itertools
+import threading
+import traceback
+import SocketServer
+from collections import deque
+from ipaddr import IPv4Network
+
+def auth_digest(secret, challenge):
+  return hmac.new(secret, challenge, hashlib.sha256).hexdigest()
+
+
+class LeaseTable(object):
+  """ 未割り当ての機器と有効なリースを管理
+  """
+  def __init__(self, items, ttl=60):
+    # itemsは (ipaddr, kw) のリスト
+    self.pending = deque(items)
+    self.ttl = ttl
+    self.leases = dict()
+    self.results = dict()
+    self.lock = threading.Lock()
+    self.cond = threading.Condition(self.lock)
+    self.ids = itertools.count(1)
+
+  def _reclaim(self):
+    """ 期限切れのリースを未割り当てに戻す
+    """
+    now = time.time()
+    for lease_id, (ipaddr, kw, expires) in self.leases.items():
+      if expires < now:
+        del self.leases[lease_id]
+        self.pending.appendleft((ipaddr, kw))
+
+  def acquire(self):
+    """ リースを1件割り当てる
+    戻値: (lease_id, ipaddr, kw) / 実行中のリースだけが残っている場合はNone / 全て完了した場合はFalse
+    """
+    with self.lock:
+      self._reclaim()
+      if self.pending:
+        ipaddr, kw = self.pending.popleft()
+        lease_id = next(self.ids)
+        self.leases[lease_id] = (ipaddr, kw, time.time() + self.ttl)
+        return lease_id, ipaddr, kw
+      return None if self.leases else False
+
+  def renew(self, lease_id):
+    with self.lock:
+      if lease_id not in self.leases: return False
+      ipaddr, kw, expires = self.leases[lease_id]
+      self.leases[lease_id] = (ipaddr, kw, time.time() + self.ttl)
+      return True
+
+  def release(self, lease_id):
+    """ 完了せずに手放されたリースを未割り当てに戻す
+    """
+    with self.lock:
+      if lease_id not in self.leases: return
+      ipaddr, kw, expires = self.leases.pop(lease_id)
+      self.pending.appendleft((ipaddr, kw))
+
+  def complete(self, lease_id, state, requeue_kw=None):
+    """ 結果を記録 (requeue_kwを指定すると、そのオプションで未割り当ての最後に戻す)
+    戻値: (ipaddr, kw) / リースが無効な場合はNone
+    """
+    with self.cond:
+      if lease_id not in self.leases: return None
+      ipaddr, kw, expires = self.leases.pop(lease_id)
+      if requeue_kw is not None:
+        self.pending.append((ipaddr, dict(kw, **requeue_kw)))
+      else:
+        self.results[ipaddr] = state
+      self.cond.notify_all()
+      return ipaddr, kw
+
+  def wait(self, timeout=None):
+    """ 全て完了するまで待つ
+    """
+    with self.cond:
+      while self.pending or self.leases:
+        self.cond.wait(timeout or self.ttl)
+        self._reclaim()
+
+
+class _LeaseHandler(SocketServer.StreamRequestHandler):
+  """ ワーカー1接続分の処理
+  """
+  def handle(self):
+    coord = self.server.coordinator
+    granted = set()
+    try:
+      if coord.secret is not None and not self.authenticate(coord):
+        coord.logger.warn("%s: %s: 認証に失敗しました." % (coord.__class__.__name__, self.client_address[0], ))
+        return
+      for line in iter(self.rfile.readline, ''):
+        req = json.loads(line)
+        if req.get('op') == 'lease':
+          lease = coord.table.acquire()
+          if lease is False:
+            rsp = dict(done=True)
+          elif lease is None:
+            rsp = dict(wait=coord.poll_interval)
+          else:
+            lease_id, ipaddr, kw = lease
+            granted.add(lease_id)
+            rsp = dict(lease_id=lease_id, ipaddr=ipaddr, kw=kw, payload=coord.payload, ttl=coord.table.ttl)
+        elif req.get('op') == 'renew':
+          rsp = dict(ok=coord.table.renew(req['lease_id']))
+        elif req.get('op') == 'record':
+          if coord.journal:
+            coord.journal.record(req['ipaddr'], req['state'], req.get('note'))
+          rsp = dict(ok=True)
+        elif req.get('op') == 'observe':
+          if coord.history:
+            coord.history.observe(req['ipaddr'], req['model'], req['acl_size'], req['duration'])
+          rsp = dict(ok=True)
+        elif req.get('op') == 'snapshot':
+          if coord.snapshots:
+            coord.snapshots.save(req['ipaddr'], req['model'], 
+                                 map(IPv4Network, req['current_acl']), map(IPv4Network, req['target_acl']))
+          rsp = dict(ok=True)
+        elif req.get('op') == 'result':
+          granted.discard(req['lease_id'])
+          rsp = dict(ok=coord.on_result(req['lease_id'], req.get('state')))
+        else:
+          rsp = dict(error="unknown op: %s" % (req.get('op'), ))
+        self.wfile.write(json.dumps(rsp) + "\n")
+        self.wfile.flush()
+    except (socket.error, ValueError):
+      coord.logger.debug(traceback.format_exc())
+    finally:
+      # 接続が切れたワーカーのリースは再割り当て
+      for lease_id in granted:
+        coord.table.release(lease_id)
+
+  def authenticate(self, coord):
+    """ チャレンジを送り、共有鍵で計算したダイジェストが一致すればTrue
+    """
+    challenge = os.urandom(16).encode('hex')
+    self.wfile.write(json.dumps(dict(challenge=challenge)) + "\n")
+    self.wfile.flush()
+    req = json.loads(self.rfile.readline() or 'null') or dict()
+    if req.get('op') == 'auth' and \
+       hmac.compare_digest(str(req.get('digest', '')), auth_digest(coord.secret, challenge)):
+      rsp = dict(ok=True)
+    else:
+      rsp = dict(error="authentication failed")
+    self.wfile.write(json.dumps(rsp) + "\n")
+    self.wfile.flush()
+    return 'ok' in rsp
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class Coordinator(object):
+  """ リースを配布するコーディネータ
+  items: (ipaddr, kw) のリスト
+  payload: 全ワーカー共通で渡すデータ (JSONに変換できること)
+  journal: ワーカーから通知された処理状態を記録するRunJournal
+  history: ワーカーから通知された所要時間を記録するDurationHistory
+  snapshots: ワーカーから通知された変更前のACLを記録するSnapshotStore
+  on_complete: 結果を受け取ったときに (ipaddr, kw, state) で呼び出す
+               戻値が辞書の場合は、そのオプションを追加して再実行する
+  secret: ワーカーを認証する共有鍵 (Noneの場合は認証しない)
+  """
+  def __init__(self, addr, items, payload, logger, journal=None, on_complete=None, ttl=60, poll_interval=2, 
+               history=None, secret=None, snapshots=None):
+    self.table = LeaseTable(items, ttl=ttl)
+    self.payload = payload
+    self.logger = logger
+    self.journal = journal
+    self.history = history
+    self.snapshots = snapshots
+    self.secret = secret
+    self.on_complete = on_complete
+    self.poll_interval = poll_interval
+    self.server = _ThreadingTCPServer(addr, _LeaseHandler)
+    self.server.coordinator = self
+
+  def on_result(self, lease_id, state):
+    with self.table.lock:
+      if lease_id not in self.table.leases: return False
+      ipaddr, kw, expires = self.table.leases[lease_id]
+    requeue_kw = self.on_complete and self.on_complete(ipaddr, kw, state) or None
+    return self.table.complete(lease_id, state, requeue_kw=requeue_kw) is not None
+
+  def run(self):
+    """ 全ての機器が完了するまでリースを配布
+    """
+    t = threading.Thread(target=self.server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    self.logger.info("%s: %s:%d でリースを配布します." % ((self.__class__.__name__, ) + self.server.server_address))
+    try:
+      self.table.wait()
+    finally:
+      self.server.shutdown()
+      self.server.server_close()
+    return self.table.results
+
+
+class Worker(object):
+  """ コーディネータからリースを取得して実行するワーカー
+  func: (ipaddr, kw, payload, journal) で呼び出す関数、戻値を結果としてコーディネータに返す
+        journalにはコーディネータのジャーナルに記録するrecord()、コーディネータの履歴に記録する
+        observe()、コーディネータのスナップショットに記録するsave()を持つこのオブジェクトを渡す
+  secret: コーディネータに認証される共有鍵 (コーディネータと同じ値)
+  failed_state: funcが例外を送出した場合に記録して結果として返す処理状態
+  リースの延長に失敗した(他のワーカーに再割り当てされた)場合は、以降の記録と結果を通知しない
+  """
+  def __init__(self, addr, func, logger, secret=None, failed_state='failed'):
+    self.addr = addr
+    self.func = func
+    self.logger = logger
+    self.secret = secret
+    self.failed_state = failed_state
+    self.lock = threading.Lock()
+    # 実行中のリースを失ったらセット
+    self.lost = threading.Event()
+
+  def request(self, req):
+    with self.lock:
+      self.wfile.write(json.dumps(req) + "\n")
+      self.wfile.flush()
+      line = self.rfile.readline()
+    if not line:
+      raise socket.error("%s: connection closed by coordinator." % (self.__class__.__name__, ))
+    return json.loads(line)
+
+  def record(self, ipaddr, state, note=None):
+    """ 処理状態をコーディネータのジャーナルに記録 (RunJournal.record()と同じ呼び出し方)
+    """
+    if self.lost.is_set(): return
+    self.request(dict(op='record', ipaddr=ipaddr, state=state, note=note))
+
+  def observe(self, ipaddr, model, acl_size, duration):
+    """ 所要時間をコーディネータの履歴に記録 (DurationHistory.observe()と同じ呼び出し方)
+    """
+    self.request(dict(op='observe', ipaddr=ipaddr, model=model, acl_size=acl_size, duration=duration))
+
+  def save(self, ipaddr, model, current_acl, target_acl):
+    """ 変更前のACLをコーディネータのスナップショットに記録 (SnapshotStore.save()と同じ呼び出し方)
+    """
+    self.request(dict(op='snapshot', ipaddr=ipaddr, model=model, 
+                      current_acl=[n.with_prefixlen for n in current_acl], 
+                      target_acl=[n.with_prefixlen for n in target_acl]))
+
+  def authenticate(self):
+    """ コーディネータのチャレンジに共有鍵で計算したダイジェストを返す
+    """
+    line = self.rfile.readline()
+    challenge = line and json.loads(line).get('challenge')
+    if not challenge:
+      raise socket.error("%s: no challenge from coordinator." % (self.__class__.__name__, ))
+    rsp = self.request(dict(op='auth', digest=auth_digest(self.secret, str(challenge))))
+    if rsp.get('error'):
+      raise socket.error("%s: %s" % (self.__class__.__name__, rsp['error'], ))
+
+  def _keep_alive(self, lease_id, ttl, done, lost):
+    """ 実行中はリースを延長し続ける (延長できなかったらlostをセット)
+    """
+    while not done.wait(ttl / 3.0):
+      try:
+        if not self.request(dict(op='renew', lease_id=lease_id)).get('ok'):
+          self.logger.warn("%s: lease %s expired." % (self.__class__.__name__, lease_id, ))
+          lost.set()
+          return
+      except (socket.error, ValueError):
+        lost.set()
+        return
+
+  def run(self):
+    """ コーディネータから完了通知を受け取るまで実行
+    """
+    sock = socket.create_connection(self.addr)
+    self.rfile, self.wfile = sock.makefile('rb'), sock.makefile('wb')
+    try:
+      if self.secret is not None: self.authenticate()
+      while True:
+        rsp = self.request(dict(op='lease'))
+        if 'challenge' in rsp or 'error' in rsp:
+          raise socket.error("%s: %s" % (self.__class__.__name__, rsp.get('error', "coordinator requires a shared secret"), ))
+        if rsp.get('done'): break
+        if 'wait' in rsp:
+          time.sleep(rsp['wait'])
+          continue
+        done, self.lost = threading.Event(), threading.Event()
+        t = threading.Thread(target=self._keep_alive, args=(rsp['lease_id'], rsp['ttl'], done, self.lost))
+        t.setDaemon(True)
+        t.start()
+        try:
+          state = self.func(rsp['ipaddr'], rsp['kw'], rsp['payload'], self)
+        except Exception, e:
+          # 想定外の例外でもワーカーは終了せずに、失敗として結果を返して次のリースを取得
+          self.logger.debug(traceback.format_exc())
+          self.logger.error("%s: %s: %s" % (self.__class__.__name__, rsp['ipaddr'], str(e.__class__), ))
+          state = self.failed_state
+          self.record(rsp['ipaddr'], state, str(e.__class__))
+        finally:
+          done.set()
+        if self.lost.is_set():
+          # 再割り当て済のリースの結果は返さない (コーディネータでは他のワーカーの結果を採用)
+          self.logger.warn("%s: %s: lease %s lost, result discarded." % (
+              self.__class__.__name__, rsp['ipaddr'], rsp['lease_id'], ))
+          continue
+        self.request(dict(op='result', lease_id=rsp['lease_id'], state=state))
+    finally:
+      sock.close()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+""" 機器にコンフィグの断片を転送するための一時的なファイルサーバ
+
+- TftpServer: TFTP(RFC1350)の読み出し(RRQ)のみ
+- HttpFileServer: HTTPのGETのみ
+- ファイルはメモリ上に置き、publish()したときに指定した機器からの要求にだけ応答
+- URLのホスト部は、機器へのルーティングで使われるローカルのIPアドレス
+
+ >>> server = TftpServer(('0.0.0.0', 69))
+ >>> server.start()
+ >>> name = server.publish(snippet, '192.0.2.1')
+ >>> url = server.url(name, '192.0.2.1')       # 'tftp://192.0.2.10/cm-1234-....cfg'
+ >>> server.withdraw(name)
+ >>> server.close()
+"""
+
+import os
+import time
+import uuid
+import select
+import socket
+import struct
+import logging
+import threading
+import SocketServer
+import BaseHTTPServer
+
+def local_addr(peer):
+  """ peerへの経路で使われるローカルのIPアドレス (UDPのconnect()はパケットを送信しない)
+  """
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    sock.connect((peer, 9))
+    return sock.getsockname()[0]
+  finally:
+    sock.close()
+
+
+class FileServer(object):
+  """ ファイルサーバのベースクラス
+  addr: 待ち受けるアドレス (ホストが '0.0.0.0' の場合はURLに機器ごとのローカルアドレスを使う)
+  """
+  scheme = None
+  default_port = None
+
+  def __init__(self, addr, logger=None):
+    self.addr = addr
+    self.logger = logger or logging.getLogger(__name__)
+    self.lock = threading.Lock()
+    # 名前: (データ, 取得を許可する機器のIPアドレス)
+    self.files = dict()
+    self.thread = None
+
+  def publish(self, data, peer, suffix='.cfg'):
+    """ dataをpeerから取得できるようにして名前を返す
+    """
+    name = "cm-%d-%s%s" % (os.getpid(), uuid.uuid4().hex, suffix, )
+    with self.lock:
+      self.files[name] = (data, peer)
+    return name
+
+  def withdraw(self, name):
+    with self.lock:
+      self.files.pop(name, None)
+
+  def lookup(self, name, peer):
+    """ peerに許可したファイルのデータ (なければNone)
+    """
+    with self.lock:
+      data, allowed = self.files.get(name, (None, None))
+    if allowed != peer:
+      self.logger.warn("%s: %s: 公開していないファイルを要求されました." % (peer, name, ))
+      return None
+    return data
+
+  def url(self, name, peer):
+    host, port = self.addr
+    if host in ('', '0.0.0.0'): host = local_addr(peer)
+    if port != self.default_port: host = "%s:%d" % (host, port, )
+    return "%s://%s/%s" % (self.scheme, host, name, )
+
+  def start(self):
+    self.thread = threading.Thread(target=self.serve)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def serve(self):
+    raise NotImplementedError
+
+  def close(self):
+    raise NotImplementedError
+
+
+class TftpServer(FileServer):
+  """ 読み出し専用のTFTPサーバ (転送ごとにスレッドとソケットを作成)
+  """
+  scheme = 'tftp'
+  default_port = 69
+
+  RRQ, WRQ, DATA, ACK, ERROR = 1, 2, 3, 4, 5
+  block_size = 512
+
+  def __init__(self, addr=('0.0.0.0', 69), logger=None, timeout=2.0, retries=5):
+    FileServer.__init__(self, addr, logger)
+    self.timeout = timeout
+    self.retries = retries
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind(addr)
+    self.closed = False
+
+  def serve(self):
+    while not self.closed:
+      readable, w, x = select.select([self.sock], [], [], 1.0)
+      if not readable: continue
+      try:
+        packet, client = self.sock.recvfrom(65535)
+      except socket.error:
+        continue
+      self.handle(packet, client)
+
+  def handle(self, packet, client):
+    opcode, = struct.unpack('!H', packet[:2])
+    if opcode != self.RRQ:
+      # 書き込み(WRQ)などは受け付けない
+      self.sock.sendto(self.error_packet(2, "access violation"), client)
+      return
+    name = packet[2:].split('\0')[0].lstrip('/')
+    data = self.lookup(name, client[0])
+    if data is None:
+      self.sock.sendto(self.error_packet(1, "file not found"), client)
+      return
+    t = threading.Thread(target=self.transfer, args=(data, client, name, ))
+    t.setDaemon(True)
+    t.start()
+
+  def transfer(self, data, client, name):
+    """ 512バイトのブロックごとにACKを待って送信 (タイムアウトしたら再送)
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((self.addr[0], 0))
+    sock.settimeout(self.timeout)
+    started = time.time()
+    try:
+      # データ長がブロック長の倍数の場合は最後に空のブロックを送る
+      for i in range(len(data) // self.block_size + 1):
+        block = (i + 1) & 0xffff
+        packet = struct.pack('!HH', self.DATA, block) + data[i * self.block_size:(i + 1) * self.block_size]
+        for n in range(self.retries):
+          sock.sendto(packet, client)
+          if self.wait_ack(sock, client, block): break
+        else:
+          self.logger.warn("%s: %s: TFTPの転送がタイムアウトしました." % (client[0], name, ))
+          return
+      self.logger.debug("%s: %s: TFTPで%dバイト転送しました. (%.2f秒)" % (
+          client[0], name, len(data), time.time() - started, ))
+    except socket.error, e:
+      self.logger.warn("%s: %s: TFTPの転送に失敗しました.: %s" % (client[0], name, str(e), ))
+    finally:
+      sock.close()
+
+  def wait_ack(self, sock, client, block):
+    """ blockのACKを受信したらTrue、タイムアウトしたらFalse (ERRORを受信したらsocket.error)
+    """
+    while True:
+      try:
+        packet, src = sock.recvfrom(65535)
+      except socket.timeout:
+        return False
+      if src != client or len(packet) < 4: continue
+      opcode, acked = struct.unpack('!HH', packet[:4])
+      if opcode == self.ERROR:
+        raise socket.error("TFTP error %d: %s" % (acked, packet[4:].rstrip('\0'), ))
+      if opcode == self.ACK and acked == block: return True
+
+  def error_packet(self, code, msg):
+    return struct.pack('!HH', self.ERROR, code) + msg + '\0'
+
+  def close(self):
+    self.closed = True
+    if self.thread: self.thread.join()
+    self.sock.close()
+
+
+class HttpFileRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """ publish()したファイルを返すハンドラ
+  """
+  def do_GET(self):
+    owner = self.server.owner
+    data = owner.lookup(self.path.lstrip('/'), self.client_address[0])
+    if data is None:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    self.server.owner.logger.debug("%s: %s" % (self.client_address[0], format % args, ))
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class HttpFileServer(FileServer):
+  """ GETのみのHTTPサーバ
+  """
+  scheme = 'http'
+  default_port = 80
+
+  def __init__(self, addr=('0.0.0.0', 8080), logger=None):
+    FileServer.__init__(self, addr, logger)
+    self.httpd = ThreadingHTTPServer(addr, HttpFileRequestHandler)
+    self.httpd.owner = self
+
+  def serve(self):
+    self.httpd.serve_forever()
+
+  def close(self):
+    if self.thread: self.httpd.shutdown()
+    self.httpd.server_close()
+
+
+# スキームごとのサーバのクラス
+servers = dict([(cls.scheme, cls) for cls in (TftpServer, HttpFileServer, )])
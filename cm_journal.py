@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+""" 機器ごとの処理状態を記録するジャーナル (SQLite)
+
+- 状態は追記のみで更新しない (機器ごとに最後に記録した状態が現在の状態)
+- 記録ごとにコミットするので、プロセスが異常終了しても記録済の状態は残る
+- 中断した実行は RUN_ID を指定して再開できる
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+# 機器ごとの処理状態
+DISCOVERED = 'discovered'   # 機種を特定した
+READ = 'read'               # 現在のACLを取得した
+APPLIED = 'applied'         # ACLを変更した (未保存、確認待ちのセッションがあればnoteにその名前)
+SAVED = 'saved'             # 保存した (or 変更不要だった)
+FAILED = 'failed'           # 失敗した
+
+# 実行の種類
+UPDATE = 'update'           # 新しいACLに更新
+ROLLBACK = 'rollback'       # 対象のRUN_IDで変更した機器を変更前のACLに戻す
+
+class RunJournal(object):
+  """ 実行ごと(RUN_ID)に機器の処理状態を記録するジャーナル
+  kind: 新しく実行する場合の種類 (UPDATE, ROLLBACK)
+  target: ROLLBACKの場合は対象のRUN_ID
+  再開する場合(run_idを指定)は、kindとtargetは記録済の値になる
+  """
+  def __init__(self, path, run_id=None, kind=UPDATE, target=None):
+    self.path = path
+    self.lock = threading.Lock()
+    # ワーカースレッドから共有するので check_same_thread=False (書き込みはlockで直列化)
+    self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self.conn.execute("PRAGMA journal_mode=WAL")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, started REAL)")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS events ("
+                      "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                      "run_id TEXT, ipaddr TEXT, state TEXT, ts REAL, note TEXT)")
+    self.conn.execute("CREATE INDEX IF NOT EXISTS events_run ON events (run_id, ipaddr)")
+    # 実行の種類の列がない古いジャーナルには追加 (記録済の実行はUPDATE)
+    columns = [row[1] for row in self.conn.execute("PRAGMA table_info(runs)")]
+    if 'kind' not in columns:
+      self.conn.execute("ALTER TABLE runs ADD COLUMN kind TEXT DEFAULT '%s'" % (UPDATE, ))
+      self.conn.execute("ALTER TABLE runs ADD COLUMN target TEXT")
+    if run_id:
+      # 再開: 記録済のRUN_IDであること
+      row = self.conn.execute("SELECT kind, target FROM runs WHERE run_id = ?", (run_id, )).fetchone()
+      if not row:
+        raise ValueError("%s: RUN_IDが見つかりません.: %s" % (self.path, run_id, ))
+      self.run_id = run_id
+      self.kind, self.target = str(row[0] or UPDATE), row[1] and str(row[1])
+    else:
+      self.run_id = "%s-%d" % (time.strftime('%Y%m%d%H%M%S'), os.getpid(), )
+      self.kind, self.target = kind, target
+      self.conn.execute("INSERT INTO runs (run_id, started, kind, target) VALUES (?, ?, ?, ?)", 
+                        (self.run_id, time.time(), kind, target, ))
+
+  def record(self, ipaddr, state, note=None):
+    """ 機器の処理状態を追記
+    """
+    with self.lock:
+      self.conn.execute("INSERT INTO events (run_id, ipaddr, state, ts, note) VALUES (?, ?, ?, ?, ?)",
+                        (self.run_id, ipaddr, state, time.time(), note, ))
+
+  def states(self):
+    """ 機器ごとに最後に記録された状態の辞書を返す
+    """
+    with self.lock:
+      rows = self.conn.execute("SELECT ipaddr, state FROM events WHERE id IN "
+                               "(SELECT MAX(id) FROM events WHERE run_id = ? GROUP BY ipaddr)",
+                               (self.run_id, )).fetchall()
+    return dict(rows)
+
+  def notes(self, state):
+    """ 最後に記録された状態がstateの機器の、記録時のnoteの辞書を返す
+    """
+    with self.lock:
+      rows = self.conn.execute("SELECT ipaddr, note FROM events WHERE id IN "
+                               "(SELECT MAX(id) FROM events WHERE run_id = ? GROUP BY ipaddr) AND state = ?",
+                               (self.run_id, state, )).fetchall()
+    return dict(rows)
+
+  def close(self):
+    with self.lock:
+      self.conn.close()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+""" 設定変更のトラップとsyslogを受信して、変更のあった機器だけを通知するリスナー
+
+- SNMPトラップ(v1/v2c)とsyslogをUDPで受信
+-- トラップ: ciscoConfigManEvent, jnxCmCfgChange など config_change_traps のOID
+-- syslog: config_change_patterns にマッチするメッセージ
+- 同じ機器からの通知はdebounce秒間まとめて、最後の通知からdebounce秒後にon_change(IPアドレス)を1回呼び出す
+- ipaddrsを指定した場合は、送信元がipaddrsの機器からの通知だけを受け付ける
+  (v1トラップのagent-addrは送信元が対象機器の場合だけ使う)
+- 162番(トラップ)、514番(syslog)ポートで待ち受けるにはroot権限が必要
+
+ >>> listener = ChangeListener(lambda ipaddr: queue.put((ipaddr, dict())), ipaddrs=agent_ipaddrs)
+ >>> listener.run()
+"""
+
+import re
+import time
+import select
+import socket
+import logging
+from pyasn1.codec.ber import decoder
+from pysnmp.proto import api
+
+# 設定変更を示すトラップのOID
+config_change_traps = (
+    '1.3.6.1.4.1.9.9.43.2.0.1',     # CISCO-CONFIG-MAN-MIB::ciscoConfigManEvent
+    '1.3.6.1.4.1.2636.4.5.0.1',     # JUNIPER-CFGMGMT-MIB::jnxCmCfgChange
+    )
+
+# 設定変更を示すsyslogメッセージ
+config_change_patterns = re.compile('|'.join([
+    r'%SYS-5-CONFIG_I\b',                 # cisco, arista
+    r'CONFIG_SESSION_COMMIT_SUCCESS',     # arista (configure session)
+    r'\bUI_COMMIT(_COMPLETED)?\b',        # juniper
+    r'running-config was changed',        # brocade netiron
+    r'\bDCM-1006\b',                      # brocade vdx
+    ]))
+
+# v2cトラップのsnmpTrapOID.0
+snmp_trap_oid = (1, 3, 6, 1, 6, 3, 1, 1, 4, 1, 0)
+
+def decode_trap(msg, community=None):
+  """ トラップのOIDとエージェントのアドレス(v1のみ)を返す
+  トラップ以外、コミュニティが一致しない場合はNone
+  """
+  version = int(api.decodeMessageVersion(msg))
+  if version not in api.protoModules: return None
+  p_mod = api.protoModules[version]
+  req_msg, rest = decoder.decode(msg, asn1Spec=p_mod.Message())
+  if community and str(p_mod.apiMessage.getCommunity(req_msg)) != community: return None
+  req_pdu = p_mod.apiMessage.getPDU(req_msg)
+  if not req_pdu.isSameTypeWith(p_mod.TrapPDU()): return None
+  if version == api.protoVersion1:
+    # enterprise.0.specific-trap
+    oid = tuple(p_mod.apiTrapPDU.getEnterprise(req_pdu)) + (0, int(p_mod.apiTrapPDU.getSpecificTrap(req_pdu)), )
+    return '.'.join(map(str, oid)), p_mod.apiTrapPDU.getAgentAddr(req_pdu).prettyPrint()
+  for name, val in p_mod.apiPDU.getVarBinds(req_pdu):
+    if tuple(name) == snmp_trap_oid:
+      return '.'.join(map(str, tuple(val))), None
+  return None
+
+
+class ChangeListener(object):
+  """ トラップとsyslogを受信してdebounceした機器をon_changeに渡す
+  ipaddrs: 対象機器のIPアドレス (Noneの場合は全て)
+  community: トラップのコミュニティ (Noneの場合はチェックしない、trap_addrを指定する場合は指定すること)
+  """
+  def __init__(self, on_change, ipaddrs=None, trap_addr=('0.0.0.0', 162), syslog_addr=('0.0.0.0', 514),
+               debounce=30, community=None, logger=None):
+    self.on_change = on_change
+    self.ipaddrs = ipaddrs is not None and set(ipaddrs) or None
+    self.debounce = debounce
+    self.community = community
+    self.logger = logger or logging.getLogger(__name__)
+    # 機器ごとにon_changeを呼び出す時刻
+    self.pending = dict()
+    self.socks = dict()
+    for kind, addr in (('trap', trap_addr), ('syslog', syslog_addr), ):
+      if not addr: continue
+      sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      sock.bind(addr)
+      self.socks[sock] = kind
+
+  def notify(self, ipaddr, reason):
+    """ 設定変更を受け付ける (debounce秒以内に再度通知があれば延長)
+    """
+    if self.ipaddrs is not None and ipaddr not in self.ipaddrs: return
+    if ipaddr not in self.pending:
+      self.logger.info("%s: %s: 設定変更を検知しました." % (ipaddr, reason, ))
+    self.pending[ipaddr] = time.time() + self.debounce
+
+  def handle_trap(self, data, src):
+    # 対象機器以外からのトラップは、agent-addrに対象機器を指定していても受け付けない
+    if self.ipaddrs is not None and src not in self.ipaddrs: return
+    try:
+      trap = decode_trap(data, self.community)
+    except Exception, e:
+      self.logger.debug("%s: トラップを解析できません.: %s" % (src, str(e), ))
+      return
+    if not trap: return
+    oid, agent_addr = trap
+    if oid in config_change_traps:
+      self.notify(agent_addr and agent_addr != '0.0.0.0' and agent_addr or src, oid)
+
+  def handle_syslog(self, data, src):
+    m = config_change_patterns.search(data)
+    if m: self.notify(src, m.group(0))
+
+  def fire(self):
+    """ 期限になった機器をon_changeに渡す
+    """
+    now = time.time()
+    for ipaddr in [ipaddr for ipaddr, due in self.pending.items() if due <= now]:
+      del self.pending[ipaddr]
+      self.on_change(ipaddr)
+
+  def run_once(self, timeout=1.0):
+    """ 受信を待ってから(最大timeout秒)、期限になった機器を処理
+    """
+    if self.pending:
+      timeout = max(0, min(timeout, min(self.pending.values()) - time.time()))
+    readable, w, x = select.select(self.socks.keys(), [], [], timeout)
+    for sock in readable:
+      data, (src, port) = sock.recvfrom(65535)
+      getattr(self, 'handle_' + self.socks[sock])(data, src)
+    self.fire()
+
+  def run(self):
+    while True:
+      self.run_once()
+
+  def close(self):
+    for sock in self.socks:
+      sock.close()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+""" 同時実行数を実行中に調整するワーカープール
+
+- スレッドは上限(ceiling)の数だけ起動し、同時に処理する機器の数をlimitで制限
+- window秒ごとに完了数、エラー率、ログインから取得までの所要時間を集計してlimitを調整 (AIMD)
+-- エラー率がerror_ratioを超えた、または所要時間がこれまでの最小値のlatency_ratio倍を超えた場合は半分に減らす
+-- それ以外は完了数/秒が前回から落ちていなければ1ずつ増やし、1割以上落ちた場合は1つ戻す
+
+ >>> pool = AdaptivePool(initial=5, ceiling=50, logger=logger)
+ >>> pool.acquire()
+ >>> state = run_sess(ipaddr, ..., on_phase=pool.observe_phase)
+ >>> pool.release(error=state == cm_journal.FAILED)
+"""
+
+import time
+import threading
+
+class AdaptivePool(object):
+  """ 同時実行数をAIMDで調整するゲート
+  latency_phase: 所要時間を監視する処理状態 (run_sess()のon_phaseに渡される状態)
+  """
+  def __init__(self, initial, ceiling, floor=1, window=10.0, error_ratio=0.2, latency_ratio=2.0,
+               latency_phase='read', logger=None):
+    self.ceiling = ceiling
+    self.floor = floor
+    self.limit = max(floor, min(initial, ceiling))
+    self.window = window
+    self.error_ratio = error_ratio
+    self.latency_ratio = latency_ratio
+    self.latency_phase = latency_phase
+    self.logger = logger
+    self.cond = threading.Condition()
+    self.active = 0
+    self.base_latency = None
+    self.last_rate = None
+    self._reset_window()
+
+  def _reset_window(self):
+    self.window_started = time.time()
+    self.done = 0
+    self.errors = 0
+    self.latencies = list()
+
+  def acquire(self):
+    """ 同時実行数がlimit未満になるまで待つ
+    """
+    with self.cond:
+      while self.active >= self.limit:
+        self.cond.wait()
+      self.active += 1
+
+  def release(self, error=False):
+    """ 1台の処理の完了を通知 (error: 失敗した場合はTrue)
+    """
+    with self.cond:
+      self.active -= 1
+      self.done += 1
+      if error: self.errors += 1
+      self._adjust()
+      self.cond.notify_all()
+
+  def observe_phase(self, phase, seconds):
+    """ 処理状態ごとの所要時間 (run_sess()のon_phase)
+    """
+    if phase != self.latency_phase: return
+    with self.cond:
+      self.latencies.append(seconds)
+
+  def _adjust(self):
+    """ window秒ごとにlimitを調整
+    """
+    elapsed = time.time() - self.window_started
+    if elapsed < self.window: return
+    rate = self.done / elapsed
+    error_rate = float(self.errors) / self.done
+    latency = self.latencies and sum(self.latencies) / len(self.latencies) or None
+    if latency is not None and (self.base_latency is None or latency < self.base_latency):
+      self.base_latency = latency
+    limit = self.limit
+    if error_rate > self.error_ratio or \
+       (latency is not None and latency > self.base_latency * self.latency_ratio):
+      # エラーや応答の遅延は機器やAAAサーバの過負荷とみなして半分に減らす
+      limit = max(self.floor, self.limit // 2)
+    elif self.last_rate is None or rate >= self.last_rate:
+      limit = min(self.ceiling, self.limit + 1)
+    elif rate < self.last_rate * 0.9:
+      # 増やしても完了数が増えない場合は戻す
+      limit = max(self.floor, self.limit - 1)
+    if limit != self.limit and self.logger:
+      self.logger.info("%s: 同時実行数 %d -> %d (完了: %.2f/秒, エラー率: %.2f, 所要時間: %s)" % (
+              self.__class__.__name__, self.limit, limit, rate, error_rate,
+              latency is None and '-' or "%.2f秒" % (latency, ), ))
+    self.limit = limit
+    self.last_rate = rate
+    self._reset_window()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+""" セッションを開始する前に管理ポートへの到達性をまとめて確認
+
+- 全機器の管理ポート(telnet 23, NETCONF 830, eAPI 80)にノンブロッキングでconnect()して
+  poll()で完了を待つので、数千の機器でもタイムアウト1回分の時間で確認できる
+- 機器ごとにいずれかのポートに接続できれば到達可能とする
+
+ >>> reachable = probe([('192.0.2.1', (23, )), ('192.0.2.2', (830, ))], timeout=3)
+"""
+
+import time
+import errno
+import select
+import socket
+import resource
+
+# poll()で接続の完了(またはエラー)を示すイベント
+_done_events = select.POLLOUT | select.POLLERR | select.POLLHUP
+
+def max_batch(reserved=64):
+  """ 同時にオープンできるソケット数 (ファイルディスクリプタの上限から予備を除く)
+  """
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  return max(1, soft - reserved)
+
+def _probe_batch(targets, timeout):
+  """ targetsの (IPアドレス, ポート) に同時に接続してみる
+  戻値: {IPアドレス: 接続できたポート}
+  """
+  reachable = dict()
+  pending = dict()
+  fds_of = dict()
+  poller = select.poll()
+  for ipaddr, port in targets:
+    if ipaddr in reachable: continue
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    err = sock.connect_ex((ipaddr, port))
+    if err == 0:
+      reachable[ipaddr] = port
+      sock.close()
+    elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+      pending[sock.fileno()] = (sock, ipaddr, port)
+      fds_of.setdefault(ipaddr, list()).append(sock.fileno())
+      poller.register(sock, _done_events)
+    else:
+      sock.close()
+
+  limit = time.time() + timeout
+  while pending:
+    remaining = limit - time.time()
+    if remaining <= 0: break
+    for fd, event in poller.poll(remaining * 1000):
+      # 同じ機器の他のポートに接続できたので閉じたもの
+      if fd not in pending: continue
+      sock, ipaddr, port = pending.pop(fd)
+      poller.unregister(fd)
+      ok = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+      sock.close()
+      if not ok or ipaddr in reachable: continue
+      reachable[ipaddr] = port
+      # 同じ機器の他のポートは待たない
+      for other in fds_of[ipaddr]:
+        if other not in pending: continue
+        poller.unregister(other)
+        pending.pop(other)[0].close()
+  # タイムアウトしたもの
+  for sock, ipaddr, port in pending.values():
+    sock.close()
+  return reachable
+
+def probe(targets, timeout=3, batch=None):
+  """ 機器ごとに管理ポートのいずれかに接続できるか確認
+  targets: (IPアドレス, ポートのタプル) のリスト
+  batch: 同時に接続する数 (デフォルトはファイルディスクリプタの上限まで)
+  戻値: {IPアドレス: 接続できたポート} (到達できない機器は含まない)
+  """
+  pairs = [(ipaddr, port) for ipaddr, ports in targets for port in ports]
+  batch = batch or max_batch()
+  reachable = dict()
+  for i in range(0, len(pairs), batch):
+    reachable.update(_probe_batch(pairs[i:i + batch], timeout))
+  return reachable
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+""" 機器ごとのセッション処理のプロファイル
+
+- run_sess()を機器ごとにcProfileで計測して、セッションのクラスごとに集計
+- dump()で出力するファイル (クラスごと)
+    <クラス名>.pstats     pstats形式 (python -m pstats で表示)
+    <クラス名>.collapsed  flamegraph.pl用のcollapsed stack形式 (呼び出し元のグラフから按分した近似)
+    <クラス名>.alloc.txt  メモリ割り当ての増加量の上位 (tracemallocが使える場合のみ)
+- tracemallocはプロセス全体を計測するので、並列実行中は他の機器の割り当ても含まれる
+
+ >>> profiler = SessProfiler('./profile', key=lambda ipaddr: 'TelnetSess')
+ >>> run = profiler.wrap(run_sess)
+ >>> run(ipaddr, logger, new_acl, dump_telnet)
+ >>> profiler.dump()
+"""
+
+import os
+import pstats
+import cProfile
+import threading
+from os.path import join, basename, exists
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+class SessProfiler(object):
+  """ 機器ごとのプロファイルをkey(IPアドレス)で求めたクラス名ごとに集計
+  alloc: Trueの場合はtracemallocでメモリ割り当ても計測
+  """
+  def __init__(self, outdir, key, alloc=False, top=30, frames=10):
+    self.outdir = outdir
+    self.key = key
+    self.alloc = alloc and tracemalloc is not None
+    self.top = top
+    self.lock = threading.Lock()
+    self.stats = dict()
+    self.allocs = dict()
+    if self.alloc and not tracemalloc.is_tracing():
+      tracemalloc.start(frames)
+
+  def wrap(self, func):
+    """ func(ipaddr, ...)をプロファイルしながら実行する関数を返す
+    """
+    def profiled(ipaddr, *args, **kw):
+      before = self.alloc and tracemalloc.take_snapshot() or None
+      prof = cProfile.Profile()
+      try:
+        return prof.runcall(func, ipaddr, *args, **kw)
+      finally:
+        name = self.key(ipaddr)
+        after = self.alloc and tracemalloc.take_snapshot() or None
+        with self.lock:
+          if name in self.stats:
+            self.stats[name].add(prof)
+          else:
+            self.stats[name] = pstats.Stats(prof)
+          if after:
+            totals = self.allocs.setdefault(name, dict())
+            for diff in after.compare_to(before, 'lineno'):
+              if diff.size_diff <= 0: continue
+              line = str(diff.traceback)
+              totals[line] = totals.get(line, 0) + diff.size_diff
+    return profiled
+
+  def dump(self):
+    """ クラスごとにpstats、collapsed stack、メモリ割り当ての上位を出力
+    """
+    if not exists(self.outdir): os.makedirs(self.outdir)
+    with self.lock:
+      for name, stats in self.stats.items():
+        stats.dump_stats(join(self.outdir, name + '.pstats'))
+        with open(join(self.outdir, name + '.collapsed'), 'w') as f:
+          for stack, usec in sorted(collapse_stats(stats).items()):
+            f.write("%s %d\n" % (stack, usec, ))
+      for name, totals in self.allocs.items():
+        with open(join(self.outdir, name + '.alloc.txt'), 'w') as f:
+          for line, size in sorted(totals.items(), key=lambda x: -x[1])[:self.top]:
+            f.write("%10.1f KiB  %s\n" % (size / 1024.0, line, ))
+
+
+def _label(func):
+  filename, lineno, funcname = func
+  return ("%s:%d(%s)" % (basename(filename), lineno, funcname)).replace(';', ':')
+
+def collapse_stats(stats, max_depth=64, min_usec=1):
+  """ pstatsの呼び出し元のグラフからcollapsed stack {'a;b;c': マイクロ秒} を求める
+  関数ごとの自己時間を、呼び出し元ごとの累積時間の比で按分してルートまでたどる
+  """
+  graph = stats.stats
+  collapsed = dict()
+
+  def walk(func, usec, path):
+    callers = graph.get(func, (0, 0, 0, 0, {}))[4]
+    candidates = [(caller, edge) for caller, edge in callers.items() if caller not in path]
+    if not candidates or len(path) >= max_depth:
+      stack = ';'.join([_label(f) for f in reversed(path)])
+      collapsed[stack] = collapsed.get(stack, 0) + usec
+      return
+    total = sum([edge[3] for caller, edge in candidates])
+    for caller, edge in candidates:
+      share = usec * edge[3] / float(total) if total else usec / float(len(candidates))
+      if share < min_usec: continue
+      walk(caller, share, path + (caller, ))
+
+  for func, (cc, nc, tt, ct, callers) in graph.items():
+    if tt * 1e6 >= min_usec:
+      walk(func, tt * 1e6, (func, ))
+  return dict([(stack, int(usec)) for stack, usec in collapsed.items() if int(usec)])
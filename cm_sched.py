@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+""" 機器ごとの所要時間の履歴を使った処理順の決定
+
+- 所要時間が長いと見込まれる機器から順に処理する (Longest Job First)
+- 履歴がない機器は、同じ機種の履歴からACLエントリ数あたりの所要時間を求めて見積もる
+"""
+
+import os
+import json
+import threading
+
+class DurationHistory(object):
+  """ 機器ごとの所要時間の履歴 (JSONファイルに保存)
+  { ipaddr: {'model': 機種, 'acl_size': ACLエントリ数, 'duration': 所要時間(秒)}, ... }
+  """
+  def __init__(self, path, alpha=0.5):
+    self.path = path
+    # 所要時間の指数移動平均の重み
+    self.alpha = alpha
+    self.lock = threading.Lock()
+    self.hist = dict()
+    if os.access(self.path, os.R_OK):
+      with open(self.path) as f:
+        self.hist = json.load(f)
+
+  def observe(self, ipaddr, model, acl_size, duration):
+    """ 完了した機器の所要時間を記録
+    """
+    with self.lock:
+      h = self.hist.get(ipaddr)
+      if h and h.get('model') == model:
+        duration = self.alpha * duration + (1 - self.alpha) * h['duration']
+      self.hist[ipaddr] = dict(model=model, acl_size=acl_size, duration=duration)
+
+  def _rates(self):
+    """ 機種ごと、および全体のACLエントリ1件あたりの所要時間
+    """
+    totals = dict()
+    for h in self.hist.values():
+      for k in (h['model'], None):
+        d, n = totals.get(k, (0.0, 0))
+        totals[k] = (d + h['duration'], n + h['acl_size'] + 1)
+    return dict((k, d / n) for k, (d, n) in totals.items())
+
+  def estimate(self, ipaddr, model=None, acl_size=0, rates=None):
+    """ 機器の所要時間を見積もる
+    """
+    if ipaddr in self.hist:
+      return self.hist[ipaddr]['duration']
+    if rates is None:
+      rates = self._rates()
+    rate = rates.get(model, rates.get(None, 0.0))
+    return rate * (acl_size + 1)
+
+  def order(self, ipaddrs, model_of=lambda ipaddr: None, acl_size=0):
+    """ 見積もった所要時間の長い順に並べたipaddrのリストを返す
+    (見積もりが同じ場合は元の順序)
+    """
+    with self.lock:
+      rates = self._rates()
+      est = dict((ipaddr, self.estimate(ipaddr, model_of(ipaddr), acl_size, rates)) for ipaddr in ipaddrs)
+    return sorted(ipaddrs, key=lambda ipaddr: -est[ipaddr])
+
+  def save(self):
+    """ 履歴をファイルに保存 (一時ファイルに書いてから置き換える)
+    """
+    with self.lock:
+      tmp = self.path + '.tmp'
+      with open(tmp, 'w') as f:
+        json.dump(self.hist, f, indent=1, sort_keys=True)
+      os.rename(tmp, self.path)
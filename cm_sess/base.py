@@ -1,12 +1,108 @@
 # -*- coding: utf-8 -*-
 
 import abc
+import time
+import random
 
 class SessBase:
   """ リモート接続セッションのベースクラス
   """
   __metaclass__ = abc.ABCMeta
+
+  # 機器ごとのデッドライン (cm_sess.deadline.Deadline)
+  deadline = None
+
+  # 機器ごとに応答時間から学習したタイムアウト (cm_sess.rto.RtoStore)
+  rto_store = None
+
+  # 更新後のACLの確認方法
+  # 'full': 常に機器から再取得
+  # 'sampled': verify_ratioの割合の機器と、コマンドがエラーになった機器だけ再取得
+  # 'optimistic': コマンドがエラーになった機器だけ再取得
+  # 再取得しない場合は、コマンドが成功したものとして組み立てたACLを返す
+  verify_policy = 'full'
+  verify_ratio = 0.1
+
+  # transaction()でまとめて変更できる設定の種類
+  # 種類ごとに get_<種類>(**kw) と update_<種類>(diff_dict, **kw) を実装する
+  change_kinds = ('snmp_acl', )
   
+  def get_ipaddr(self):
+    """ 接続先機器のIPアドレス
+    """
+    return (getattr(self, 'device', None) or self.server).ipaddr
+
+  def get_timeout(self, cap, kind=None):
+    """ 呼び出しごとのタイムアウト
+    kind: 呼び出しの種類 (telnet, rpc, http) を指定するとrto_storeで学習したタイムアウトを使う
+          学習するのはプロンプトや1エントリの変更など応答時間がほぼ一定の呼び出しだけ
+          ACLの取得、ロード、保存など応答時間がサイズや機器の状態で変わる呼び出しはNoneのまま(capを使う)
+    デッドラインが設定されていれば残り時間で制限
+    """
+    if kind and self.rto_store is not None:
+      cap = self.rto_store.get(self.get_ipaddr(), kind).timeout(cap)
+    if self.deadline is None: return cap
+    return self.deadline.timeout(cap)
+
+  def timed_call(self, kind, timeout_errors, func, *args, **kw):
+    """ func(*args, **kw)の応答時間をrto_storeに反映して戻値を返す
+    timeout_errors: タイムアウトを示す例外クラスのタプル (次のタイムアウトを延ばす)
+    """
+    if not kind or self.rto_store is None: return func(*args, **kw)
+    estimator = self.rto_store.get(self.get_ipaddr(), kind)
+    started = time.time()
+    try:
+      result = func(*args, **kw)
+    except timeout_errors:
+      estimator.backoff()
+      raise
+    estimator.observe(time.time() - started)
+    return result
+
+  def verify_snmp_acl(self, expected_acl, cmd_error=False, **kw):
+    """ update_snmp_acl()の戻値: verify_policyに応じて再取得したACLかexpected_aclを返す
+    kwはget_snmp_acl()に渡す
+    """
+    if self.verify_policy == 'full' or cmd_error or \
+       (self.verify_policy == 'sampled' and random.random() < self.verify_ratio):
+      return self.get_snmp_acl(**kw)
+    return sorted(expected_acl)
+
+  def transaction(self):
+    """ 複数の設定変更を1セッションでまとめて実行するSessTransactionを返す
+    """
+    return SessTransaction(self)
+
+  def rollback_config(self, applied):
+    """ transaction()で適用した変更を元に戻す
+    applied: 適用した順の (種類, diff_dict) のリスト
+    デフォルトは逆順に逆の差分を適用する (candidateを持たない機種)
+    """
+    for kind, diff_dict in reversed(applied):
+      getattr(self, 'update_' + kind)(dict([('add', diff_dict['del']), ('del', diff_dict['add']), ]))
+
+  def restore_snmp_acl(self, snapshot_acl, applied_acl=None):
+    """ 変更前に記録したACL(snapshot_acl)に戻す (cm_snapshot)
+    applied_acl: 機器に適用済のACL (指定した場合は機器から再取得せずに差分を求める)
+    戻値: update_snmp_acl()の戻値
+    """
+    if applied_acl is None:
+      current_acl = self.get_snmp_acl()
+    else:
+      current_acl = self.last_acl = sorted(applied_acl)
+    return self.update_snmp_acl(dict([('add', list(set(snapshot_acl) - set(current_acl))), 
+                                      ('del', list(set(current_acl) - set(snapshot_acl))), ]), prompt=False)
+
+  def pending_session(self):
+    """ 変更後に確認待ちになっているセッションの名前 (なければNone)
+    """
+    return None
+
+  def resume_session(self, name):
+    """ 前回の実行で確認待ちのまま中断したセッションnameを引き継ぐ (save_exit_config()で確定)
+    """
+    return
+
   def write_log(self, logger, level, msg):
     """ APIを判別できるようにクラス名をつけてmsgをログ出力
     """ 
@@ -31,3 +127,62 @@ class SessBase:
   @abc.abstractmethod
   def close(self, **kw):
     return
+
+
+class SessTransaction(object):
+  """ 複数の設定変更を1セッションでまとめて実行する
+  コンフィグモードへの移行、確認、保存(save_exit_config())は1回だけ
+
+  >>> txn = sess.transaction()
+  >>> txn.add('snmp_acl', new_acl)
+  >>> diffs = txn.commit()
+
+  確認で一致しない変更があった場合や途中で失敗した場合は、適用済の変更を
+  sess.rollback_config()で元に戻して例外を送出する (保存はしない)
+  """
+  def __init__(self, sess):
+    self.sess = sess
+    self.changes = list()
+
+  def add(self, kind, desired):
+    """ 変更後の設定(リスト)を追加
+    """
+    if kind not in self.sess.change_kinds:
+      raise ValueError("%s: unsupported change: %s" % (self.sess.__class__.__name__, kind, ))
+    self.changes.append((kind, desired))
+
+  def commit(self):
+    """ 差分を適用、確認して保存
+    戻値: {種類: diff_dict} (差分がなかった種類は含まない)
+    """
+    sess = self.sess
+    diffs = list()
+    for kind, desired in self.changes:
+      current = getattr(sess, 'get_' + kind)()
+      diff_dict = dict([('add', list(set(desired) - set(current))), 
+                        ('del', list(set(current) - set(desired))), ])
+      if filter(len, diff_dict.values()):
+        diffs.append((kind, desired, diff_dict))
+    if not diffs: return dict()
+
+    applied = list()
+    verify_policy = sess.verify_policy
+    try:
+      # 適用中は変更ごとの再取得をせずに、最後にまとめて確認する
+      sess.verify_policy = 'optimistic'
+      for kind, desired, diff_dict in diffs:
+        getattr(sess, 'update_' + kind)(diff_dict, prompt=False)
+        applied.append((kind, diff_dict))
+      sess.verify_policy = verify_policy
+      for kind, desired, diff_dict in diffs:
+        current = getattr(sess, 'get_' + kind)(set_last_acl=False)
+        if set(current) != set(desired):
+          raise RuntimeError("%s: %s: verification failed." % (sess.__class__.__name__, kind, ))
+    except Exception:
+      sess.verify_policy = verify_policy
+      if applied:
+        sess.rollback_config(applied)
+      raise
+
+    sess.save_exit_config(prompt=False)
+    return dict([(kind, diff_dict) for kind, desired, diff_dict in diffs])
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+""" 機器ごとの処理時間の上限(デッドライン)
+"""
+
+import time
+
+class DeadlineExceeded(Exception):
+  def __init__(self, value):
+    self.value = value
+  def __str__(self):
+    return self.value
+
+class Deadline(object):
+  """ 機器ごとの処理全体の持ち時間
+  各呼び出しのタイムアウトは残り時間で上限を制限する
+  """
+  def __init__(self, budget):
+    self.budget = budget
+    self.expires = time.time() + budget
+    self.suspended = False
+
+  def remaining(self):
+    return self.expires - time.time()
+
+  def expired(self):
+    return not self.suspended and self.remaining() <= 0
+
+  def check(self, what=''):
+    """ 期限切れの場合は DeadlineExceeded
+    """
+    if self.expired():
+      raise DeadlineExceeded("deadline (%ds) exceeded%s" % (self.budget, what and ": " + what or "", ))
+
+  def timeout(self, cap):
+    """ capと残り時間の短いほうを返す
+    """
+    if self.suspended: return cap
+    self.check()
+    return min(cap, self.remaining())
+
+  def suspend(self):
+    """ 設定変更を開始したら途中で中断しないように、以降は各呼び出しのタイムアウトのみ適用
+    """
+    self.suspended = True
@@ -1,19 +1,26 @@
 # -*- coding: utf-8 -*-
 
 import re
+import os
+import time
 import logging
 import urllib, urllib2
+import socket
 from contextlib import closing
 import json
 import traceback
 from ipaddr import IPv4Network, IPv4Address
 
 from base import SessBase
+from json_stream import JsonStream, DESCEND, DECODE, SKIP
 
 class EapiHttpSess(SessBase):
   """eapiセッション用クラス
   """
-  def __init__(self, server, user_login, pass_login, logger_name, http_port=80, rpc_timeout=8):
+  acl_name = 'SNMP-ACCESS'
+
+  def __init__(self, server, user_login, pass_login, logger_name, http_port=80, rpc_timeout=8, 
+               config_session=True, commit_timer='00:10:00'):
     self.server = server
     self.base_url = 'http://%s:%s' % (self.server.ipaddr, http_port)
     self.api_url = self.base_url + '/command-api'
@@ -24,8 +31,15 @@ class EapiHttpSess(SessBase):
     self.rpc_timeout = rpc_timeout
     self.req_id = 0
     self.closed = True
-    self.acl_name = 'SNMP-ACCESS'
     self.last_acl = list()
+    # configure sessionで変更する場合はTrue (Falseの場合はrunning-configを直接変更)
+    self.config_session = config_session
+    # コミットの確認期限 (hh:mm:ss): 期限までにsave_exit_config()で確認しなければ機器が元に戻す
+    # Noneの場合は即時コミット (元に戻す場合はACLを再投入)
+    self.commit_timer = commit_timer
+    self.session_name = None
+    # commit timerで確認待ちのセッションがある場合はTrue
+    self.commit_pending = False
 
   def get_api_req(self, cmds):
     """ CLIコマンドのリストをAPIに渡して取得するリクエストを返す
@@ -40,6 +54,13 @@ class EapiHttpSess(SessBase):
                 ])
     return urllib2.Request(self.api_url, json.dumps(data), {'content-type': 'application/json', })
 
+  def urlopen(self, cmds, kind='http'):
+    """ CLIコマンドのリストをAPIに送信してレスポンスを返す
+    kind: 保存などの応答を待つ場合はNone (rpc_timeoutを使う)
+    """
+    return self.timed_call(kind, (socket.timeout, ), 
+                           urllib2.urlopen, self.get_api_req(cmds), timeout=self.get_timeout(self.rpc_timeout, kind))
+
   def check_http_error(self, http_res, err_log):
     """ urlopen()の戻値でエラーをチェック
     """ 
@@ -91,19 +112,35 @@ class EapiHttpSess(SessBase):
           pass
       raise RuntimeError("%s: ACL entry in unknown format: %s" % (self.server.ipaddr, e, ))
 
+    def select(path):
+      """ レスポンスのうち、idとerror、aclListの要素だけをデコードする
+      {"jsonrpc": "2.0", "result": [{}, {"aclList": [{..}, ..]}], "id": ..}
+      """
+      if path in ((), ('result', )) or (len(path) == 2 and path[0] == 'result'): return DESCEND
+      if len(path) == 3 and path[0] == 'result' and path[2] == 'aclList': return DESCEND
+      if len(path) == 4 and path[0] == 'result' and path[2] == 'aclList': return DECODE
+      if path in (('id', ), ('error', )): return DECODE
+      return SKIP
+
     set_last_acl = kw.get('set_last_acl', True)
     acl = list()
     cmds = ['enable', 'show ip access-lists ' + self.acl_name, ]
-    # APIからのレスポンスを処理
-    with closing(urllib2.urlopen(self.get_api_req(cmds), timeout=self.rpc_timeout)) as res:
+    # APIからのレスポンスを処理 (応答時間がACLのサイズで変わるので固定のタイムアウト)
+    with closing(self.urlopen(cmds, kind=None)) as res:
       self.check_http_error(res, "get_snmp_acl() returned an HTTP error.")
-      data = json.loads(res.read())
+      # レスポンス全体は読み込まずに、対象のACLだけを残す
+      data = dict()
+      acls = list()
+      for path, value in JsonStream(res).scan(select):
+        if len(path) == 4:
+          # warnings: "Model 'AclList' is not a public model and is subject to change!"
+          # (将来データ構造が変更される可能性あり)
+          if value.get('name') == self.acl_name and value.get('standard') is True: acls.append(value)
+        else:
+          data[path[0]] = value
       self.check_api_error(data.get('error'), "get_snmp_acl() returned an API error.")
-
-      # warnings: "Model 'AclList' is not a public model and is subject to change!"
-      # (将来データ構造が変更される可能性あり)
       assert data['id'] == self.req_id
-      acls = filter(lambda a: a['name'] == self.acl_name and a['standard'] is True, data['result'][1]['aclList'])
+
       if len(acls) == 1:
         for e in acls[0]['sequence']:
           s = get_acl_entry(e)
@@ -125,35 +162,90 @@ class EapiHttpSess(SessBase):
         return False
 
     # コマンドリストを作成
-    cmds = ['enable', 'configure', 'ip access-list standard ' + self.acl_name, ]
+    if self.config_session:
+      # configure sessionに変更を用意して1リクエストでコミット (途中でエラーになればrunningは変更されない)
+      self.session_name = "cm-%s-%d" % (time.strftime('%Y%m%d%H%M%S'), os.getpid(), )
+      cmds = ['enable', 'configure session ' + self.session_name, 'ip access-list standard ' + self.acl_name, ]
+    else:
+      cmds = ['enable', 'configure', 'ip access-list standard ' + self.acl_name, ]
     for n in acl_diff_dict['del']:
       cmds.append('no permit ' + n.with_prefixlen)
     for n in acl_diff_dict['add']:
       cmds.append('permit ' + n.with_prefixlen)
 
-    cmds.append('end')
+    if not self.config_session:
+      cmds.append('end')
+    elif self.commit_timer:
+      cmds.append('commit timer ' + self.commit_timer)
+    else:
+      cmds.append('commit')
 
     # APIからのレスポンスを処理
-    with closing(urllib2.urlopen(self.get_api_req(cmds), timeout=self.rpc_timeout)) as res:
-      self.check_http_error(res, "update_snmp_acl() returned an HTTP error.")
-      data = json.loads(res.read())
-      self.check_api_error(data.get('error'), "update_snmp_acl() returned an API error.")
-      assert data['id'] == self.req_id
+    try:
+      with closing(self.urlopen(cmds, kind=None)) as res:
+        self.check_http_error(res, "update_snmp_acl() returned an HTTP error.")
+        data = json.loads(res.read())
+        self.check_api_error(data.get('error'), "update_snmp_acl() returned an API error.")
+        assert data['id'] == self.req_id
 
-      if len(data['result']) != len(cmds) or filter(len, data['result']):
-        # 正常に更新されている場合は、コマンドリスト内のコマンドと同数の空の辞書になっている
-        self.write_log(self.logger, 'debug', data['result'])
-        raise RuntimeError("%s: failed to update ACL." % (self.server.ipaddr, ))
+        if len(data['result']) != len(cmds) or filter(len, data['result']):
+          # 正常に更新されている場合は、コマンドリスト内のコマンドと同数の空の辞書になっている
+          self.write_log(self.logger, 'debug', data['result'])
+          raise RuntimeError("%s: failed to update ACL." % (self.server.ipaddr, ))
+    except Exception:
+      if self.config_session:
+        # コミットされていないセッションを破棄 (破棄に失敗しても元の例外を送出)
+        try:
+          self.abort_session()
+        except Exception:
+          self.write_log(self.logger, 'debug', traceback.format_exc())
+      raise
+    self.commit_pending = bool(self.config_session and self.commit_timer)
       
-    # 更新後のACLを取得して返す
-    return self.get_snmp_acl(set_last_acl=False)
+    # 更新後のACLを返す
+    expected_acl = set(self.last_acl) - set(acl_diff_dict['del']) | set(acl_diff_dict['add'])
+    return self.verify_snmp_acl(expected_acl, set_last_acl=False)
+
+  def abort_session(self):
+    """ configure sessionを破棄 (commit timerで確認待ちの場合はコミット前の設定に戻る)
+    """
+    with closing(self.urlopen(['enable', 'configure session %s abort' % (self.session_name, ), ])) as res:
+      self.check_http_error(res, "セッションの破棄リクエストでHTTPエラーが発生しました.")
+      data = json.loads(res.read())
+      self.check_api_error(data.get('error'), "abort_session() returned an API error.")
+    self.commit_pending = False
+    self.write_log(self.logger, 'debug', "%s: セッション%sを破棄しました." % (self.server.ipaddr, self.session_name, ))
+
+  def pending_session(self):
+    """ commit timerで確認待ちのconfigure sessionの名前
+    """
+    return self.commit_pending and self.session_name or None
+
+  def resume_session(self, name):
+    """ 前回の実行で確認待ちのconfigure sessionをsave_exit_config()で確定する
+    """
+    self.session_name = name
+    self.commit_pending = True
+
+  def rollback_config(self, applied):
+    """ transaction()で適用した変更を元に戻す
+    commit timerで確認待ちの場合はセッションの破棄のみ
+    """
+    if self.commit_pending:
+      self.abort_session()
+      return
+    SessBase.rollback_config(self, applied)
 
   def save_exit_config(self, **kw):
     """ 保存
     """
     if kw.get('prompt', False) and not re.match('\s*(y|yes|)\s*$', raw_input("保存しますか? ").rstrip(), re.I): 
-      # ロールバック処理はできないので一旦削除して元のACLに戻す
       self.write_log(self.logger, 'info', "%s: 元のACLに戻します." % (self.server.ipaddr, ))        
+      if self.commit_pending:
+        # 確認待ちのセッションを破棄
+        self.abort_session()
+        return
+      # ロールバック処理はできないので一旦削除して元のACLに戻す
       cmds = ['enable', 
               'configure', 
               'no ip access-list standard ' + self.acl_name, 
@@ -164,12 +256,20 @@ class EapiHttpSess(SessBase):
       cmds.append('end')
 
       # APIからのレスポンスを処理
-      with closing(urllib2.urlopen(self.get_api_req(cmds), timeout=self.rpc_timeout)) as res:
+      with closing(self.urlopen(cmds, kind=None)) as res:
         self.check_http_error(res, "ACLの更新リクエストでHTTPエラーが発生しました.")
 
+    cmds = ['enable', 'write memory', ]
+    if self.commit_pending:
+      # 確認待ちのセッションのコミットを確定してから保存
+      cmds.insert(1, 'configure session %s commit' % (self.session_name, ))
     # write memory をリクエスト
-    with closing(urllib2.urlopen(self.get_api_req(['enable', 'write memory',]), timeout=self.rpc_timeout)) as res:
+    with closing(self.urlopen(cmds, kind=None)) as res:
       self.check_http_error(res, "コンフィグ保存リクエストでHTTPエラーが発生しました.")
+      if self.commit_pending:
+        data = json.loads(res.read())
+        self.check_api_error(data.get('error'), "save_exit_config() returned an API error.")
+        self.commit_pending = False
       self.write_log(self.logger, 'debug', "%s: コンフィグ保存しました." % (self.server.ipaddr, ))
 
   def close(self):
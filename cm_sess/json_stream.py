@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+""" レスポンスを読みながらJSONを走査して、必要な値だけを取り出す
+
+- 全体をjson.loads()せずに、selectで指定したパスの値だけをデコードして返す
+- バッファに保持するのは読み込み途中の値1つ分だけなので、
+  大きな配列の要素を1件ずつ処理すればメモリ使用量は全体のサイズによらない
+"""
+
+import json
+
+# selectの戻値
+DESCEND = 'descend'   # オブジェクト/配列の中を走査
+DECODE = 'decode'     # 値をデコードして返す
+SKIP = 'skip'         # 読み捨てる
+
+_whitespace = ' \t\r\n'
+
+class JsonStream(object):
+  """ ファイルオブジェクトから読みながらJSONを走査
+  """
+  def __init__(self, fp, chunk_size=65536):
+    self.fp = fp
+    self.chunk_size = chunk_size
+    self.buf = ''
+    self.pos = 0
+    self.eof = False
+    self.decoder = json.JSONDecoder()
+
+  def _fill(self, size=None):
+    """ 読み込み済の部分を捨ててから続きを読み込む
+    """
+    chunk = self.fp.read(size or self.chunk_size)
+    if not chunk:
+      self.eof = True
+      return
+    self.buf = self.buf[self.pos:] + chunk
+    self.pos = 0
+
+  def _peek(self):
+    """ 空白を読み飛ばして次の文字を返す (終端の場合は'')
+    """
+    while True:
+      while self.pos < len(self.buf) and self.buf[self.pos] in _whitespace:
+        self.pos += 1
+      if self.pos < len(self.buf) or self.eof: break
+      self._fill()
+    return self.buf[self.pos:self.pos + 1]
+
+  def _next(self, expected):
+    c = self._peek()
+    if c not in expected:
+      raise ValueError("%s: unexpected %r (expected %r)" % (self.__class__.__name__, c, expected, ))
+    self.pos += 1
+    return c
+
+  def _decode(self):
+    """ 次の値を1つデコードする (バッファの途中で終わっている場合は読み足して再試行)
+    """
+    self._peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buf, self.pos)
+        # 数値などはバッファの終端で切れている可能性があるので読み足して確認
+        if end < len(self.buf) or self.eof:
+          self.pos = end
+          return value
+      except ValueError:
+        if self.eof: raise
+      # 再試行の回数を抑えるために読み足す量を倍々にする
+      self._fill(max(self.chunk_size, len(self.buf) - self.pos))
+
+  def scan(self, select, path=()):
+    """ selectに(パス)を渡して、DECODEを返したパスの (パス, 値) を順に返す
+    パスはオブジェクトのキーと配列のインデックスのタプル
+    """
+    action = select(path)
+    c = self._peek()
+    if action == DESCEND and c == '{':
+      self.pos += 1
+      if self._peek() == '}':
+        self.pos += 1
+        return
+      while True:
+        key = self._decode()
+        self._next(':')
+        for item in self.scan(select, path + (key, )):
+          yield item
+        if self._next(',}') == '}': break
+    elif action == DESCEND and c == '[':
+      self.pos += 1
+      if self._peek() == ']':
+        self.pos += 1
+        return
+      i = 0
+      while True:
+        for item in self.scan(select, path + (i, )):
+          yield item
+        i += 1
+        if self._next(',]') == ']': break
+    else:
+      value = self._decode()
+      if action == DECODE:
+        yield path, value
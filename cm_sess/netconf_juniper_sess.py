@@ -2,10 +2,13 @@
 
 import re
 import logging
-import os
-from os.path import dirname, join
+import threading
+from os.path import dirname, basename, join
+from jinja2 import Environment, FileSystemLoader, TemplateError
 from jnpr.junos import Device
 from jnpr.junos.utils.config import Config
+from jnpr.junos.exception import RpcTimeoutError
+from ncclient.operations.errors import TimeoutExpiredError
 from ipaddr import IPv4Network
 
 from cm_sess.netconf_yaml.preflist import *
@@ -15,9 +18,25 @@ from base import SessBase
 # set形式のjinja2テンプレート
 template_path = join(dirname(__file__), './netconf_templates/preflist_tmpl.set')
 
+# コンパイル済のテンプレート (プロセスごとに1回だけコンパイル)
+_template = None
+_template_lock = threading.Lock()
+
+def get_template():
+  """ コンパイル済のテンプレートを返す
+  """
+  global _template
+  with _template_lock:
+    if _template is None:
+      env = Environment(loader=FileSystemLoader(dirname(template_path)), trim_blocks=True)
+      _template = env.get_template(basename(template_path))
+  return _template
+
 class NetconfJuniperSess(SessBase):
   """netconfセッション用クラス
   """
+  acl_name = 'SNMP-ACCESS'
+
   def __init__(self, server, user_login, pass_login, logger_name, netconf_port=830, rpc_timeout=20):
     self.server = server
     self.user_login = user_login
@@ -26,8 +45,21 @@ class NetconfJuniperSess(SessBase):
     self.netconf_port = netconf_port
     self.rpc_timeout = rpc_timeout
     self.closed = True
-    self.acl_name = 'SNMP-ACCESS'
     self.last_acl = list()
+    self.locked = False
+
+  def set_rpc_timeout(self, kind=None):
+    """ 次のRPCのタイムアウトを学習した応答時間とデッドラインの残り時間で制限
+    """
+    setattr(self.dev, 'timeout', self.get_timeout(self.rpc_timeout, kind))
+
+  def call_rpc(self, func, *args, **kw):
+    """ タイムアウトを設定してRPCを発行し、応答時間を学習
+    kind: コミットなどの応答を待つ場合はNone (rpc_timeoutを使う)
+    """
+    kind = kw.pop('kind', 'rpc')
+    self.set_rpc_timeout(kind)
+    return self.timed_call(kind, (RpcTimeoutError, TimeoutExpiredError, ), func, *args, **kw)
 
   def open(self):
     """サーバに接続
@@ -40,7 +72,7 @@ class NetconfJuniperSess(SessBase):
     self.dev.open(gather_facts=False)
     if self.dev.connected:
       # デフォルト30秒を更新
-      setattr(self.dev, 'timeout', self.rpc_timeout)
+      self.set_rpc_timeout()
       self.cu = Config(self.dev)
       self.closed = False
       self.write_log(self.logger, 'info', "%s (%s): 接続しました." % (self.server.ipaddr, self.server.model, ))
@@ -61,7 +93,8 @@ class NetconfJuniperSess(SessBase):
     """
     set_last_acl = kw.get('set_last_acl', True)
     acl = list()
-    for pl in PrefListTable(self.dev).get():
+    # 応答時間がACLのサイズで変わるので固定のタイムアウト
+    for pl in self.call_rpc(PrefListTable(self.dev).get, kind=None):
       if pl.name == self.acl_name:
         # prefix-list name がマッチしたらエントリを取得
         acl = map(IPv4Network, pl.entries.keys())
@@ -72,8 +105,11 @@ class NetconfJuniperSess(SessBase):
 
   def update_snmp_acl(self, acl_diff_dict, **kw):
     """ SNMPアクセスリストを更新
+    差分のエントリだけを set/delete でロードする
     """
-    if not os.access(template_path, os.R_OK):
+    try:
+      template = get_template()
+    except (IOError, TemplateError):
       self.close(error_msg="テンプレートファイルを開けません.: %s" % (template_path, ))
       raise IOError('failed!')
 
@@ -85,16 +121,31 @@ class NetconfJuniperSess(SessBase):
         self.close()
         return False
 
-    new_acl = list(set(self.last_acl) - set(acl_diff_dict['del'])) + acl_diff_dict['add']
     template_vars = dict([
             ('acl_dict', dict([
-                     (self.acl_name, [ n.with_prefixlen for n in new_acl ]), 
+                     (self.acl_name, dict([
+                              (k, [ n.with_prefixlen for n in acl_diff_dict.get(k, []) ]) for k in ('del', 'add', )
+                              ])), 
                      ])), 
             ])
-    # 新しいACLを機器にロードする
-    self.cu.lock()
-    self.cu.load(template_path=template_path, template_vars=template_vars)
-    return self.get_snmp_acl(set_last_acl=False)
+    # 差分を機器にロードする
+    self.set_rpc_timeout()
+    if not self.locked:
+      self.cu.lock()
+      self.locked = True
+    self.call_rpc(self.cu.load, template.render(**template_vars), format='set', kind=None)
+    # ロードがエラーなら例外になるので、ここではコマンドのエラーなし
+    expected_acl = set(self.last_acl) - set(acl_diff_dict['del']) | set(acl_diff_dict['add'])
+    return self.verify_snmp_acl(expected_acl, set_last_acl=False)
+
+  def rollback_config(self, applied):
+    """ transaction()で適用した変更をcandidateごと破棄する
+    """
+    self.set_rpc_timeout()
+    self.cu.rollback()
+    if self.locked:
+      self.cu.unlock()
+      self.locked = False
 
   def save_exit_config(self, **kw):
     """ コミット or ロールバック
@@ -103,6 +154,7 @@ class NetconfJuniperSess(SessBase):
       # 確認プロンプトを表示
       if not re.match('\s*(y|yes|)\s*$', raw_input("保存しますか? ").rstrip(), re.I): 
         self.write_log(self.logger, 'info', "%s: ロールバックします." % (self.server.ipaddr, ))        
+        self.set_rpc_timeout()
         self.cu.rollback()
         current_acl = self.get_snmp_acl(set_last_acl=False)
         failed = set(current_acl) != set(self.last_acl)
@@ -114,8 +166,12 @@ class NetconfJuniperSess(SessBase):
         self.close()
         return
     # コミット
+    self.set_rpc_timeout()
     self.cu.commit()
-    self.cu.unlock()
+    # 中断した実行の再開時は、ロックせずにコミットのみ実行する場合がある
+    if self.locked:
+      self.cu.unlock()
+      self.locked = False
     self.write_log(self.logger, 'debug', "%s: コミットしました." % (self.server.ipaddr, ))    
 
   def close(self, error_msg=None):
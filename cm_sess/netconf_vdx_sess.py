@@ -3,14 +3,17 @@
 import re
 import logging
 import os
+from io import BytesIO
 from time import sleep
 from os.path import dirname, join
 from ncclient import manager
 from ncclient.xml_ import *
 from ncclient.operations.rpc import RPC
+from ncclient.operations.errors import TimeoutExpiredError
 from ipaddr import IPv4Address, IPv4Network
 
 from base import SessBase
+from seq_alloc import SeqIdAllocator
 
 # Brocade固有のリソース名
 brocade_acl_urn = 'urn:brocade.com:mgmt:brocade-ip-access-list'
@@ -19,6 +22,38 @@ brocade_mgmt_urn = 'urn:brocade.com:mgmt:brocade-ras'
 # <get-config>でACLを取得するためのXPATHフィルタ
 brocade_acl_xpath_tmpl = "/ip-acl/ip/access-list/standard[name='{acl_name}']"
 
+# ACLエントリのタグ (インポート時に1回だけqualifyしておく)
+brocade_acl_seq_tag = qualify('seq', brocade_acl_urn)
+brocade_acl_field_tags = dict([(qualify(f, brocade_acl_urn), f) 
+                               for f in ('seq-id', 'action', 'src-host-any-sip', 'src-host-ip', 'src-mask', )])
+
+def parse_acl_reply(xml):
+  """ <get-config>のrpc-replyからACLエントリを取り出す
+  iterparseで<seq>ごとに処理して、処理済の要素は解放する
+  戻値: ({IPv4Network: seq-id}, [(判別できなかったエントリのフィールド, 例外), ...])
+  """
+  acl_d = dict()
+  unknown = list()
+  if isinstance(xml, unicode): xml = xml.encode('utf-8')
+  for event, eles in etree.iterparse(BytesIO(xml), events=('end', ), tag=brocade_acl_seq_tag):
+    fields = dict([(brocade_acl_field_tags[ele.tag], ele.text) for ele in eles if ele.tag in brocade_acl_field_tags])
+    try:
+      if fields['action'] != 'permit': 
+        raise RuntimeError("unable to handle %s action" % fields['action'])
+      if fields['src-host-ip'] != '0.0.0.0': 
+        raise RuntimeError("unable to handle src-host-ip %s" % fields['src-host-ip'])
+      src_mask = fields['src-mask'] if fields.get('src-mask') != '0.0.0.0' else None
+      acl_d[IPv4Network(fields['src-host-any-sip'] + (src_mask and '/' + src_mask or ''))] = int(fields['seq-id'])
+    except KeyError, e:
+      unknown.append((fields, RuntimeError("missing %s" % (e.args[0], ))))
+    except (ValueError, RuntimeError), e:
+      unknown.append((fields, e))
+    # 処理済の要素を解放
+    eles.clear()
+    while eles.getprevious() is not None:
+      del eles.getparent()[0]
+  return acl_d, unknown
+
 # ACL追加(or削除)するためのXMLテンプレート
 brocade_acl_std_xml_tmpl = """
   <config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0">
@@ -100,6 +135,8 @@ get_save_status_retry = 5
 class NetconfVdxSess(SessBase):
   """netconfセッション用クラス
   """
+  acl_name = 'MANAGEMENT-ACCESS'
+
   def __init__(self, server, user_login, pass_login, logger_name, netconf_port=830, rpc_timeout=20):
     self.server = server
     self.user_login = user_login
@@ -108,7 +145,6 @@ class NetconfVdxSess(SessBase):
     self.netconf_port = netconf_port
     self.rpc_timeout = rpc_timeout
     self.closed = True
-    self.acl_name = 'MANAGEMENT-ACCESS'
     # 辞書の値にseq-idを保持する
     self.last_acl_d = dict()
 
@@ -120,6 +156,19 @@ class NetconfVdxSess(SessBase):
       raise RuntimeError("%s: %s: %s" % (self.__class__.__name__, self.server.ipaddr, rsp.xml))
     return
 
+  def set_rpc_timeout(self, kind=None):
+    """ 次のRPCのタイムアウトを学習した応答時間とデッドラインの残り時間で制限
+    """
+    setattr(self.dev, 'timeout', self.get_timeout(self.rpc_timeout, kind))
+
+  def call_rpc(self, func, *args, **kw):
+    """ タイムアウトを設定してRPCを発行し、応答時間を学習
+    kind: 保存などの応答を待つ場合はNone (rpc_timeoutを使う)
+    """
+    kind = kw.pop('kind', 'rpc')
+    self.set_rpc_timeout(kind)
+    return self.timed_call(kind, (TimeoutExpiredError, ), func, *args, **kw)
+
   def open(self):
     """サーバに接続
     """
@@ -128,6 +177,7 @@ class NetconfVdxSess(SessBase):
             username=self.user_login, 
             password=self.pass_login, 
             hostkey_verify=False,
+            timeout=self.get_timeout(self.rpc_timeout),
             )
     if self.dev.connected:
       setattr(self.dev, 'timeout', self.rpc_timeout)
@@ -140,35 +190,21 @@ class NetconfVdxSess(SessBase):
     """ SNMPアクセスリストを取得(VDXでは管理インターフェイスのACLにしてます)
     """
     set_last_acl = kw.get('set_last_acl', True)
-    acl_d = dict()
-
-    def get_acl(eles):
-      for ele in eles.getchildren():
-        if ele.tag == qualify('action', brocade_acl_urn): action = ele.text
-        if ele.tag == qualify('seq-id', brocade_acl_urn): seq_id = int(ele.text)
-        if ele.tag == qualify('src-host-any-sip', brocade_acl_urn): src_host_any_sip = ele.text
-        if ele.tag == qualify('src-host-ip', brocade_acl_urn): src_host_ip = ele.text
-        if ele.tag == qualify('src-mask', brocade_acl_urn): src_mask = ele.text if ele.text != '0.0.0.0' else None
-      if action != 'permit': 
-        raise RuntimeError("unable to handle %s action" % action)
-      if src_host_ip != '0.0.0.0': 
-        raise RuntimeError("unable to handle src-host-ip %s" % src_host_ip)
-      acl_d[IPv4Network(src_host_any_sip + (src_mask and '/' + src_mask or ''))] = seq_id
-
-    for eles in self.dev.get_config(
+
+    # 応答時間がACLのサイズで変わるので固定のタイムアウト
+    rsp = self.call_rpc(self.dev.get_config, 
           source='running', 
           filter=('xpath', brocade_acl_xpath_tmpl.format(acl_name=self.acl_name, )), 
-          ).data.iterdescendants():
-      if eles.tag == qualify('seq', brocade_acl_urn):
-        try:
-          get_acl(eles)
-        except (NameError, RuntimeError), e:
-          self.write_log(self.logger, 
-                         'warn', 
-                         "%s: ACLエントリを判別できません.: %s: %s" % (
-                               self.server.ipaddr, 
-                               [(ele.tag, ele.text) for ele in eles.getchildren()], 
-                               e.message, ), )
+          kind=None, 
+          )
+    acl_d, unknown = parse_acl_reply(rsp.xml)
+    for fields, e in unknown:
+      self.write_log(self.logger, 
+                     'warn', 
+                     "%s: ACLエントリを判別できません.: %s: %s" % (
+                           self.server.ipaddr, 
+                           sorted(fields.items()), 
+                           str(e), ), )
 
     if set_last_acl: self.last_acl_d = acl_d
     return sorted(acl_d.keys())
@@ -200,18 +236,8 @@ class NetconfVdxSess(SessBase):
       acl2add_d = acl_diff_dict['add']
       acl2del_d = acl_diff_dict['del']
 
-    def get_seq_id(seq_ids):
-      """順不動前提のACLに追加するエントリのseq-id
-      """
-      seq_ids_dec = map(lambda n: n / 10, seq_ids)
-      seq_ids_dec.sort()
-      for i in range(len(seq_ids_dec) - 1):
-        if seq_ids_dec[i] + 1 < seq_ids_dec[i + 1]:
-          return (seq_ids_dec[i] + 1) * 10
-      return (seq_ids_dec[-1] + 1) * 10
-
-    # rpc-reply受信時に更新するseq-idのリスト
-    seq_id_update = self.last_acl_d.values() 
+    # 追加するエントリのseq-idを割り当てる (削除したエントリのseq-idは再利用)
+    seq_ids = SeqIdAllocator(self.last_acl_d.values())
 
     # 削除
     my_ipaddr = IPv4Address(self.dev._session.transport.sock.getsockname()[0])
@@ -233,13 +259,13 @@ class NetconfVdxSess(SessBase):
       xml = etree.tostring(ele_conf)
 
       # ACLエントリ削除RPCを発行
-      rsp = self.dev.edit_config(target='running', config=xml)
+      rsp = self.call_rpc(self.dev.edit_config, target='running', config=xml)
       self.check_rsp_error(rsp, "%sから%sを削除できませんでした." % (self.acl_name, str(to_del), ))
-      seq_id_update.remove(self.last_acl_d[to_del])
+      seq_ids.free(self.last_acl_d[to_del])
 
     # 追加
     for to_add in acl2add_d:
-      new_seq_id = get_seq_id(seq_id_update)
+      new_seq_id = seq_ids.allocate()
       xml = brocade_acl_std_xml_tmpl.format(
                   urn = brocade_acl_urn,
                   acl_name = self.acl_name, 
@@ -248,12 +274,27 @@ class NetconfVdxSess(SessBase):
                   network_mask = str(to_add.hostmask),)
 
       # ACLエントリ追加RPCを発行
-      rsp = self.dev.edit_config(target='running', config=xml)
-      self.check_rsp_error(rsp, "%sに%sを追加できませんでした." % (self.acl_name, str(to_del), ))
-      seq_id_update.append(new_seq_id)
+      rsp = self.call_rpc(self.dev.edit_config, target='running', config=xml)
+      self.check_rsp_error(rsp, "%sに%sを追加できませんでした." % (self.acl_name, str(to_add), ))
+
+    # 更新後のACLを返す (RPCのエラーは例外になる)
+    expected_acl = set(self.last_acl_d.keys()) - set(acl2del_d) | set(acl2add_d)
+    return self.verify_snmp_acl(expected_acl, set_last_acl=False)
 
-    # 更新後のACLをrunningから取得
-    return self.get_snmp_acl(set_last_acl=False)
+  def rollback_config(self, applied):
+    """ transaction()で適用した変更を元に戻す
+    candidateが未サポートなので、逆順にrunningから再取得したseq-idで逆の変更を適用
+    """
+    for kind, diff_dict in reversed(applied):
+      getattr(self, 'update_' + kind)(diff_dict, rollback=True)
+
+  def restore_snmp_acl(self, snapshot_acl, applied_acl=None):
+    """ 変更前に記録したACLに戻す
+    削除するエントリのseq-idが必要なので、applied_aclにかかわらずrunningから再取得する
+    """
+    current_acl = self.get_snmp_acl()
+    return self.update_snmp_acl(dict([('add', list(set(snapshot_acl) - set(current_acl))), 
+                                      ('del', list(set(current_acl) - set(snapshot_acl))), ]), prompt=False)
 
   def save_exit_config(self, **kw):
     """コミット or ロールバック
@@ -264,7 +305,7 @@ class NetconfVdxSess(SessBase):
       self.update_snmp_acl(kw.get('acl_diff_dict'), rollback=True)
 
     # candidateが未サポートなのでBrocade独自のRPCでstartupの更新処理
-    rsp = self.dev.vdx_save_config()
+    rsp = self.call_rpc(self.dev.vdx_save_config, kind=None)
     self.check_rsp_error(rsp, "startup更新リクエストでエラーが発生しました.")
 
     et = etree.fromstring(rsp.xml)
@@ -279,7 +320,7 @@ class NetconfVdxSess(SessBase):
       if rsp_status == 'completed': break
       # completedを受信するまでの所要時間10秒前後(観測)
       sleep(3)
-      rsp = self.dev.vdx_get_save_status(rsp_sess_id)
+      rsp = self.call_rpc(self.dev.vdx_get_save_status, rsp_sess_id)
       self.check_rsp_error(rsp, "startup更新ステータス取得リクエストでエラーが発生しました.")
       et = etree.fromstring(rsp.xml)
       rsp_status = et.find('./%s' % qualify('status', brocade_mgmt_urn)).text
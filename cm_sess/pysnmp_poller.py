@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+""" 多数の機器のカウンタを定期的に取得するポーラー
+
+- snmpget_counters()を機器ごとに呼ぶかわりに、1つのSNMPエンジンで全機器にGETを非同期に送信
+- OIDが多い場合は、レスポンスがtooBigにならないようにmax_oidsずつ分けて送信
+- 取得に失敗したリクエストの数を機器ごとに数える (failures、loggerを指定した場合はログにも出力)
+- 取得した値は事前に確保したNumPy配列(サンプル数 x 機器 x OID)に格納
+- 毎秒の変化量は全機器分をまとめて計算 (32/64ビットカウンタの折り返しに対応)
+
+ >>> poller = CounterPoller(snmp_comm, routers, ['1.3.6.1.2.1.31.1.1.1.6.1', '1.3.6.1.2.1.2.2.1.10.1', ])
+ >>> poller.run(interval=10, count=6)
+ >>> before = poller.rates()
+"""
+
+import time
+import numpy as np
+from pysnmp.entity.rfc3413.oneliner import cmdgen
+from pysnmp.proto import rfc1902
+
+# カウンタのビット幅ごとの折り返しのマスク
+COUNTER32_MASK = np.uint64(0xffffffff)
+COUNTER64_MASK = np.uint64(0xffffffffffffffff)
+
+class CounterPoller(object):
+  """ 機器 x OID のカウンタを一定間隔で取得
+  routers: 機器のIPアドレスのリスト
+  oids: 取得するOIDのリスト
+  depth: 保持するサンプル数 (古いものから上書き)
+  max_oids: 1回のGETで取得するOIDの数の上限
+            (デフォルトは最小のメッセージサイズ484バイトの機器でもtooBigにならない程度)
+  logger: 取得の失敗を出力するロガー (Noneの場合はfailuresに数えるだけ)
+  """
+  def __init__(self, community, routers, oids, depth=64, port=161, timeout=1, retries=1, max_oids=10, logger=None):
+    self.routers = list(routers)
+    self.oids = list(oids)
+    self.chunks = [self.oids[k:k + max_oids] for k in range(0, len(self.oids), max_oids)]
+    self.depth = depth
+    self.logger = logger
+    self.oid_index = dict([(tuple(int(n) for n in oid.split('.')), j) for j, oid in enumerate(self.oids)])
+    # カウンタの型が分かるまでは64ビットとして扱う
+    self.masks = np.empty(len(self.oids), dtype=np.uint64)
+    self.masks.fill(COUNTER64_MASK)
+    self.samples = np.zeros((depth, len(self.routers), len(self.oids)), dtype=np.uint64)
+    self.valid = np.zeros((depth, len(self.routers), len(self.oids)), dtype=bool)
+    self.times = np.empty((depth, len(self.routers)), dtype=np.float64)
+    self.times.fill(np.nan)
+    # 機器ごとの取得に失敗したリクエストの数
+    self.failures = np.zeros(len(self.routers), dtype=np.int64)
+    # 次に書き込むサンプルの位置と、書き込んだサンプル数
+    self.head = 0
+    self.count = 0
+    self.my_cmdgen = cmdgen.AsynCommandGenerator()
+    self.auth = cmdgen.CommunityData(community)
+    self.targets = [cmdgen.UdpTransportTarget((router, port), timeout=timeout, retries=retries)
+                    for router in self.routers]
+
+  def _callback(self, send_request_handle, error_indication, error_status, error_index, varbinds, cb_ctx):
+    """ レスポンスを受信したら配列に格納 (エラーの場合は無効なまま)
+    """
+    slot, i = cb_ctx
+    if error_indication or error_status:
+      self.failures[i] += 1
+      if self.logger:
+        self.logger.warn("%s: %s: %s" % (self.__class__.__name__, self.routers[i], 
+                                         error_indication or error_status.prettyPrint(), ))
+      return
+    self.times[slot, i] = time.time()
+    for name, val in varbinds:
+      j = self.oid_index.get(tuple(name))
+      if j is None: continue
+      try:
+        self.samples[slot, i, j] = int(val)
+      except (TypeError, ValueError):
+        # noSuchObjectなど
+        continue
+      self.valid[slot, i, j] = True
+      if isinstance(val, rfc1902.Counter32):
+        self.masks[j] = COUNTER32_MASK
+
+  def poll_once(self):
+    """ 全機器にOIDをmax_oidsずつ分けたGETを送信して、全てのレスポンス(またはタイムアウト)を待つ
+    """
+    slot = self.head
+    self.valid[slot] = False
+    self.times[slot] = np.nan
+    for i, target in enumerate(self.targets):
+      for oids in self.chunks:
+        self.my_cmdgen.asyncGetCmd(self.auth, target, oids, (self._callback, (slot, i)))
+    self.my_cmdgen.snmpEngine.transportDispatcher.runDispatcher()
+    self.head = (self.head + 1) % self.depth
+    self.count = min(self.count + 1, self.depth)
+
+  def run(self, interval, count, on_sample=None):
+    """ interval秒ごとにcount回取得 (取得にかかった時間で間隔がずれないように開始時刻を基準にする)
+    on_sample: 取得するたびに呼び出す関数 (引数はこのオブジェクト)
+    """
+    started = time.time()
+    for k in range(count):
+      wait = started + k * interval - time.time()
+      if wait > 0: time.sleep(wait)
+      self.poll_once()
+      if on_sample: on_sample(self)
+
+  def latest(self, back=0):
+    """ back回前に取得したサンプルの位置
+    """
+    if back >= self.count:
+      raise IndexError("%s: only %d samples." % (self.__class__.__name__, self.count, ))
+    return (self.head - 1 - back) % self.depth
+
+  def values(self, back=0):
+    """ 機器 x OID の値 (取得できなかったものはマスク)
+    """
+    slot = self.latest(back)
+    return np.ma.masked_array(self.samples[slot], mask=~self.valid[slot])
+
+  def rates(self, back=1):
+    """ 直近のサンプルとback回前のサンプルから求めた 機器 x OID の毎秒の変化量
+    どちらかを取得できなかったものはNaN
+    """
+    cur, prev = self.latest(), self.latest(back)
+    # uint64の引き算は2**64で折り返すので、ビット幅のマスクで32ビットカウンタの折り返しも補正できる
+    delta = (self.samples[cur] - self.samples[prev]) & self.masks
+    elapsed = self.times[cur] - self.times[prev]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      rate = delta.astype(np.float64) / elapsed[:, np.newaxis]
+    rate[~(self.valid[cur] & self.valid[prev])] = np.nan
+    return rate
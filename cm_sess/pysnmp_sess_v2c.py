@@ -4,6 +4,8 @@
 """
 
 from pysnmp.entity.rfc3413.oneliner import cmdgen
+from ipaddr import IPv4Network, IPv4Address
+from socket import inet_ntoa
 import re
 
 class PysnmpSessV2cError(Exception):
@@ -34,12 +36,12 @@ class PysnmpSessV2c(object):
       raise PysnmpSessV2cError("%s: %s: %s" % (self.__class__.__name__, agent, error_indication))
     else:
       if error_status:
-        raise PysnmpSessV2cError("%s: %s: %s at %s" % 
+        raise PysnmpSessV2cError("%s: %s: %s at %s" % (
             self.__class__.__name__,
             agent, 
             error_status.prettyPrint(), 
-            error_index and varbinds[int(error_index)-1][0] or '?' 
-            )
+            error_index and varbinds[int(error_index)-1][0] or '?', 
+            ))
       else:
         d = dict()
         for name, val in varbinds:
@@ -56,12 +58,12 @@ class PysnmpSessV2c(object):
       raise PysnmpSessV2cError("%s: %s: %s" % (self.__class__.__name__, agent, error_indication))
     else:
       if error_status:
-        raise PysnmpSessV2cError("%s: %s: %s at %s" % 
+        raise PysnmpSessV2cError("%s: %s: %s at %s" % (
             self.__class__.__name__, 
             agent, 
             error_status.prettyPrint(), 
-            error_index and varbind_table[-1][int(error_index)-1][0] or '?' 
-            )
+            error_index and varbind_table[-1][int(error_index)-1][0] or '?', 
+            ))
       else:
         d = dict()
         for varbind_tablerow in varbind_table:
@@ -82,12 +84,12 @@ class PysnmpSessV2c(object):
       raise PysnmpSessV2cError("%s: %s: %s" % (self.__class__.__name__, agent, error_indication))
     else:
       if error_status:
-        raise PysnmpSessV2cError("%s: %s: %s at %s" % 
+        raise PysnmpSessV2cError("%s: %s: %s at %s" % (
             self.__class__.__name__, 
             agent, 
             error_status.prettyPrint(), 
-            error_index and varbind_table[-1][int(error_index)-1][0] or '?' 
-            )
+            error_index and varbind_table[-1][int(error_index)-1][0] or '?', 
+            ))
       else:
         d = dict()
         for varbind_tablerow in varbind_table:
@@ -95,8 +97,8 @@ class PysnmpSessV2c(object):
             d[name] = val
         return d
               
-def snmpget_sysdescr(router, community):
-  sess = PysnmpSessV2c(community=community, )
+def snmpget_sysdescr(router, community, timeout=1, retries=3):
+  sess = PysnmpSessV2c(community=community, timeout=timeout, retries=retries, )
   oid = '1.3.6.1.2.1.1.1.0'
   res = sess.sync_get(router, oid)
   return str(res.values()[0])
@@ -107,6 +109,48 @@ def snmpget_counters(router, community, *oids):
   d = sess.sync_get(router, *oids)
   return dict(zip(map(str, d.keys()), map(int, d.values())))
 
+def snmpwalk_acl(router, community, mib, acl_name, maxrepetitions=25):
+  """ ACLのエントリをベンダーMIBからGETBULKで取得
+  mib: ACLのテーブルの列のOID
+    {'addr': アドレスの列, 
+     'mask': マスクの列, 
+     'wildcard': マスクがワイルドカード形式の場合はTrue, 
+     'name': ACL名の列 (テーブルに複数のACLが含まれる場合), 
+     'action': 動作の列 (permit以外のエントリを含む場合), 
+     'permit': 動作の列のpermitの値, }
+  戻値: IPv4Networkのソート済リスト (permitのエントリのみ)
+  acl_nameの行がない場合はPysnmpSessV2cError (ACL名の不一致やMIBの未実装をACLが空と区別できないため)
+  """
+  sess = PysnmpSessV2c(community=community, )
+  columns = [k for k in ('addr', 'mask', 'name', 'action', ) if mib.get(k)]
+  res = sess.sync_bulkget(router, 0, maxrepetitions, 0, *[mib[k] for k in columns])
+  # 列のOIDを除いた残り(インデックス)ごとに行をまとめる
+  rows = dict()
+  for name, val in res.items():
+    oid = tuple(name)
+    for k in columns:
+      prefix = tuple(int(n) for n in mib[k].split('.'))
+      if oid[:len(prefix)] == prefix:
+        rows.setdefault(oid[len(prefix):], dict())[k] = val
+        break
+  acl = list()
+  matched = 0
+  for index, row in rows.items():
+    if 'name' in columns and str(row.get('name')) != acl_name: continue
+    matched += 1
+    if 'action' in columns and int(row.get('action', -1)) != mib['permit']: continue
+    if 'addr' not in row or 'mask' not in row:
+      raise PysnmpSessV2cError("%s: %s: incomplete ACL row %s" % ('snmpwalk_acl', router, index, ))
+    addr = inet_ntoa(row['addr'].asOctets())
+    mask = IPv4Address(inet_ntoa(row['mask'].asOctets()))
+    if mib.get('wildcard'):
+      mask = IPv4Address(int(mask) ^ 0xffffffff)
+    acl.append(IPv4Network("%s/%s" % (addr, str(mask), )))
+  if not matched:
+    raise PysnmpSessV2cError("%s: %s: no ACL rows for %s" % ('snmpwalk_acl', router, acl_name, ))
+  acl.sort()
+  return acl
+
 if __name__ == '__main__':
   pass
 
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+""" 機器とのやりとりの記録と再生
+
+- 記録: セッションをopen()した後にrecord_sess()を呼ぶと、以降の受信データをTranscriptに記録
+-- telnet: expect()ごとに受信したデータ (before + after)
+-- eAPI: HTTPレスポンスのボディ
+-- NETCONF: <get-config>のrpc-reply
+- 再生: replay_sess()で、セッションクラスを変更せずに通信部分だけを記録したデータに差し替える
+-- telnet: pexpectのspawnのかわりのReplayChild
+-- eAPI: urllib2のハンドラReplayHandler
+-- NETCONF: ncclient/PyEZのDeviceのかわりのReplayDevice
+
+ >>> transcript = Transcript.load('./192.0.2.1.json')
+ >>> sess = agent.get_sess(None, None, logger_name)
+ >>> replay_sess(sess, transcript)
+ >>> sess.get_snmp_acl()
+"""
+
+import re
+import json
+import urllib2
+import mimetools
+from StringIO import StringIO
+from contextlib import closing
+
+class ReplayError(Exception):
+  def __init__(self, value):
+    self.value = value
+  def __str__(self):
+    return self.value
+
+
+class Transcript(object):
+  """ 1台の機器とのやりとりの記録
+  transport: 'telnet', 'eapi', 'netconf'
+  records: 受信したデータのリスト (eAPIは (リクエストのid, ボディ))
+  """
+  def __init__(self, transport, model, records=None):
+    self.transport = transport
+    self.model = model
+    self.records = records if records is not None else list()
+    self.pos = 0
+
+  def next(self):
+    """ 次に再生するデータ (最後まで再生したら先頭に戻る)
+    """
+    if not self.records:
+      raise ReplayError("%s: no records." % (self.__class__.__name__, ))
+    record = self.records[self.pos]
+    self.pos = (self.pos + 1) % len(self.records)
+    return record
+
+  def rewind(self):
+    self.pos = 0
+
+  def save(self, path):
+    with open(path, 'w') as f:
+      json.dump(dict(transport=self.transport, model=self.model, records=self.records), f)
+
+  @classmethod
+  def load(cls, path):
+    with open(path) as f:
+      d = json.load(f)
+    # 受信データはbytesのまま扱う
+    encode = lambda r: isinstance(r, unicode) and r.encode('utf-8') or r
+    records = [isinstance(r, list) and (r[0], encode(r[1])) or encode(r) for r in d['records']]
+    return cls(d['transport'], d['model'], records)
+
+
+class RecordingChild(object):
+  """ pexpectのspawnをラップして、expect()ごとに受信したデータを記録
+  """
+  def __init__(self, child, transcript):
+    self.child = child
+    self.transcript = transcript
+
+  def __getattr__(self, name):
+    return getattr(self.child, name)
+
+  def expect(self, pattern, **kw):
+    i = self.child.expect(pattern, **kw)
+    after = self.child.after
+    self.transcript.records.append(self.child.before + (isinstance(after, basestring) and after or ''))
+    return i
+
+
+class ReplayChild(object):
+  """ pexpectのspawnのかわりに、記録したデータを順に返す
+  """
+  def __init__(self, transcript):
+    self.transcript = transcript
+    self.before = ''
+    self.after = ''
+    self.logfile = None
+    self.compiled = dict()
+
+  def send(self, s):
+    return len(s)
+
+  def _compile(self, pattern):
+    # pexpectと同じく文字列はDOTALLでコンパイル (コンパイル済のパターンはそのまま使う)
+    if hasattr(pattern, 'search'): return pattern
+    if not isinstance(pattern, basestring): return None
+    if pattern not in self.compiled:
+      self.compiled[pattern] = re.compile(pattern, re.DOTALL)
+    return self.compiled[pattern]
+
+  def expect(self, pattern, timeout=None):
+    """ 次のデータで最初にマッチした位置のパターンのインデックスを返す
+    """
+    patterns = isinstance(pattern, list) and pattern or [pattern]
+    data = self.transcript.next()
+    compiled = [self._compile(p) for p in patterns]
+    matches = [(m.start(), i, m) for i, m in enumerate([c and c.search(data) for c in compiled]) if m]
+    if not matches:
+      raise ReplayError("%s: no pattern matched: %r" % (self.__class__.__name__, patterns, ))
+    start, i, m = min(matches)
+    self.before, self.after = data[:start], m.group(0)
+    return i
+
+  def close(self):
+    return
+
+
+class ReplayResponse(StringIO):
+  """ 記録したボディを返すHTTPレスポンス
+  """
+  def __init__(self, body, url=''):
+    StringIO.__init__(self, body)
+    self.url = url
+    self.code = 200
+    self.msg = 'OK'
+    self.headers = mimetools.Message(StringIO(''))
+
+  def info(self):
+    return self.headers
+
+  def getcode(self):
+    return self.code
+
+  def geturl(self):
+    return self.url
+
+
+class ReplayHandler(urllib2.BaseHandler):
+  """ HTTPリクエストに記録したボディを返すurllib2のハンドラ
+  レスポンスのidはリクエストのidに置き換える
+  """
+  # デフォルトのHTTPHandlerより先に呼ばれるようにする
+  handler_order = 100
+
+  def __init__(self, transcript):
+    self.transcript = transcript
+
+  def http_open(self, req):
+    req_id = json.loads(req.get_data())['id']
+    rec_id, body = self.transcript.next()
+    if rec_id != req_id:
+      # idは末尾にあるので後ろから探して置き換える
+      i = body.rfind('"id": %d' % (rec_id, ))
+      if i >= 0:
+        body = body[:i] + '"id": %d' % (req_id, ) + body[i + len('"id": %d' % (rec_id, )):]
+    return ReplayResponse(body, req.get_full_url())
+
+
+class ReplayReply(object):
+  """ ncclientのRPCReplyのかわり
+  """
+  def __init__(self, xml):
+    self.xml = xml
+    self.ok = True
+
+
+class ReplayRpc(object):
+  """ PyEZのDevice.rpcのかわり (get_configは記録した<configuration>を返す)
+  """
+  def __init__(self, transcript):
+    self.transcript = transcript
+
+  def get_config(self, *args, **kw):
+    from lxml import etree
+    return etree.fromstring(self.transcript.next())
+
+
+class ReplayDevice(object):
+  """ ncclientのManager / PyEZのDeviceのかわり
+  """
+  def __init__(self, transcript):
+    self.transcript = transcript
+    self.timeout = None
+    self.connected = True
+    self.rpc = ReplayRpc(transcript)
+
+  def get_config(self, **kw):
+    return ReplayReply(self.transcript.next())
+
+  def close(self):
+    self.connected = False
+
+  # ncclientのManager.close_session()
+  close_session = close
+
+
+def record_sess(sess, transcript):
+  """ open()したセッションの受信データをtranscriptに記録するように差し替える
+  """
+  if transcript.transport == 'telnet':
+    sess.child = RecordingChild(sess.child, transcript)
+  elif transcript.transport == 'eapi':
+    urlopen = sess.urlopen
+    def recording_urlopen(cmds, **kw):
+      with closing(urlopen(cmds, **kw)) as res:
+        body = res.read()
+      transcript.records.append((sess.req_id, body))
+      return ReplayResponse(body)
+    sess.urlopen = recording_urlopen
+  elif transcript.transport == 'netconf' and transcript.model != 'juniper':
+    # ncclient
+    get_config = sess.dev.get_config
+    def recording_get_config(**kw):
+      rsp = get_config(**kw)
+      transcript.records.append(rsp.xml)
+      return rsp
+    sess.dev.get_config = recording_get_config
+  elif transcript.transport == 'netconf':
+    # PyEZ
+    from lxml import etree
+    get_config = sess.dev.rpc.get_config
+    def recording_rpc_get_config(*args, **kw):
+      rsp = get_config(*args, **kw)
+      transcript.records.append(etree.tostring(rsp))
+      return rsp
+    sess.dev.rpc.get_config = recording_rpc_get_config
+  else:
+    raise ReplayError("unknown transport: %s" % (transcript.transport, ))
+
+def replay_sess(sess, transcript):
+  """ セッションの通信部分を記録したデータの再生に差し替える (open()は不要)
+  """
+  if transcript.transport == 'telnet':
+    sess.child = ReplayChild(transcript)
+  elif transcript.transport == 'eapi':
+    urllib2.install_opener(urllib2.build_opener(ReplayHandler(transcript)))
+  elif transcript.transport == 'netconf':
+    sess.dev = ReplayDevice(transcript)
+  else:
+    raise ReplayError("unknown transport: %s" % (transcript.transport, ))
+  sess.closed = False
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+""" 機器ごとに実測した応答時間から求めるタイムアウト
+
+- TCPの再送タイムアウト(RFC 6298)と同じく、平滑化した応答時間(SRTT)と
+  そのばらつき(RTTVAR)から RTO = SRTT + 4 * RTTVAR を求める
+- 推定値は機器と呼び出しの種類(telnet, rpc, http, snmp)ごとに保持してJSONファイルに保存
+- 十分なサンプルがない間は、各セッションクラスの固定のタイムアウトを使う
+"""
+
+import os
+import json
+import threading
+
+class RtoEstimator(object):
+  """ 応答時間からタイムアウトを推定
+  lock: 更新を排他するロック (作成したRtoStoreのロックを共有)
+  """
+  # 機器 x 呼び出しの種類ごとに作成するので、インスタンスの__dict__を持たない
+  __slots__ = ('srtt', 'rttvar', 'samples', 'lock', )
+
+  alpha = 1 / 8.0
+  beta = 1 / 4.0
+  k = 4
+  # 推定値を使いはじめるまでのサンプル数
+  min_samples = 3
+
+  def __init__(self, lock, srtt=None, rttvar=None, samples=0):
+    self.srtt = srtt
+    self.rttvar = rttvar
+    self.samples = samples
+    # 同じ機器のセッションを複数のスレッドで実行する場合があるので更新は排他
+    # (機器ごとにロックを作らずに、RtoStoreの1つのロックを参照する)
+    self.lock = lock
+
+  def observe(self, rtt):
+    """ 応答時間(秒)を反映
+    """
+    with self.lock:
+      if self.srtt is None:
+        self.srtt = rtt
+        self.rttvar = rtt / 2.0
+      else:
+        self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+        self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+      self.samples += 1
+
+  def backoff(self):
+    """ タイムアウトした場合は次のタイムアウトを倍にする
+    """
+    with self.lock:
+      if self.srtt is None: return
+      self.srtt *= 2
+      self.rttvar *= 2
+
+  def timeout(self, default, floor=1.0, ceiling=60.0):
+    """ 推定したタイムアウト (サンプルが足りない場合はdefault)
+    """
+    with self.lock:
+      if self.samples < self.min_samples: return default
+      return min(ceiling, max(floor, self.srtt + self.k * self.rttvar))
+
+
+class RtoStore(object):
+  """ 機器 x 呼び出しの種類ごとのRtoEstimator (JSONファイルに保存)
+  RtoEstimatorの更新もこのロックで排他する (save()中に更新されない)
+  """
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    self.estimators = dict()
+    if os.access(self.path, os.R_OK):
+      with open(self.path) as f:
+        for key, v in json.load(f).items():
+          self.estimators[tuple(key.split('|'))] = RtoEstimator(self.lock, **v)
+
+  def get(self, ipaddr, kind):
+    with self.lock:
+      key = (ipaddr, kind)
+      if key not in self.estimators:
+        self.estimators[key] = RtoEstimator(self.lock)
+      return self.estimators[key]
+
+  def save(self):
+    """ 一時ファイルに書いてから置き換える
+    """
+    with self.lock:
+      data = dict([('|'.join(key), dict(srtt=e.srtt, rttvar=e.rttvar, samples=e.samples))
+                   for key, e in self.estimators.items() if e.samples])
+      tmp = self.path + '.tmp'
+      with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+      os.rename(tmp, self.path)
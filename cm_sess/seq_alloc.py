@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+""" 順序番号つきACLに追加するエントリのseq-idの割り当て
+
+- seq-idはstep(10)ごとのスロットで管理し、空いているスロットの小さいほうから割り当てる
+- 空きスロットを区間(開始, 終了)のヒープで保持するので、割り当てと解放はO(log n)
+- NetconfVdxSessのほか、順序番号つきのエントリを扱うtelnetの機種でも使う
+"""
+
+import heapq
+
+class SeqIdAllocator(object):
+  """ seq-idの割り当てと解放
+  seq_ids: 使用中のseq-id
+  """
+  def __init__(self, seq_ids=(), step=10, first=1):
+    self.step = step
+    self.first = first
+    # スロットごとの使用中のseq-idの数 (stepの倍数でないseq-idは同じスロットに複数ある)
+    self.used = dict()
+    for seq_id in seq_ids:
+      slot = seq_id // step
+      self.used[slot] = self.used.get(slot, 0) + 1
+    # 空きスロットの区間 [start, end) のヒープ、最後の区間は上限なし(None)
+    self.free_slots = list()
+    start = first
+    for slot in sorted(self.used):
+      if slot < start: continue
+      if slot > start:
+        self.free_slots.append((start, slot))
+      start = slot + 1
+    self.free_slots.append((start, None))
+    heapq.heapify(self.free_slots)
+
+  def allocate(self):
+    """ 空いているスロットのうち最小のseq-idを割り当てる
+    """
+    start, end = heapq.heappop(self.free_slots)
+    if end is None or start + 1 < end:
+      heapq.heappush(self.free_slots, (start + 1, end))
+    self.used[start] = 1
+    return start * self.step
+
+  def free(self, seq_id):
+    """ 削除したエントリのseq-idを解放して、スロットの使用中のseq-idがなくなれば再利用できるようにする
+    firstより前のスロットは割り当てないので空きスロットに戻さない
+    """
+    slot = seq_id // self.step
+    if slot not in self.used: return
+    self.used[slot] -= 1
+    if self.used[slot]: return
+    del self.used[slot]
+    if slot < self.first: return
+    heapq.heappush(self.free_slots, (slot, slot + 1))
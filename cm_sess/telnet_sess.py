@@ -8,9 +8,125 @@ from ipaddr import IPv4Network
 
 from base import SessBase
 
+class TelnetCliError(Exception):
+  """ 機器がエラーを返した場合の例外 (エラーになったコマンドとメッセージ)
+  """
+  def __init__(self, command, value):
+    self.command = command
+    self.value = value
+  def __str__(self):
+    return "%s: %s" % (self.command, self.value, )
+
+class TelnetVendor(object):
+  """ 機種ごとのプロンプト、コマンド (全てのセッションで共有)
+  プロンプトはpexpectと同じくDOTALL、エラーのパターンはMULTILINEでコンパイル済
+  エラーのパターンはTelnetCliErrorのメッセージにするため行末までマッチさせる
+  (受信途中の行にマッチしないように改行を受信するまで待つ)
+  """
+  # ログインの失敗、切断など、続行できないエラー
+  fatal_pattern = re.compile(r"^\s*(% ?(Authentication failed|Bad (passwords|secrets)|Access denied|Login invalid)|"
+                             r"Login incorrect|Permission denied|Connection closed by foreign host)[^\r\n]*(?=\r?\n)", re.M)
+  # ページャ (スペースで続きを表示)
+  pager_pattern = re.compile(r"--More--[^\r\n]*|---\(more( \d+%)?\)---")
+  # 続きを表示するときにページャを消す文字
+  pager_erase = re.compile(r"^([ \x08]*\x08|\r +\r)")
+  need_priv = False
+  deact_pager = False
+  linebreak = "\n"
+  priv_prompt = None
+  # ACLのコンフィグモードに移行するコマンド (Noneの場合は移行しない)
+  config_acl_fmt = None
+  # 一括ロードに対応するファイルサーバのスキーム
+  bulk_schemes = ()
+  bulk_error_pattern = None
+  # show コマンドの出力のACLエントリ (グループ1: アドレス、グループ2: マスク)
+  acl_entry_pattern = None
+
+  def add_acl_cmd(self, acl_name, n):
+    raise NotImplementedError
+
+  def del_acl_cmd(self, acl_name, n):
+    return "no " + self.add_acl_cmd(acl_name, n)
+
+  def bulk_load_cmd(self, url):
+    raise NotImplementedError
+
+
+class JuniperTelnetVendor(TelnetVendor):
+  unpriv_prompt = re.compile(r"\r\n[-\w.]+@[-\w]+>\s*$", re.DOTALL)
+  config_prompt = re.compile(r"\r\n[-\w.]+@[-\w]+#\s*$", re.DOTALL)
+  error_pattern = re.compile(r"^\s*(syntax error|error:|unknown command)[^\r\n]*(?=\r?\n)", re.M)
+  acl_entry_pattern = re.compile(r"^\s*([\d.]+)/(\d+);\s*$")
+
+  def add_acl_cmd(self, acl_name, n):
+    return "set policy-options prefix-list %s %s" % (acl_name, n.with_prefixlen, )
+
+  def del_acl_cmd(self, acl_name, n):
+    return "delete policy-options prefix-list %s %s" % (acl_name, n.with_prefixlen, )
+
+
+class BrocadeNetironTelnetVendor(TelnetVendor):
+  need_priv = True
+  deact_pager = True
+  linebreak = "\r\n"
+  unpriv_prompt = re.compile(r"\r\ntelnet@[-\w]+>\s*$", re.DOTALL)
+  priv_prompt = re.compile(r"\r\ntelnet@[-\w]+#\s*$", re.DOTALL)
+  config_prompt = re.compile(r"\r\ntelnet@[-\w]+\(config.*\)#\s*$", re.DOTALL)
+  config_acl_fmt = "ip access-list standard %s"
+  error_pattern = re.compile(r"^\s*(Error|Invalid input|Incomplete command)[^\r\n]*(?=\r?\n)", re.M)
+  acl_entry_pattern = re.compile(r"^\s*sequence\s+\d+\s+permit\s+(?:host\s+)?([\d.]+)(?:\s+([\d.]+))?\s*$")
+  bulk_schemes = ('tftp', )
+  bulk_error_pattern = re.compile(r"(?i)\b(fail(ed|ure)?|error|timed? ?out)\b", re.M)
+
+  def add_acl_cmd(self, acl_name, n):
+    return "permit " + n.with_prefixlen
+
+  def bulk_load_cmd(self, url):
+    return "copy tftp running-config %s %s" % tuple(url.split('/', 3)[2:])
+
+
+class CiscoTelnetVendor(TelnetVendor):
+  need_priv = True
+  deact_pager = True
+  unpriv_prompt = re.compile(r"\r\n[-\w]+>\s*$", re.DOTALL)
+  priv_prompt = re.compile(r"\r\n[-\w]+#\s*$", re.DOTALL)
+  config_prompt = re.compile(r"\r\n[-\w]+\(config.*\)#\s*$", re.DOTALL)
+  config_acl_fmt = "ip access-list standard %s"
+  # '% Warning'などの警告はエラーにしない
+  error_pattern = re.compile(r"^\s*% ?(Invalid|Incomplete|Ambiguous|Unknown|Unrecognized|Error)[^\r\n]*(?=\r?\n)", re.M)
+  acl_entry_pattern = re.compile(r"^\s*\d+\s+permit\s+([\d.]+)(?:,\s+wildcard\s+bits\s+([\d.]+))?\b")
+  bulk_schemes = ('tftp', 'http', )
+  bulk_error_pattern = re.compile(r"^\s*%\s*Error", re.M)
+
+  def add_acl_cmd(self, acl_name, n):
+    return "permit " + n.with_hostmask.replace('/', ' ')
+
+  def bulk_load_cmd(self, url):
+    return "copy %s running-config" % (url, )
+
+
 class TelnetSess(SessBase):
   """telnetセッション用クラス
   """
+  # 機種ごとのプロンプト、コマンド
+  vendors = dict([
+      ('juniper', JuniperTelnetVendor()), 
+      ('brocade_netiron', BrocadeNetironTelnetVendor()), 
+      ('cisco', CiscoTelnetVendor()), 
+      ])
+  pass_prompt = re.compile(r".*Password:", re.DOTALL)
+  # 一括ロードでcopyの確認に応答するプロンプト
+  confirm_prompt = re.compile(r"\[[^\]\r\n]*\]\?\s*$", re.DOTALL)
+  # 変更するACLの名前 (SNMPでACLを取得する場合も使う)
+  acl_name = 'SNMP-ACCESS'
+
+  # ACLの変更をコンフィグの断片にして一括でロードするファイルサーバ (cm_filesrv.TftpServer, HttpFileServer)
+  file_server = None
+  # 一括でロードする変更のエントリ数の下限
+  bulk_threshold = 100
+  # 一括ロードの転送を待つタイムアウト(秒)
+  bulk_timeout = 60
+
   def __init__(self, device, pass_login, pass_enable, logger_name, 
                user_login=None, telnet_port=23, telnet_timeout=8, screen_dump=None):
     self.device = device
@@ -22,44 +138,59 @@ class TelnetSess(SessBase):
     self.telnet_port = telnet_port
     self.telnet_timeout = telnet_timeout
     self.logfile = screen_dump
-    self.need_priv = False
-    self.deact_pager = False
-    self.pass_prompt = ".*Password:"
-    self.acl_name = 'SNMP-ACCESS'
+    self.last_acl = list()
+    self.in_config = False
     self.closed = True
+    # 最後に送信したコマンド (TelnetCliErrorに含める)
+    self.last_cmd = None
+    # 最後のexpect()でプロンプトまでに受信した出力 (ページャを除いてつなげたもの)
+    self.before = ''
 
     # 機種依存の設定
-    assert self.device.model in ('juniper', 'brocade_netiron', 'cisco', )
-    if self.device.model == "juniper":
-      self.unpriv_prompt = "\r\n%s@[-\w]+>\s*$" % (self.user_login, )
-      self.config_prompt = "\r\n%s@[-\w]+#\s*$" % (self.user_login, )
-      self.add_acl_cmd = lambda n: "set policy-options prefix-list %s %s" % (self.acl_name, n.with_prefixlen, )
-      self.del_acl_cmd = lambda n: "delete policy-options prefix-list %s %s" % (self.acl_name, n.with_prefixlen, )
-      self.linebreak = "\n"
-    if self.device.model == "brocade_netiron":
-      self.need_priv = True
-      self.deact_pager = True
-      self.unpriv_prompt = "\r\ntelnet@[-\w]+>\s*$"
-      self.priv_prompt = "\r\ntelnet@[-\w]+#\s*$"
-      self.config_prompt = "\r\ntelnet@[-\w]+\(config.*\)#\s*$"
-      self.config_acl_cmd = "ip access-list standard " + self.acl_name
-      self.add_acl_cmd = lambda n: "permit " + n.with_prefixlen
-      self.del_acl_cmd = lambda n: "no " + self.add_acl_cmd(n)
-      self.linebreak = "\r\n"
-    if self.device.model == "cisco":
-      self.need_priv = True
-      self.deact_pager = True
-      self.unpriv_prompt = "\r\n[-\w]+>\s*$"
-      self.priv_prompt = "\r\n[-\w]+#\s*$"
-      self.config_prompt = "\r\n[-\w]+\(config.*\)#\s*$"
-      self.config_acl_cmd = "ip access-list standard " + self.acl_name
-      self.add_acl_cmd = lambda n: "permit " + n.with_hostmask.replace('/', ' ')
-      self.del_acl_cmd = lambda n: "no " + self.add_acl_cmd(n)
-      self.linebreak = "\n"
-
-  def sendline(self, line):
+    assert self.device.model in self.vendors
+    self.vendor = self.vendors[self.device.model]
+
+  def add_acl_cmd(self, n):
+    return self.vendor.add_acl_cmd(self.acl_name, n)
+
+  def del_acl_cmd(self, n):
+    return self.vendor.del_acl_cmd(self.acl_name, n)
+
+  def sendline(self, line, secret=False):
+    """ secret: パスワードの場合はTrue (TelnetCliErrorに含めない)
+    """
     if hasattr(self, 'child'):
-      getattr(self, 'child').send(line + self.linebreak)
+      self.last_cmd = secret and "(password)" or line
+      getattr(self, 'child').send(line + self.vendor.linebreak)
+
+  def expect(self, pattern, kind='telnet', timeout=None, check_errors=True):
+    """ 学習した応答時間とデッドラインの残り時間で制限したタイムアウトでexpect
+    kind: 保存などの応答を待つ場合はNone (timeout、指定しない場合はtelnet_timeoutを使う)
+    プロンプトを待ちながら、機種ごとのエラーとページャも同時に待つ
+    - ログインの失敗などはタイムアウトを待たずにTelnetCliErrorを送出
+    - check_errors: Trueの場合はコマンドのエラーでもTelnetCliErrorを送出
+      (Falseの場合は呼び出し側でself.beforeを確認する)
+    - ページャはスペースを送って続きを待ち、ページごとの出力をつなげてself.beforeにする
+    戻値: patternがリストの場合はマッチしたパターンのインデックス
+    """
+    patterns = isinstance(pattern, list) and pattern or [pattern]
+    n = len(patterns)
+    patterns = patterns + [self.vendor.pager_pattern, self.vendor.fatal_pattern] + \
+               (check_errors and [self.vendor.error_pattern] or [])
+    output = None
+    while True:
+      i = self.timed_call(kind, (pexpect.TIMEOUT, ), 
+                          self.child.expect, patterns, timeout=self.get_timeout(timeout or self.telnet_timeout, kind))
+      before = self.child.before
+      if output is not None: before = output + self.vendor.pager_erase.sub("", before)
+      if i != n: break
+      # ページャ
+      output = before
+      self.child.send(" ")
+    self.before = before
+    if i > n:
+      raise TelnetCliError(self.last_cmd, self.child.after.strip())
+    return i
 
   def open(self):
     """ログインしてイネーブルモードへ移行
@@ -76,32 +207,35 @@ class TelnetSess(SessBase):
       except:
         self.write_log(self.logger, 'warn', "%s: ファイルをオープンできません." % (self.logfile, ))
         
-    self.child.expect(self.pass_prompt)
-    self.sendline(self.pass_login)
-    self.child.expect(self.unpriv_prompt)
-    if self.need_priv:
+    # ログインバナーなどをエラーと判定しないように、ログイン中は続行できないエラーだけ確認
+    self.expect(self.pass_prompt, check_errors=False)
+    self.sendline(self.pass_login, secret=True)
+    self.expect(self.vendor.unpriv_prompt, check_errors=False)
+    if self.vendor.need_priv:
       self.sendline("enable")
-      self.child.expect(self.pass_prompt)
-      self.sendline(self.pass_enable)
-      self.child.expect(self.priv_prompt)
-    if self.deact_pager:
+      self.expect(self.pass_prompt, check_errors=False)
+      self.sendline(self.pass_enable, secret=True)
+      self.expect(self.vendor.priv_prompt, check_errors=False)
+    if self.vendor.deact_pager:
       self.sendline("term len 0")
-      self.child.expect(self.priv_prompt)
+      self.expect(self.vendor.priv_prompt)
     self.closed = False
     self.write_log(self.logger, 'info', "%s (%s): ログインしました." % (self.device.ipaddr, self.device.model))
   
   def start_config(self):
-    """ コンフィグモードへ移行
+    """ コンフィグモードへ移行 (移行済の場合は何もしない)
     """
-    return getattr(self, '_start_config_' + self.device.model)()
+    if self.in_config: return
+    getattr(self, '_start_config_' + self.device.model)()
+    self.in_config = True
 
   def _start_config_juniper(self):
     self.sendline("configure")
-    self.child.expect(self.config_prompt)
+    self.expect(self.vendor.config_prompt)
 
   def _start_config_brocade_netiron(self):
     self.sendline("configure t")
-    self.child.expect(self.config_prompt)
+    self.expect(self.vendor.config_prompt)
 
   def _start_config_cisco(self):
     return self._start_config_brocade_netiron()
@@ -110,7 +244,8 @@ class TelnetSess(SessBase):
     """ SNMPアクセスリストを取得
     """
     # コンフィグモードでshowコマンドを実行するときはTrue
-    config_mode=kw.get('config_mode', False)
+    config_mode=kw.get('config_mode', self.in_config)
+    set_last_acl = kw.get('set_last_acl', True)
     acl = list()
     for m in getattr(self, '_gen_snmp_acl_' + self.device.model)(config_mode):
       if not m: continue
@@ -119,15 +254,16 @@ class TelnetSess(SessBase):
       else:
         acl.append(IPv4Network("%s" % m.group(1)))
     acl.sort()
+    if set_last_acl: self.last_acl = acl
     return acl
 
   def _gen_snmp_acl_brocade_netiron(self, config_mode):
     cmd = "show access-list name %s | inc ^_+sequence" % (self.acl_name, )
     self.sendline(cmd)
-    self.child.expect(config_mode and self.config_prompt or self.priv_prompt)
-    for l in self.child.before.split('\r\n')[1:]:
+    self.expect(config_mode and self.vendor.config_prompt or self.vendor.priv_prompt, kind=None, check_errors=False)
+    for l in self.before.split('\r\n')[1:]:
       if len(l.strip()) == 0: continue
-      m = re.match(r"^\s*sequence\s+\d+\s+permit\s+(?:host\s+)?([\d.]+)(?:\s+([\d.]+))?\s*$", l)
+      m = self.vendor.acl_entry_pattern.match(l)
       if not m:
         self.write_log(self.logger, 'warn', "%s: ACLエントリを判別できません.: %s" % (self.device.ipaddr, l, ))
         continue
@@ -136,10 +272,10 @@ class TelnetSess(SessBase):
   def _gen_snmp_acl_juniper(self, config_mode):
     cmd = "show%s policy-options prefix-list %s | no-more" % ("" if config_mode else " configuration", self.acl_name, )
     self.sendline(cmd)
-    self.child.expect(config_mode and self.config_prompt or self.unpriv_prompt)
-    for l in self.child.before.split('\r\n')[1:]:
+    self.expect(config_mode and self.vendor.config_prompt or self.vendor.unpriv_prompt, kind=None, check_errors=False)
+    for l in self.before.split('\r\n')[1:]:
       if l.strip() in (cmd.strip(), '[edit]') or len(l) == 0: continue
-      m = re.match(r"^\s*([\d.]+)/(\d+);\s*$", l)
+      m = self.vendor.acl_entry_pattern.match(l)
       if not m:
         self.write_log(self.logger, 'warn', "%s: ACLエントリを判別できません.: %s" % (self.device.ipaddr, l, ))
         continue
@@ -148,10 +284,10 @@ class TelnetSess(SessBase):
   def _gen_snmp_acl_cisco(self, config_mode):
     cmd = "%s show ip access-lists %s | inc [0-9]+_permit_" % (config_mode and "do" or "", self.acl_name, )
     self.sendline(cmd)
-    self.child.expect(config_mode and self.config_prompt or self.priv_prompt)
-    for l in self.child.before.split('\r\n')[1:]:
+    self.expect(config_mode and self.vendor.config_prompt or self.vendor.priv_prompt, kind=None, check_errors=False)
+    for l in self.before.split('\r\n')[1:]:
       if len(l.strip()) == 0: continue
-      m = re.match(r"^\s*\d+\s+permit\s+([\d.]+)(?:,\s+wildcard\s+bits\s+([\d.]+))?\b", l)
+      m = self.vendor.acl_entry_pattern.match(l)
       if not m:
         self.write_log(self.logger, 'warn', "%s: %s: ACLエントリを判別できません.: %s" % (self.device.ipaddr, l, ))
         continue
@@ -168,17 +304,66 @@ class TelnetSess(SessBase):
         self.close()
         return False
 
+    expected_acl = set(self.last_acl) - set(acl_dict.get('del', [])) | set(acl_dict.get('add', []))
+    if self.use_bulk_load(acl_dict):
+      self.bulk_load_acl(acl_dict)
+      # copyはマージした行ごとのエラーを返さないので、verify_policyによらず再取得して確認する
+      return self.verify_snmp_acl(expected_acl, cmd_error=True, config_mode=False, set_last_acl=False)
+
     self.start_config()
-    if hasattr(self, 'config_acl_cmd'):
-      self.sendline(self.config_acl_cmd)
-      self.child.expect(self.config_prompt)      
+    if self.vendor.config_acl_fmt:
+      self.sendline(self.vendor.config_acl_fmt % (self.acl_name, ))
+      self.expect(self.vendor.config_prompt)      
 
+    cmd_error = False
     for which in [ k for k in ('del', 'add', ) if k in acl_dict]:
       for n in acl_dict[which]:
-        self.sendline(getattr(self, which + '_acl_cmd')(n))
-        self.child.expect(self.config_prompt)
+        cmd = getattr(self, which + '_acl_cmd')(n)
+        self.sendline(cmd)
+        # エントリごとのエラーでは中断せずに、残りのエントリを変更してから確認する
+        self.expect(self.vendor.config_prompt, check_errors=False)
+        if self.vendor.error_pattern.search(self.before + self.child.after):
+          cmd_error = True
+          self.write_log(self.logger, 'warn', "%s: コマンドがエラーになりました.: %s" % (self.device.ipaddr, cmd, ))
+
+    return self.verify_snmp_acl(expected_acl, cmd_error=cmd_error, config_mode=True, set_last_acl=False)
 
-    return self.get_snmp_acl(config_mode=True)
+  def use_bulk_load(self, acl_dict):
+    """ 変更のエントリ数がbulk_threshold以上で、ファイルサーバのスキームに対応していればTrue
+    コンフィグモードに移行済の場合は使わない (copyは特権モードで実行)
+    """
+    return self.file_server is not None and not self.in_config and \
+           self.file_server.scheme in self.vendor.bulk_schemes and \
+           sum(map(len, acl_dict.values())) >= self.bulk_threshold
+
+  def bulk_load_acl(self, acl_dict):
+    """ ACLの変更をコンフィグの断片にしてファイルサーバに置き、1回のcopyでrunning-configにマージ
+    戻値: 転送またはコマンドがエラーになった場合はTrue
+    """
+    lines = [self.vendor.config_acl_fmt % (self.acl_name, )]
+    for which in [ k for k in ('del', 'add', ) if k in acl_dict]:
+      lines.extend([" " + getattr(self, which + '_acl_cmd')(n) for n in acl_dict[which]])
+    lines.append("end")
+    name = self.file_server.publish("\n".join(lines) + "\n", self.device.ipaddr)
+    try:
+      cmd = self.vendor.bulk_load_cmd(self.file_server.url(name, self.device.ipaddr))
+      self.write_log(self.logger, 'info', "%s: %d行を一括でロードします.: %s" % (self.device.ipaddr, len(lines), cmd, ))
+      self.sendline(cmd)
+      output = ""
+      # 宛先ファイル名などの確認にはデフォルト([]内)で応答
+      for n in range(3):
+        i = self.expect([self.confirm_prompt, self.vendor.priv_prompt], kind=None, timeout=self.bulk_timeout, 
+                        check_errors=False)
+        output += self.before + self.child.after
+        if i == 1: break
+        self.sendline("")
+    finally:
+      self.file_server.withdraw(name)
+    if self.vendor.bulk_error_pattern.search(output) or self.vendor.error_pattern.search(output):
+      self.write_log(self.logger, 'warn', "%s: 一括ロードがエラーになりました.: %s" % (
+          self.device.ipaddr, " / ".join([l.strip() for l in output.splitlines() if l.strip()][-3:]), ))
+      return True
+    return False
 
   def save_exit_config(self, **kw):
     """ 保存してコンフィグモードを終了
@@ -201,29 +386,30 @@ class TelnetSess(SessBase):
         print ""
         self.write_log(self.logger, 'debug', "%s: スクリプトの処理に復帰します." % (self.device.ipaddr, ))
     getattr(self, '_save_exit_config_' + self.device.model)()
+    self.in_config = False
     self.write_log(self.logger, 'debug', "%s: コンフィグ保存しました." % (self.device.ipaddr, ))
 
   def _save_exit_config_juniper(self):
     self.sendline("commit and-quit")
-    self.child.expect(self.unpriv_prompt)
+    self.expect(self.vendor.unpriv_prompt, kind=None)
 
   def _save_exit_config_brocade_netiron(self):
     self.sendline("write mem")
-    i = self.child.expect([self.config_prompt, self.priv_prompt])  
+    i = self.expect([self.vendor.config_prompt, self.vendor.priv_prompt], kind=None)  
     if i == 0:
       self.sendline("end")
-      self.child.expect(self.priv_prompt)
+      self.expect(self.vendor.priv_prompt)
 
   def _save_exit_config_cisco(self):
     self.sendline("")
-    i = self.child.expect([self.config_prompt, self.priv_prompt])  
+    i = self.expect([self.vendor.config_prompt, self.vendor.priv_prompt])  
     if i == 0:
       self.sendline("do write mem")
-      self.child.expect(self.config_prompt)
+      self.expect(self.vendor.config_prompt, kind=None)
       self.sendline("end")
     else:
       self.sendline("write mem")
-    self.child.expect(self.priv_prompt)
+    self.expect(self.vendor.priv_prompt, kind=None)
 
   def close(self):
     """ セッション終了
@@ -231,7 +417,8 @@ class TelnetSess(SessBase):
     if self.closed: return
     for n in range(4):
       self.sendline("exit")
-      i = self.child.expect([self.config_prompt, self.priv_prompt, self.unpriv_prompt, pexpect.EOF])  
+      i = self.child.expect([self.vendor.config_prompt, self.vendor.priv_prompt, self.vendor.unpriv_prompt, pexpect.EOF])  
       if i == 3: break
     self.write_log(self.logger, 'debug', "%s: セッションを閉じました." % (self.device.ipaddr, ))
+    self.in_config = False
     self.closed = True
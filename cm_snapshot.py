@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+""" 変更前のACLを記録するスナップショット (SQLite)
+
+- 実行(RUN_ID)ごとに、変更する直前の機器のACLを記録
+- 変更後のACL(targets)はハッシュをキーに1回だけ保存し、機器ごとには変更後のACLとの差分だけを保存
+-- missing: 変更後のACLにあって変更前になかったエントリ (変更で追加した)
+-- extra: 変更前のACLにあって変更後になかったエントリ (変更で削除した)
+-- 変更前のACL = 変更後のACL - missing + extra
+- ロールバック時は機器から再取得せずに、変更後のACLから逆の差分を適用できる
+
+ >>> store = SnapshotStore('./snapshot.db', run_id)
+ >>> store.save(ipaddr, agent.model, current_acl, new_acl)
+ >>> SnapshotStore('./snapshot.db', run_id).load()
+ {'192.0.2.1': ('cisco', [変更前のACL], [変更後のACL])}
+"""
+
+import time
+import hashlib
+import sqlite3
+import threading
+from ipaddr import IPv4Network
+
+def encode_acl(acl):
+  return " ".join([n.with_prefixlen for n in sorted(set(acl))])
+
+def decode_acl(s):
+  return [IPv4Network(e) for e in s.split()]
+
+class SnapshotStore(object):
+  """ RUN_IDごとの変更前のACL
+  """
+  def __init__(self, path, run_id):
+    self.path = path
+    self.run_id = run_id
+    self.lock = threading.Lock()
+    # 登録済の変更後のACLのハッシュ
+    self.targets = set()
+    # ワーカースレッドから共有するので check_same_thread=False (書き込みはlockで直列化)
+    self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self.conn.execute("PRAGMA journal_mode=WAL")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS targets (key TEXT PRIMARY KEY, acl TEXT)")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS snapshots ("
+                      "run_id TEXT, ipaddr TEXT, model TEXT, target TEXT, missing TEXT, extra TEXT, ts REAL, "
+                      "PRIMARY KEY (run_id, ipaddr))")
+
+  def save(self, ipaddr, model, current_acl, target_acl):
+    """ 変更前のACL(current_acl)を変更後のACL(target_acl)との差分で記録
+    同じRUN_IDで再実行(再開)した場合は最初の記録を残す
+    """
+    target = encode_acl(target_acl)
+    key = hashlib.sha1(target).hexdigest()
+    current, target_set = set(current_acl), set(target_acl)
+    with self.lock:
+      if key not in self.targets:
+        self.conn.execute("INSERT OR IGNORE INTO targets (key, acl) VALUES (?, ?)", (key, target, ))
+        self.targets.add(key)
+      self.conn.execute("INSERT OR IGNORE INTO snapshots (run_id, ipaddr, model, target, missing, extra, ts) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (self.run_id, ipaddr, model, key,
+                         encode_acl(target_set - current), encode_acl(current - target_set), time.time(), ))
+
+  def load(self):
+    """ 機器ごとの (機種, 変更前のACL, 変更後のACL) の辞書を返す
+    """
+    with self.lock:
+      rows = self.conn.execute("SELECT s.ipaddr, s.model, t.acl, s.missing, s.extra "
+                               "FROM snapshots s JOIN targets t ON s.target = t.key WHERE s.run_id = ?",
+                               (self.run_id, )).fetchall()
+    snapshots = dict()
+    # 変更後のACLは同じ内容が多いので1回だけ変換する
+    targets = dict()
+    for ipaddr, model, target, missing, extra in rows:
+      if target not in targets: targets[target] = set(decode_acl(target))
+      target_acl = targets[target]
+      snapshot_acl = target_acl - set(decode_acl(missing)) | set(decode_acl(extra))
+      snapshots[str(ipaddr)] = (str(model), sorted(snapshot_acl), sorted(target_acl))
+    return snapshots
+
+  def close(self):
+    with self.lock:
+      self.conn.close()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+""" SNMPで取得した値を保存するメモリマップドファイルの時系列ストア
+
+- (機器, OID) ごとの系列を、固定長のリングバッファ (時刻 float64, 値 uint64) に保存
+- 追記はO(1)、範囲の読み出しはファイルをコピーせずにNumPyのビューで返す
+- ディレクトリ構成
+    data.bin   全系列のリングバッファ (max_series x capacity)
+    head.bin   系列ごとの次の書き込み位置と件数 (max_series x 2)
+    index.json 系列のキーと位置の対応、capacity、max_series
+- data.binは max_series x capacity x 16バイトのスパースファイル (書き込んだ系列の分だけディスクを使う)
+- 追加した系列のindex.jsonへの保存は、append_many()の最後とflush()で1回だけ
+
+ >>> store = TimeSeriesStore('./snmp_tsdb', capacity=40320)
+ >>> store.append(('192.0.2.1', '1.3.6.1.2.1.31.1.1.1.6.1'), time.time(), 12345)
+ >>> views = store.range(('192.0.2.1', '1.3.6.1.2.1.31.1.1.1.6.1'), t0, t1)
+
+ CounterPoller(cm_sess.pysnmp_poller)で取得した値を保存する場合
+ >>> poller.run(interval=60, count=1440, on_sample=store.append_poller)
+"""
+
+import os
+import json
+import threading
+from os.path import join, exists
+import numpy as np
+
+record_dtype = np.dtype([('ts', '<f8'), ('val', '<u8')])
+
+class TimeSeriesStore(object):
+  """ 系列ごとに固定長のリングバッファを持つ時系列ストア
+  capacity: 系列ごとに保持する件数
+  max_series: 系列数の上限 (作成時に確保、機器数 x インタフェース数 x OID数より大きくする)
+  既存のストアを開く場合、capacityとmax_seriesはindex.jsonの値を使う
+  """
+  def __init__(self, path, capacity=40320, max_series=200000):
+    self.path = path
+    self.lock = threading.Lock()
+    if not exists(path): os.makedirs(path)
+    index_path = join(path, 'index.json')
+    if exists(index_path):
+      with open(index_path) as f:
+        meta = json.load(f)
+      capacity, max_series = meta['capacity'], meta['max_series']
+      self.index = dict([(tuple(k.split('|')), v) for k, v in meta['series'].items()])
+      mode = 'r+'
+    else:
+      self.index = dict()
+      mode = 'w+'
+    self.capacity = capacity
+    self.max_series = max_series
+    # index.jsonに保存していない系列がある場合はTrue
+    self.dirty = False
+    self.data = np.memmap(join(path, 'data.bin'), dtype=record_dtype, mode=mode, shape=(max_series, capacity))
+    self.head = np.memmap(join(path, 'head.bin'), dtype=np.uint64, mode=mode, shape=(max_series, 2))
+    if mode == 'w+': self._save_index()
+
+  def _save_index(self):
+    """ 系列のキーと位置の対応を保存
+    """
+    meta = dict(capacity=self.capacity, max_series=self.max_series,
+                series=dict([('|'.join(k), v) for k, v in self.index.items()]))
+    tmp = join(self.path, 'index.json.tmp')
+    with open(tmp, 'w') as f:
+      json.dump(meta, f)
+    os.rename(tmp, join(self.path, 'index.json'))
+    self.dirty = False
+
+  def _slot(self, key, create=True):
+    slot = self.index.get(key)
+    if slot is None and create:
+      if len(self.index) >= self.max_series:
+        raise ValueError("%s: too many series (max %d)." % (self.__class__.__name__, self.max_series, ))
+      slot = self.index[key] = len(self.index)
+      self.dirty = True
+    return slot
+
+  def append(self, key, ts, val):
+    """ 系列key (機器, OID) に1件追記 (追加した系列はflush()で保存)
+    """
+    with self.lock:
+      slot = self._slot(tuple(key))
+      pos, count = int(self.head[slot, 0]), int(self.head[slot, 1])
+      self.data[slot, pos] = (ts, val)
+      self.head[slot, 0] = (pos + 1) % self.capacity
+      self.head[slot, 1] = min(count + 1, self.capacity)
+
+  def append_many(self, keys, ts, vals):
+    """ 複数の系列に1件ずつまとめて追記 (keysは重複しないこと)
+    ts: 時刻 (スカラーまたは系列ごとの配列)
+    """
+    with self.lock:
+      slots = np.array([self._slot(tuple(key)) for key in keys], dtype=np.intp)
+      pos = self.head[slots, 0].astype(np.intp)
+      self.data['ts'][slots, pos] = ts
+      self.data['val'][slots, pos] = vals
+      self.head[slots, 0] = (pos + 1) % self.capacity
+      self.head[slots, 1] = np.minimum(self.head[slots, 1] + np.uint64(1), np.uint64(self.capacity))
+      if self.dirty: self._save_index()
+
+  def append_poller(self, poller):
+    """ CounterPollerが直近に取得した値を追記 (CounterPoller.run()のon_sampleに指定する)
+    """
+    slot = poller.latest()
+    i, j = np.nonzero(poller.valid[slot])
+    if not len(i): return
+    keys = [(poller.routers[a], poller.oids[b]) for a, b in zip(i, j)]
+    self.append_many(keys, poller.times[slot, i], poller.samples[slot, i, j])
+
+  def views(self, key):
+    """ 系列keyの全件を古い順に並べたビューのリスト (折り返している場合は2つ)
+    """
+    slot = self._slot(tuple(key), create=False)
+    if slot is None: return list()
+    pos, count = int(self.head[slot, 0]), int(self.head[slot, 1])
+    if count < self.capacity:
+      return [self.data[slot, :count]]
+    return [v for v in (self.data[slot, pos:], self.data[slot, :pos]) if len(v)]
+
+  def range(self, key, t0=None, t1=None):
+    """ 系列keyの t0 <= 時刻 < t1 の範囲のビューのリスト (コピーしない)
+    """
+    result = list()
+    for v in self.views(key):
+      i = 0 if t0 is None else np.searchsorted(v['ts'], t0, side='left')
+      j = len(v) if t1 is None else np.searchsorted(v['ts'], t1, side='left')
+      if i < j: result.append(v[i:j])
+    return result
+
+  def read(self, key, t0=None, t1=None):
+    """ range()のビューを1つの配列にまとめて返す (折り返している場合はコピー)
+    """
+    views = self.range(key, t0, t1)
+    if len(views) == 1: return views[0]
+    if not views: return np.empty(0, dtype=record_dtype)
+    return np.concatenate(views)
+
+  def flush(self):
+    with self.lock:
+      if self.dirty: self._save_index()
+      self.data.flush()
+      self.head.flush()
@@ -8,19 +8,141 @@
 - 機器ごとのsysDescrを取得してから機種に対応するAPIで接続
 -- cisco, brocade(ni): telnet 
 -- juniper, brocade(vdx): netconf
--- arista: eapi
+-- arista: eapi (configure sessionで変更し、commit timerの期限内に保存で確定)
 
 - threadingモジュールを使った並列処理のデモ
 
  $ ./update_snmp_acl_thread.py -h
- usage: update_snmp_acl_thread.py [-h] [-d]
+ usage: update_snmp_acl_thread.py [-h] [-d] [-r RUN_ID] [-t SEC]
+                                  [--straggler-deadline SEC]
+                                  [--verify {full,sampled,optimistic}]
+                                  [--verify-ratio RATIO] [--max-threads N] [-l]
+                                  [--trap-community COMMUNITY] [-a]
+                                  [--profile DIR] [--profile-alloc]
+                                  [--bulk-load {tftp,http}] [--rollback RUN_ID]
+                                  [--coordinator HOST:PORT | --worker HOST:PORT]
  
  optional arguments:
-   -h, --help         show this help message and exit
-   -d, --dump-telnet  copy telnet screen to a file (default: False)
+   -h, --help            show this help message and exit
+   -d, --dump-telnet     copy telnet screen to a file (default: False)
+   -r RUN_ID, --resume RUN_ID
+                         resume an interrupted run (default: None)
+   -t SEC, --deadline SEC
+                         per-device deadline in seconds (default: None)
+   --straggler-deadline SEC
+                         per-device deadline in the straggler lane (default:
+                         None)
+   --verify {full,sampled,optimistic}
+                         how to verify the updated ACL (default: full)
+   --verify-ratio RATIO  ratio of devices re-read in the sampled mode
+                         (default: 0.1)
+   --max-threads N       adapt the number of concurrent sessions up to N
+                         (default: None)
+   -l, --listen          update only devices that report config changes
+                         (default: False)
+   --trap-community COMMUNITY
+                         accept config change traps with COMMUNITY in --listen
+                         (default: None)
+   -a, --audit           compare ACLs without changing them (default: False)
+   --profile DIR         write per-backend profiles to DIR (default: None)
+   --profile-alloc       also trace memory allocations with --profile (default:
+                         False)
+   --bulk-load {tftp,http}
+                         push large ACL changes as a file served over TFTP or
+                         HTTP (default: None)
+   --rollback RUN_ID     restore the ACLs recorded before RUN_ID changed them
+                         (default: None)
+   --coordinator HOST:PORT
+                         lease devices to workers listening on HOST:PORT
+                         (default: None)
+   --worker HOST:PORT    run sessions leased by the coordinator at HOST:PORT
+                         (default: None)
 
 - オプション '-d', '--dump-telnet': telnetセッションのスクリーンをファイルに出力
   (パスワードが平文で出力されるので注意)
+
+- オプション '-r', '--resume': 中断した実行をRUN_IDを指定して再開
+-- RUN_IDは開始時にコンソールに表示 (ログにも記録)
+-- 機器ごとの処理状態(discovered, read, applied, saved, failed)をジャーナルに記録
+-- 保存まで完了した機器はスキップ
+-- 変更後、保存前に中断した機器は、ACLを再確認して一致していれば保存のみ実行
+-- aristaでcommit timerの確認待ちのまま中断した場合は、期限内ならセッションのコミットを確定してから保存
+
+- オプション '-t', '--deadline': 機器ごとの処理時間の上限(秒)
+-- 各呼び出しのタイムアウトを残り時間で制限
+-- 設定変更を開始する前に期限切れになった機器は、セッションを閉じてストラグラー用の
+   キューに回し、1スレッドで後から処理 (上限は '--straggler-deadline')
+-- 設定変更を開始した後は途中で中断しない (各呼び出しのタイムアウトのみ適用)
+
+- タイムアウト: 機器ごとに実測した応答時間(telnet, RPC, HTTP, SNMP)から学習
+-- 平滑化した応答時間とそのばらつきから求める (TCPの再送タイムアウトと同じ方法)
+-- 推定値は update_snmp_acl_thread.rto.json に保存して次回の実行に引き継ぐ
+-- 学習するのはログインやプロンプトの応答など応答時間がほぼ一定の呼び出しだけ
+-- サンプルが少ない機器と、ACLの取得、ロード、保存など時間がサイズで変わる呼び出しは固定のタイムアウト
+
+- 処理順: 過去の実行で記録した機器ごとの所要時間が長い順にキューに入れる
+-- 所要時間の履歴は update_snmp_acl_thread.history.json に保存
+-- 履歴がない機器は、同じ機種のACLエントリ数あたりの所要時間から見積もる
+
+- 同じ内容のACLはハッシュで共有 (cm_aclstore.AclStore)
+-- 差分の計算は (変更前, 変更後) のACLの組み合わせごとに1回だけ
+-- 変更前後のACLは初回のみエントリを、2回目以降はハッシュのみをログに出力
+
+- セッション開始前に全機器の管理ポート(telnet 23, NETCONF 830, eAPI 80)への接続を並列に確認
+-- 機種を特定する前なので全機種のポートを確認
+-- 接続できない機器はジャーナルに失敗(unreachable)として記録し、SNMPでの機種の特定もキューへの投入もしない
+
+- オプション '--verify': 更新後のACLの確認方法
+-- full: 常に機器からACLを再取得して確認
+-- sampled: '--verify-ratio' の割合の機器と、コマンドがエラーになった機器だけ再取得
+-- optimistic: コマンドがエラーになった機器だけ再取得
+-- 再取得しない機器は、コマンドが成功したものとして組み立てたACLで確認
+
+- オプション '--max-threads': 同時に処理する機器の数を実行中に調整 (上限N)
+-- thread_num から始めて、一定時間ごとに完了数、エラー率、ログインから取得までの所要時間を集計
+-- エラー率や所要時間が増えた場合は半分に減らし、それ以外は完了数が落ちない限り1ずつ増やす (AIMD)
+
+- オプション '-l', '--listen': 設定変更を通知した機器だけを更新 (中断するまで継続)
+-- SNMPトラップ(ciscoConfigManEvent, jnxCmCfgChange)とsyslogの設定変更メッセージを受信
+-- 同じ機器からの通知は change_debounce 秒間まとめて1回だけ処理
+-- 通知は対象機器(agent_ipaddrs)から送信されたものだけ受け付ける
+-- トラップは '--trap-community' でコミュニティを指定した場合だけ受信 (指定しない場合はsyslogのみ)
+-- 処理中の機器への通知は、処理が終わってから1回だけ再実行 (同じ機器のセッションを同時に実行しない)
+-- 162番、514番ポートで待ち受けるのでroot権限で実行
+
+- オプション '-a', '--audit': ACLを変更せずに新しいACLとの差分の有無だけを確認
+-- ベンダーMIB(cm_agent.Agent.snmp_acl_mib)が定義されている機種(brocade_netiron)はSNMPのGETBULKで取得
+-- ACL名はセッションのクラスのacl_name (brocade_vdxはMANAGEMENT-ACCESS)
+-- 定義されていない機種、SNMPで取得できなかった場合はCLI/APIのセッションで取得
+
+- オプション '--profile': 機器ごとのrun_sess()をcProfileで計測し、セッションのクラスごとにDIRに出力 (cm_profile)
+-- <クラス名>.pstats: python -m pstats で表示
+-- <クラス名>.collapsed: flamegraph.pl でフレームグラフを作成 (呼び出し元のグラフから按分した近似)
+-- '--profile-alloc': tracemallocでメモリ割り当ての増加量も<クラス名>.alloc.txtに出力 (並列実行中は近似)
+-- 指定しない場合は計測しない
+
+- オプション '--bulk-load': 変更のエントリ数が多い場合(TelnetSess.bulk_threshold以上)はコマンドを1行ずつ入力せずに一括でロード
+-- 変更をコンフィグの断片にして、内蔵のTFTP/HTTPサーバ(cm_filesrv)で機器にだけ公開
+-- cisco: copy tftp://HOST/FILE running-config (httpも可)
+-- brocade(ni): copy tftp running-config HOST FILE (tftpのみ)
+-- 対応していない機種、スキームの場合は1行ずつ入力
+-- ロード後は機器からACLを再取得して確認
+
+- 変更前のACLを update_snmp_acl_thread.snapshot.db に記録 (cm_snapshot)
+-- 変更後のACLは1回だけ保存し、機器ごとには変更後のACLとの差分のみ保存
+
+- オプション '--rollback': RUN_IDの実行で変更した機器を、記録した変更前のACLに並列に戻して保存
+-- 変更後のACLを適用済(applied, saved)の機器は再取得せずに逆の差分を適用
+-- それ以外の機器と、削除にseq-idが必要なbrocade(vdx)は機器から再取得して差分を求める
+-- ロールバックの処理状態は新しいRUN_IDでジャーナルに記録 (実行の種類と対象のRUN_IDも記録)
+-- ロールバックのRUN_IDを '--resume' に指定すると、ロールバックとして再開 (新しいACLは適用しない)
+
+- オプション '--coordinator', '--worker': 複数ホストで分散実行
+-- コーディネータは機器ごとのリースをワーカーに配布し、処理状態をジャーナルに記録
+-- ワーカーは thread_num 本の接続でリースを取得してセッションを実行
+-- ワーカーが停止して期限切れになったリースは他のワーカーに再割り当て
+-- 起動時に入力する共有鍵で、コーディネータがワーカーの接続を認証 (HMAC-SHA256のチャレンジ/レスポンス)
+-- 所要時間はワーカーからコーディネータに通知して、コーディネータの履歴に保存
 """
 
 # 設定変更対象機器のIPアドレス
@@ -32,17 +154,32 @@ snmp_mgr_networks = ('172.25.8.0/24', '172.31.30.0/24', '192.168.11.0/24', '10.0
 import sys
 from os.path import *
 import re
+import time
 import hashlib
 import logging
 import getpass
 import argparse
 import traceback
 import threading
+import socket
 import Queue
 from ipaddr import IPv4Network
 
 from cm_sess.pysnmp_sess_v2c import *
+from cm_sess.deadline import Deadline, DeadlineExceeded
+from cm_sess.rto import RtoStore
+from cm_sess.telnet_sess import TelnetSess
 import cm_agent
+import cm_journal
+import cm_sched
+import cm_dist
+import cm_probe
+import cm_aclstore
+import cm_pool
+import cm_listen
+import cm_profile
+import cm_filesrv
+import cm_snapshot
 
 # ロギング設定
 logger_name =basename(sys.argv[0])[:-3]
@@ -66,9 +203,46 @@ snmp_comm_hash = '58bff4b84f5e0f61ae1688c8f7a6bf84'
 
 pass_login, pass_enable, snmp_comm = None, None, None
 
+# 処理状態を記録するジャーナル
+journal_path = './%s.journal.db' % (logger_name, )
+
+# 変更前のACLのスナップショット
+snapshot_path = './%s.snapshot.db' % (logger_name, )
+
+# 機器ごとの所要時間の履歴
+history_path = './%s.history.json' % (logger_name, )
+
+# 機器ごとに応答時間から学習したタイムアウト
+rto_path = './%s.rto.json' % (logger_name, )
+rto_store = None
+
+# get_agent()で特定した機種のキャッシュ
+agents = dict()
+
+# 管理ポートへの到達性確認のタイムアウト(秒)
+probe_timeout = 3
+
+# '--listen'で設定変更のトラップとsyslogを受信するアドレス
+trap_addr = ('0.0.0.0', 162)
+syslog_addr = ('0.0.0.0', 514)
+# トラップのコミュニティ ('--trap-community'で指定、Noneの場合はトラップを受信しない)
+trap_community = None
+# 同じ機器からの通知をまとめる時間(秒)
+change_debounce = 30
+
+# '--bulk-load'のファイルサーバが待ち受けるアドレス
+bulk_addr = dict(tftp=('0.0.0.0', 69), http=('0.0.0.0', 8080))
+file_server = None
+
 # スレッド数
 thread_num = 5
 
+# デッドライン超過でストラグラー用キューに回す場合のrun_sess()の戻値
+STRAGGLER = 'straggler'
+
+# 分散実行時のリースの有効期限(秒): ワーカーは実行中に延長する
+lease_ttl = 60
+
 def get_secrets():
   """標準入力から取得するパスワードをチェック
   """
@@ -98,91 +272,603 @@ def get_secrets():
 def get_agent(ipaddr):
   """ipaddrからSNMPで取得するsysDescrを使って機種を判別
   """
-  m = re.search('(arista|brocade\s+(netiron|vdx)|cisco|juniper)', snmpget_sysdescr(ipaddr, snmp_comm), re.I)
+  if ipaddr in agents: return agents[ipaddr]
+  if rto_store is None:
+    sysdescr = snmpget_sysdescr(ipaddr, snmp_comm)
+  else:
+    # 学習した応答時間からタイムアウトを決める
+    estimator = rto_store.get(ipaddr, 'snmp')
+    started = time.time()
+    try:
+      sysdescr = snmpget_sysdescr(ipaddr, snmp_comm, timeout=estimator.timeout(1))
+    except PysnmpSessV2cError:
+      estimator.backoff()
+      raise
+    estimator.observe(time.time() - started)
+  m = re.search('(arista|brocade\s+(netiron|vdx)|cisco|juniper)', sysdescr, re.I)
   if m:
     # Arista、BrocadeNetiron、BrocadeVdx、Cisco、Juniper いずれかのオブジェクトを返す
-    return getattr(cm_agent, ''.join(m.group(1).lower().title().split()))(ipaddr)
+    agents[ipaddr] = getattr(cm_agent, ''.join(m.group(1).lower().title().split()))(ipaddr)
+    return agents[ipaddr]
   else:
     raise ValueError("%s: 機種を特定できませんでした." % (ipaddr))
 
 
+def discover_agents(ipaddrs):
+  """機種を並列に特定してキャッシュ (エラーはrun_sess()で改めて処理)
+  """
+  queue = Queue.Queue()
+  def discover():
+    while True:
+      ipaddr = queue.get()
+      try:
+        get_agent(ipaddr)
+      except (ValueError, PysnmpSessV2cError):
+        pass
+      queue.task_done()
+  for i in range(thread_num):
+    t = threading.Thread(target=discover)
+    t.setDaemon(True)
+    t.start()
+  for ipaddr in ipaddrs:
+    queue.put(ipaddr)
+  queue.join()
+
+
 class RunSessThread(threading.Thread):
   """ Threadクラスのサブクラス
   run()メソッドで機器IPアドレスをキューから取得して設定変更
+  stragglers: デッドラインを超過した機器を入れるキュー
+  target: 機器ごとに実行する関数 (デフォルトはrun_sess)
+  pool: 同時実行数を調整するAdaptivePool
   """
-  def __init__(self, queue, a, d):
+  def __init__(self, queue, a, d, stragglers=None, target=None, pool=None, **kw):
     threading.Thread.__init__(self)
     self.queue = queue
     self.a = a
     self.d = d
+    self.stragglers = stragglers
+    self.target = target or run_sess
+    self.pool = pool
+    self.kw = kw
+    if pool:
+      # 処理状態ごとの所要時間をプールに通知
+      self.kw['on_phase'] = pool.observe_phase
 
   def run(self):
     while True:
-      # キューから機器のIPアドレスを取得
-      ipaddr = self.queue.get()
-      run_sess(ipaddr, logger, self.a, self.d)
-      # キューに完了通知
-      self.queue.task_done()
+      # キューから機器のIPアドレスと機器ごとのオプションを取得
+      ipaddr, item_kw = self.queue.get()
+      try:
+        self.run_one(ipaddr, item_kw)
+      finally:
+        # キューに完了通知 (例外の場合もqueue.join()が戻るように)
+        self.queue.task_done()
+
+  def run_one(self, ipaddr, item_kw):
+    state = cm_journal.FAILED
+    if self.pool: self.pool.acquire()
+    try:
+      state = self.target(ipaddr, logger, self.a, self.d, **dict(self.kw, **item_kw))
+    except Exception, e:
+      # 想定外の例外でもスレッドは終了せずに、失敗として次の機器を処理
+      logger.debug(traceback.format_exc())
+      logger.error("%s: %s: 処理に失敗しました." % (ipaddr, str(e.__class__), ))
+      if self.kw.get('journal'): self.kw['journal'].record(ipaddr, cm_journal.FAILED, str(e.__class__))
+    finally:
+      if self.pool: self.pool.release(error=state in (cm_journal.FAILED, STRAGGLER, ))
+    if state == STRAGGLER and self.stragglers is not None:
+      # ストラグラー用のキューで後から処理
+      self.stragglers.put((ipaddr, item_kw))
+    elif state == STRAGGLER:
+      # ストラグラー用のデッドラインも超過した場合は、後がないので失敗として記録
+      logger.error("%s: 処理時間の上限を超えたので中断しました." % (ipaddr, ))
+      if self.kw.get('journal'): self.kw['journal'].record(ipaddr, cm_journal.FAILED, "deadline exceeded")
+
+
+def describe_acl(acl, acl_store=None):
+  """ログ出力用のACL: acl_storeがあれば同じ内容のACLは2回目以降ハッシュのみ
+  """
+  if acl_store: return acl_store.describe(acl_store.intern(acl))
+  return ", ".join([n.with_prefixlen for n in acl])
 
 
-def run_sess(ipaddr, logger, new_acl, dump_telnet):
+def run_sess(ipaddr, logger, new_acl, dump_telnet, journal=None, reverify=False, deadline=None, history=None, 
+             verify_policy='full', verify_ratio=0.1, acl_store=None, on_phase=None, snapshots=None, pending_session=None, 
+             on_sess=None):
   """管理対象機器のipaddrにアクセスして設定を更新する
+  journal: 処理状態を記録するRunJournal
+  reverify: 変更後、保存前に中断していた機器の場合はTrue
+  deadline: 機器ごとの処理時間の上限(秒)
+  history: 所要時間を記録するDurationHistory
+  verify_policy, verify_ratio: 更新後のACLの確認方法 (SessBase.verify_policy)
+  acl_store: 同じ内容のACLと差分を機器間で共有するAclStore
+  on_phase: 処理状態を記録するたびに (状態, 前の状態からの所要時間) で呼び出す関数
+  snapshots: 変更前のACLを記録するSnapshotStore
+  pending_session: 前回の実行で確認待ちのまま中断したセッションの名前 (reverifyの場合)
+  on_sess: セッションを作成したときに (ipaddr, セッション) で呼び出す関数
+  戻値: 最後に記録した処理状態 (デッドライン超過の場合は STRAGGLER)
   """
+  started = time.time()
+  result = dict(state=None, recorded=started)
+  def record(state, note=None):
+    result['state'] = state
+    if journal: journal.record(ipaddr, state, note)
+    if on_phase:
+      now = time.time()
+      on_phase(state, now - result['recorded'])
+      result['recorded'] = now
+
+  deadline = deadline and Deadline(deadline)
+
   try:
     # 機種を特定する
     agent = get_agent(ipaddr)
   except (ValueError, PysnmpSessV2cError), e:
     # 特定できなかった場合は終了
     logger.error("%s: %s" % (e.__class__.__name__, str(e)))
-    return
+    record(cm_journal.FAILED, str(e))
+    return result['state']
+  record(cm_journal.DISCOVERED, agent.model)
   # 機種ごとに対応するAPIを使ってアクセス
   sess = agent.get_sess(pass_login, pass_enable, logger.name, dump_telnet=dump_telnet, )
+  if on_sess: on_sess(ipaddr, sess)
+  sess.deadline = deadline
+  sess.rto_store = rto_store
+  sess.verify_policy = verify_policy
+  sess.verify_ratio = verify_ratio
+  if isinstance(sess, TelnetSess):
+    sess.file_server = file_server
   try:
     # セッション開始
     sess.open()
     # 設定されているACLとの差分を取得
     current_acl = sess.get_snmp_acl()
-    acl_diff_dict = dict()
-    acl_diff_dict['add'] = list(set(new_acl) - set(current_acl))
-    acl_diff_dict['del'] = list(set(current_acl) - set(new_acl))
+    record(cm_journal.READ)
+    if deadline:
+      # 設定変更の開始前に期限切れならここで中断、開始後は中断しない
+      deadline.check("before update")
+      deadline.suspend()
+    if acl_store:
+      # 同じ内容のACLの差分は1回だけ計算する
+      acl_diff_dict = acl_store.diff(acl_store.intern(current_acl), acl_store.intern(new_acl, pin=True))
+    else:
+      acl_diff_dict = dict()
+      acl_diff_dict['add'] = list(set(new_acl) - set(current_acl))
+      acl_diff_dict['del'] = list(set(current_acl) - set(new_acl))
 
     # 新しいACLとの差分がある場合
     if filter(len, acl_diff_dict.values()):
-      logger.info("%s: 変更前のACL: %s" % (ipaddr, ", ".join([n.with_prefixlen for n in current_acl])))
+      logger.info("%s: 変更前のACL: %s" % (ipaddr, describe_acl(current_acl, acl_store)))
+      if snapshots: snapshots.save(ipaddr, agent.model, current_acl, new_acl)
       updated_acl = sess.update_snmp_acl(acl_diff_dict, prompt=False)
       # 更新キャンセルの場合
-      if not updated_acl and sess.closed: return
+      if not updated_acl and sess.closed: return result['state']
       if set(new_acl) != set(updated_acl):
         # 更新結果がリクエストと一致しなかった場合は保存しない
-        logger.error("%s: ACL変更を正常に完了できませんでした: %s" % (ipaddr, ", ".join([n.with_prefixlen for n in updated_acl])))
+        logger.error("%s: ACL変更を正常に完了できませんでした: %s" % (ipaddr, describe_acl(updated_acl, acl_store)))
+        record(cm_journal.FAILED, "ACL mismatch")
       else:
-        # 更新された設定を保存
-        logger.info("%s: 変更後のACL: %s" % (ipaddr, ", ".join([n.with_prefixlen for n in updated_acl])))
+        # 更新された設定を保存 (確認待ちのセッションは再開時に確定できるように名前を記録)
+        record(cm_journal.APPLIED, sess.pending_session())
+        logger.info("%s: 変更後のACL: %s" % (ipaddr, describe_acl(updated_acl, acl_store)))
         sess.save_exit_config(prompt=False)
+        record(cm_journal.SAVED)
+
+    # 前回の実行で変更後、保存前に中断していた場合は保存のみ実行
+    elif reverify:
+      logger.info("%s: 変更済のACLを保存します." % (ipaddr, ))
+      if pending_session:
+        # 確認待ちのセッションが期限切れ前なら、保存時にコミットを確定する
+        sess.resume_session(pending_session)
+      sess.save_exit_config(prompt=False)
+      record(cm_journal.SAVED)
 
     # 新しいACLと一致していた場合
     else:
       logger.info("%s: ACLは更新済です." % (ipaddr, ))
+      record(cm_journal.SAVED, "unchanged")
 
     # セッション終了
     sess.close()
+    # 完了した機器の所要時間を記録
+    if history and result['state'] == cm_journal.SAVED:
+      history.observe(ipaddr, agent.model, len(current_acl), time.time() - started)
+
+  except Exception, e:
+    logger.debug(traceback.format_exc())
+    if deadline and (isinstance(e, DeadlineExceeded) or deadline.expired()):
+      # 設定変更の開始前にデッドラインを超過した場合はセッションを閉じてストラグラー扱い
+      logger.warn("%s: %s: 処理時間の上限を超えたので後で再実行します." % (ipaddr, sess.__class__.__name__, ))
+      try:
+        sess.deadline = None
+        sess.close()
+      except Exception:
+        logger.debug(traceback.format_exc())
+      return STRAGGLER
+    logger.error("%s: %s: セッションの実行に失敗しました." % (sess.__class__.__name__, str(e.__class__), )) 
+    record(cm_journal.FAILED, str(e.__class__))
 
+  return result['state']
+
+
+def restore_sess(ipaddr, logger, snapshots, dump_telnet, journal=None, assume_applied=False):
+  """管理対象機器のACLをスナップショットの変更前のACLに戻して保存する
+  snapshots: {IPアドレス: (機種, 変更前のACL, 変更後のACL)} (SnapshotStore.load())
+  assume_applied: 変更後のACLが適用済の場合はTrue (機器から再取得しない)
+  戻値: 最後に記録した処理状態
+  """
+  result = dict(state=None)
+  def record(state, note=None):
+    result['state'] = state
+    if journal: journal.record(ipaddr, state, note)
+
+  model, snapshot_acl, applied_acl = snapshots[ipaddr]
+  # 機種は記録済なのでSNMPで特定しない
+  agent = agents.setdefault(ipaddr, getattr(cm_agent, ''.join([w.title() for w in model.split('_')]))(ipaddr))
+  record(cm_journal.DISCOVERED, agent.model)
+  sess = agent.get_sess(pass_login, pass_enable, logger.name, dump_telnet=dump_telnet, )
+  sess.rto_store = rto_store
+  if isinstance(sess, TelnetSess):
+    sess.file_server = file_server
+  try:
+    sess.open()
+    restored_acl = sess.restore_snmp_acl(snapshot_acl, assume_applied and applied_acl or None)
+    if set(restored_acl) != set(snapshot_acl):
+      logger.error("%s: 変更前のACLに戻せませんでした: %s" % (ipaddr, describe_acl(restored_acl)))
+      record(cm_journal.FAILED, "ACL mismatch")
+    else:
+      record(cm_journal.APPLIED, "rollback")
+      logger.info("%s: 変更前のACLに戻しました: %s" % (ipaddr, describe_acl(restored_acl)))
+      sess.save_exit_config(prompt=False)
+      record(cm_journal.SAVED, "rollback")
+    sess.close()
   except Exception, e:
     logger.debug(traceback.format_exc())
     logger.error("%s: %s: セッションの実行に失敗しました." % (sess.__class__.__name__, str(e.__class__), )) 
+    record(cm_journal.FAILED, str(e.__class__))
+  return result['state']
+
+
+def audit_sess(ipaddr, logger, new_acl, dump_telnet, acl_store=None):
+  """管理対象機器のACLを取得して新しいACLと比較する (変更はしない)
+  acl_store: 同じ内容のACLと差分を機器間で共有するAclStore
+  戻値: 'compliant' / 'drift' / None (取得できなかった場合)
+  """
+  try:
+    agent = get_agent(ipaddr)
+  except (ValueError, PysnmpSessV2cError), e:
+    logger.error("%s: %s" % (e.__class__.__name__, str(e)))
+    return
+  current_acl = None
+  if agent.snmp_acl_mib:
+    # ベンダーMIBがある機種はSNMPで取得
+    try:
+      current_acl = snmpwalk_acl(ipaddr, snmp_comm, agent.snmp_acl_mib, agent.sess_class.acl_name)
+    except (ValueError, PysnmpSessV2cError), e:
+      logger.debug(traceback.format_exc())
+      logger.warn("%s: SNMPでACLを取得できませんでした.: %s" % (ipaddr, str(e), ))
+  if current_acl is None:
+    # CLI/APIのセッションで取得
+    sess = agent.get_sess(pass_login, pass_enable, logger.name, dump_telnet=dump_telnet, )
+    sess.rto_store = rto_store
+    try:
+      sess.open()
+      current_acl = sess.get_snmp_acl()
+      sess.close()
+    except Exception, e:
+      logger.debug(traceback.format_exc())
+      logger.error("%s: %s: セッションの実行に失敗しました." % (sess.__class__.__name__, str(e.__class__), )) 
+      return
+  if acl_store:
+    cur_key, new_key = acl_store.intern(current_acl), acl_store.intern(new_acl, pin=True)
+    acl_diff_dict = acl_store.diff(cur_key, new_key)
+  else:
+    acl_diff_dict = dict([('add', sorted(set(new_acl) - set(current_acl))), 
+                          ('del', sorted(set(current_acl) - set(new_acl))), ])
+  if filter(len, acl_diff_dict.values()):
+    if acl_store and not acl_store.first_seen(('diff', cur_key, new_key)):
+      # 同じ差分は2回目以降ACLのハッシュのみ
+      logger.warn("%s: ACLが一致しません.: %s" % (ipaddr, cur_key[:12], ))
+      return 'drift'
+    logger.warn("%s: ACLが一致しません.: %s追加: %s 削除: %s" % (
+            ipaddr, 
+            acl_store and cur_key[:12] + " " or "", 
+            ", ".join([n.with_prefixlen for n in acl_diff_dict['add']]), 
+            ", ".join([n.with_prefixlen for n in acl_diff_dict['del']]), ))
+    return 'drift'
+  logger.info("%s: ACLは更新済です." % (ipaddr, ))
+  return 'compliant'
+
+
+def host_port(s):
+  """ 'HOST:PORT' を (HOST, PORT) に変換
+  """
+  host, sep, port = s.rpartition(':')
+  if not sep or not port.isdigit():
+    raise argparse.ArgumentTypeError("HOST:PORT expected: %s" % (s, ))
+  return (host, int(port))
+
+
+def get_dist_secret():
+  """分散実行でコーディネータとワーカーが共有する鍵を標準入力から取得
+  """
+  while True:
+    secret = getpass.getpass(prompt='分散実行の共有鍵を入力:').strip()
+    if secret: return secret
+    print 'empty!'
+
+
+def run_worker(addr, dump_telnet, secret):
+  """ コーディネータからリースを取得してセッションを実行
+  処理状態と所要時間、変更前のACLはコーディネータのジャーナルと履歴、スナップショットに記録
+  """
+  def run_leased_sess(ipaddr, kw, payload, journal):
+    return run_sess(ipaddr, logger, new_acl(payload), dump_telnet, journal=journal, history=journal, snapshots=journal, 
+                    verify_policy=payload['verify_policy'], verify_ratio=payload['verify_ratio'], 
+                    acl_store=acl_store, **kw)
+
+  # 機器間で共有するACLと差分 (新しいACLはペイロードごとに1回だけ変換)
+  acl_store = cm_aclstore.AclStore()
+  new_acls = dict()
+  def new_acl(payload):
+    key = tuple(payload['new_acl'])
+    if key not in new_acls: new_acls[key] = map(IPv4Network, key)
+    return new_acls[key]
+
+  threads = list()
+  for i in range(thread_num):
+    worker = cm_dist.Worker(addr, run_leased_sess, logger, secret=secret, failed_state=cm_journal.FAILED)
+    t = threading.Thread(target=worker.run)
+    t.setDaemon(True)
+    t.start()
+    threads.append(t)
+  for t in threads:
+    # join()はKeyboardInterruptを受け付けないのでタイムアウトつきで待つ
+    while t.isAlive(): t.join(1)
+
+
+def run_coordinator(addr, items, new_acl, journal, history, snapshots, secret, straggler_deadline, verify_policy, verify_ratio):
+  """ ワーカーにリースを配布して全ての機器が完了するまで待つ
+  """
+  def on_complete(ipaddr, kw, state):
+    if state != STRAGGLER: return
+    if kw.get('deadline') != straggler_deadline:
+      # ストラグラー用のデッドラインで後から再実行
+      return dict(deadline=straggler_deadline)
+    journal.record(ipaddr, cm_journal.FAILED, "deadline exceeded")
+
+  payload = dict(new_acl=[n.with_prefixlen for n in new_acl], verify_policy=verify_policy, verify_ratio=verify_ratio)
+  coord = cm_dist.Coordinator(addr, items, payload, logger, 
+                              journal=journal, history=history, snapshots=snapshots, on_complete=on_complete, ttl=lease_ttl, 
+                              secret=secret, )
+  return coord.run()
+
+
+def run_listener(new_acl, dump_telnet, **kw):
+  """ 設定変更のトラップ/syslogを受信した機器だけを新しいACLに更新
+  kwはrun_sess()に渡す
+  """
+  queue = Queue.Queue()
+  # 処理中の機器と、処理中に通知があった機器 (同じ機器のセッションは同時に実行しない)
+  lock = threading.Lock()
+  in_flight, deferred = set(), set()
+  def on_change(ipaddr):
+    with lock:
+      if ipaddr in in_flight:
+        logger.info("%s: 処理中のため、終了後に再実行します." % (ipaddr, ))
+        deferred.add(ipaddr)
+        return
+      in_flight.add(ipaddr)
+    queue.put((ipaddr, dict()))
+  def run_once(ipaddr, *args, **kw):
+    try:
+      return run_sess(ipaddr, *args, **kw)
+    finally:
+      with lock:
+        if ipaddr in deferred:
+          # 処理中に通知があった機器は続けてもう1回処理
+          deferred.discard(ipaddr)
+          queue.put((ipaddr, dict()))
+        else:
+          in_flight.discard(ipaddr)
+  for i in range(thread_num):
+    t = RunSessThread(queue, new_acl, dump_telnet, target=run_once, **kw)
+    t.setDaemon(True)
+    t.start()
+  if trap_community is None:
+    logger.warn("'--trap-community'が指定されていないため、トラップは受信しません.")
+  listener = cm_listen.ChangeListener(on_change, 
+                                      ipaddrs=agent_ipaddrs, 
+                                      trap_addr=trap_community is not None and trap_addr or None, 
+                                      syslog_addr=syslog_addr, 
+                                      debounce=change_debounce, 
+                                      community=trap_community, 
+                                      logger=logger, )
+  logger.info("設定変更の通知を待ちます. (trap: %s, syslog: %s:%d)" % (
+      (trap_community is not None and "%s:%d" % trap_addr or "-", ) + syslog_addr))
+  try:
+    listener.run()
+  finally:
+    listener.close()
 
 
 def main():
+  global rto_store, file_server, trap_community
   # 確認プロンプトを表示するためのオプション指定を処理
   parser = argparse.ArgumentParser()
   parser.add_argument('-d', '--dump-telnet', action='store_true', dest='dump_telnet',
                       help='copy telnet screen to a file (default: False)' )
+  parser.add_argument('-r', '--resume', metavar='RUN_ID', dest='resume', default=None,
+                      help='resume an interrupted run (default: None)' )
+  parser.add_argument('-t', '--deadline', metavar='SEC', type=float, dest='deadline', default=None,
+                      help='per-device deadline in seconds (default: None)' )
+  parser.add_argument('--straggler-deadline', metavar='SEC', type=float, dest='straggler_deadline', default=None,
+                      help='per-device deadline in the straggler lane (default: None)' )
+  parser.add_argument('--verify', choices=('full', 'sampled', 'optimistic'), dest='verify_policy', default='full',
+                      help='how to verify the updated ACL (default: full)' )
+  parser.add_argument('--verify-ratio', metavar='RATIO', type=float, dest='verify_ratio', default=0.1,
+                      help='ratio of devices re-read in the sampled mode (default: 0.1)' )
+  parser.add_argument('--max-threads', metavar='N', type=int, dest='max_threads', default=None,
+                      help='adapt the number of concurrent sessions up to N (default: None)' )
+  parser.add_argument('-l', '--listen', action='store_true', dest='listen',
+                      help='update only devices that report config changes (default: False)' )
+  parser.add_argument('--trap-community', metavar='COMMUNITY', dest='trap_community', default=None,
+                      help='accept config change traps with COMMUNITY in --listen (default: None)' )
+  parser.add_argument('-a', '--audit', action='store_true', dest='audit',
+                      help='compare ACLs without changing them (default: False)' )
+  parser.add_argument('--profile', metavar='DIR', dest='profile', default=None,
+                      help='write per-backend profiles to DIR (default: None)' )
+  parser.add_argument('--profile-alloc', action='store_true', dest='profile_alloc',
+                      help='also trace memory allocations with --profile (default: False)' )
+  parser.add_argument('--bulk-load', choices=('tftp', 'http'), dest='bulk_load', default=None,
+                      help='push large ACL changes as a file served over TFTP or HTTP (default: None)' )
+  parser.add_argument('--rollback', metavar='RUN_ID', dest='rollback', default=None,
+                      help='restore the ACLs recorded before RUN_ID changed them (default: None)' )
+  group = parser.add_mutually_exclusive_group()
+  group.add_argument('--coordinator', metavar='HOST:PORT', type=host_port, dest='coordinator', default=None,
+                     help='lease devices to workers listening on HOST:PORT (default: None)' )
+  group.add_argument('--worker', metavar='HOST:PORT', type=host_port, dest='worker', default=None,
+                     help='run sessions leased by the coordinator at HOST:PORT (default: None)' )
 
   dump_telnet = vars(parser.parse_args())['dump_telnet']
+  resume = vars(parser.parse_args())['resume']
+  deadline = vars(parser.parse_args())['deadline']
+  straggler_deadline = vars(parser.parse_args())['straggler_deadline']
+  coordinator = vars(parser.parse_args())['coordinator']
+  worker = vars(parser.parse_args())['worker']
+  verify_policy = vars(parser.parse_args())['verify_policy']
+  verify_ratio = vars(parser.parse_args())['verify_ratio']
+  audit = vars(parser.parse_args())['audit']
+  max_threads = vars(parser.parse_args())['max_threads']
+  listen = vars(parser.parse_args())['listen']
+  trap_community = vars(parser.parse_args())['trap_community']
+  profile = vars(parser.parse_args())['profile']
+  profile_alloc = vars(parser.parse_args())['profile_alloc']
+  bulk_load = vars(parser.parse_args())['bulk_load']
+  rollback = vars(parser.parse_args())['rollback']
+
+  # 機器ごとに学習したタイムアウト (前回までの実行の推定値を引き継ぐ)
+  rto_store = RtoStore(rto_path)
+
+  if bulk_load:
+    # 大量のACL変更を一括でロードするためのファイルサーバ (終了するまで待ち受け)
+    try:
+      file_server = cm_filesrv.servers[bulk_load](bulk_addr[bulk_load], logger=logger)
+    except socket.error, e:
+      logger.error("%s: %s:%d で待ち受けできません.: %s" % ((bulk_load, ) + bulk_addr[bulk_load] + (str(e), )))
+      sys.exit(1)
+    file_server.start()
+
+  if worker:
+    # ワーカーとして実行 (処理状態と所要時間はコーディネータのジャーナルと履歴に記録)
+    try:
+      get_secrets()
+      secret = get_dist_secret()
+      logger.info("開始します. (coordinator: %s:%d)" % worker)
+      run_worker(worker, dump_telnet, secret)
+    except KeyboardInterrupt:
+      print ""
+      logger.warn("処理が中断されました.")
+      rto_store.save()
+      sys.exit()
+    rto_store.save()
+    logger.info("終了しました.")
+    return
+
+  if audit:
+    # ACLを変更せずに確認のみ
+    try:
+      get_secrets()
+    except KeyboardInterrupt:
+      print ""
+      logger.warn("処理が中断されました.")
+      sys.exit()
+    logger.info("確認を開始します.")
+    acl_store = cm_aclstore.AclStore()
+    queue = Queue.Queue()
+    for i in range(thread_num):
+      t = RunSessThread(queue, map(IPv4Network, snmp_mgr_networks), dump_telnet, target=audit_sess, acl_store=acl_store)
+      t.setDaemon(True)
+      t.start()
+    for ipaddr in agent_ipaddrs:
+      queue.put((ipaddr, dict()))
+    queue.join()
+    rto_store.save()
+    logger.info("ACLの種類: %d" % (len(acl_store), ))
+    logger.info("終了しました.")
+    return
+
+  journal = None
+  if resume:
+    try:
+      # 処理状態を記録するジャーナルを開く
+      journal = cm_journal.RunJournal(journal_path, run_id=resume)
+    except ValueError, e:
+      logger.error(str(e))
+      sys.exit(1)
+    if journal.kind == cm_journal.ROLLBACK:
+      # ロールバックの実行を再開する場合は、同じRUN_IDの変更前のACLに戻す (新しいACLは適用しない)
+      if rollback and rollback != journal.target:
+        logger.error("%s: %sのロールバックです. (--rollback: %s)" % (resume, journal.target, rollback, ))
+        sys.exit(1)
+      rollback = journal.target
+    elif rollback:
+      logger.error("%s: ロールバックの実行ではありません." % (resume, ))
+      sys.exit(1)
+
+  if rollback:
+    # RUN_IDの実行で変更した機器を変更前のACLに並列に戻す
+    try:
+      rolled_back = cm_journal.RunJournal(journal_path, run_id=rollback)
+    except ValueError, e:
+      logger.error(str(e))
+      sys.exit(1)
+    states = rolled_back.states()
+    rolled_back.close()
+    snapshot_store = cm_snapshot.SnapshotStore(snapshot_path, rollback)
+    snapshots = snapshot_store.load()
+    snapshot_store.close()
+    if not snapshots:
+      logger.warn("%s: 変更前のACLが記録されていません." % (rollback, ))
+      return
+    try:
+      get_secrets()
+    except KeyboardInterrupt:
+      print ""
+      logger.warn("処理が中断されました.")
+      sys.exit()
+    # 再開する場合は前回までのロールバックの処理状態を取得
+    restored = journal and journal.states() or dict()
+    journal = journal or cm_journal.RunJournal(journal_path, kind=cm_journal.ROLLBACK, target=rollback)
+    # コンソール(WARN以上)にも出力
+    logger.warn("ロールバックを開始します. (RUN_ID: %s, 対象: %s)" % (journal.run_id, rollback, ))
+    queue = Queue.Queue()
+    for i in range(thread_num):
+      t = RunSessThread(queue, snapshots, dump_telnet, target=restore_sess, journal=journal)
+      t.setDaemon(True)
+      t.start()
+    for ipaddr in sorted(snapshots):
+      if restored.get(ipaddr) == cm_journal.SAVED:
+        logger.info("%s: 処理済のためスキップします." % (ipaddr, ))
+        continue
+      # 前回のロールバックで処理を始めていた機器は、ACLが変わっている場合があるので再取得する
+      queue.put((ipaddr, dict(assume_applied=ipaddr not in restored and 
+                                             states.get(ipaddr) in (cm_journal.APPLIED, cm_journal.SAVED, ))))
+    queue.join()
+    journal.close()
+    rto_store.save()
+    logger.info("終了しました.")
+    return
+
+  # 新しく実行する場合のジャーナル (再開する場合は開いたもの)
+  journal = journal or cm_journal.RunJournal(journal_path)
 
   try:
     # パスワード情報を取得
     get_secrets()
+    # コーディネータの場合はワーカーを認証する共有鍵も取得
+    secret = coordinator and get_dist_secret() or None
   except KeyboardInterrupt:
     print ""
     logger.warn("処理が中断されました.")
@@ -191,22 +877,120 @@ def main():
   # 新しいACLのリスト
   new_acl = map(IPv4Network, snmp_mgr_networks)  
 
-  logger.info("開始します.")
+  # 再開に使うRUN_IDはコンソール(WARN以上)にも出力
+  logger.warn("開始します. (RUN_ID: %s)" % (journal.run_id, ))
+
+  if listen:
+    # 設定変更を通知した機器だけを処理 (中断するまで継続)
+    try:
+      run_listener(new_acl, dump_telnet, journal=journal, verify_policy=verify_policy, verify_ratio=verify_ratio, 
+                   acl_store=cm_aclstore.AclStore(), snapshots=cm_snapshot.SnapshotStore(snapshot_path, journal.run_id))
+    except KeyboardInterrupt:
+      print ""
+      logger.warn("処理が中断されました.")
+    except socket.error, e:
+      # 162番、514番ポートはroot権限がないと待ち受けできない
+      logger.error("トラップ/syslogを待ち受けできません.: %s" % (str(e), ))
+    journal.close()
+    rto_store.save()
+    logger.info("終了しました.")
+    return
+
+  # 再開する場合は前回までの処理状態を取得
+  states = resume and journal.states() or dict()
+  pending = resume and journal.notes(cm_journal.APPLIED) or dict()
+
+  # 保存まで完了している機器はスキップ
+  ipaddrs = list()
+  for ipaddr in agent_ipaddrs:
+    if states.get(ipaddr) == cm_journal.SAVED:
+      logger.info("%s: 処理済のためスキップします." % (ipaddr, ))
+      continue
+    ipaddrs.append(ipaddr)
+
+  # 管理ポートに到達できない機器はSNMPで機種を特定する前に除外し、失敗として記録
+  # (機種が未特定の機器は全機種の管理ポートを確認)
+  reachable = cm_probe.probe([(ipaddr, (agents.get(ipaddr) or cm_agent.Agent).mgmt_ports) for ipaddr in ipaddrs], 
+                             timeout=probe_timeout)
+  for ipaddr in ipaddrs:
+    if ipaddr in reachable: continue
+    logger.error("%s: 管理ポートに接続できません." % (ipaddr, ))
+    journal.record(ipaddr, cm_journal.FAILED, "unreachable")
+  ipaddrs = [ipaddr for ipaddr in ipaddrs if ipaddr in reachable]
+
+  # 到達できる機器の機種を先に特定 (見積もり、プロファイルで使う、run_sess()ではキャッシュを使う)
+  discover_agents(ipaddrs)
+  # 所要時間の見積もりが長い順に並べる
+  history = cm_sched.DurationHistory(history_path)
+  ipaddrs = history.order(ipaddrs, 
+                          model_of=lambda ipaddr: ipaddr in agents and agents[ipaddr].model or None, 
+                          acl_size=len(new_acl), )
+  items = [(ipaddr, dict(reverify=states.get(ipaddr) == cm_journal.APPLIED, pending_session=pending.get(ipaddr)), ) 
+           for ipaddr in ipaddrs]
+
+  # 変更前のACLを記録 ('--rollback'で使う)
+  snapshots = cm_snapshot.SnapshotStore(snapshot_path, journal.run_id)
+
+  if coordinator:
+    # コーディネータとしてワーカーにリースを配布
+    items = [(ipaddr, dict(kw, deadline=deadline)) for ipaddr, kw in items]
+    run_coordinator(coordinator, items, new_acl, journal, history, snapshots, 
+                    secret, straggler_deadline, verify_policy, verify_ratio)
+    snapshots.close()
+    journal.close()
+    history.save()
+    rto_store.save()
+    logger.info("終了しました.")
+    return
 
+  # 機器間で共有するACLと差分
+  acl_store = cm_aclstore.AclStore()
+  # '--profile'を指定した場合は機器ごとのrun_sess()をセッションのクラスごとに計測
+  profiler, target, on_sess = None, None, None
+  if profile:
+    if profile_alloc and cm_profile.tracemalloc is None:
+      logger.warn("tracemallocがないため、メモリ割り当ては計測しません.")
+    # run_sess()が実際に使ったセッションのクラス名 (機種を特定できなかった機器は'unknown')
+    sess_classes = dict()
+    def on_sess(ipaddr, sess):
+      sess_classes[ipaddr] = sess.__class__.__name__
+    profiler = cm_profile.SessProfiler(profile, key=lambda ipaddr: sess_classes.get(ipaddr, 'unknown'), 
+                                       alloc=profile_alloc)
+    target = profiler.wrap(run_sess)
   # キューを作成
   queue = Queue.Queue()
-  for i in range(thread_num):
+  # デッドラインを超過した機器は1スレッドで後から処理
+  stragglers = Queue.Queue()
+  t = RunSessThread(stragglers, new_acl, dump_telnet, target=target, journal=journal, deadline=straggler_deadline, history=history, 
+                    verify_policy=verify_policy, verify_ratio=verify_ratio, acl_store=acl_store, snapshots=snapshots, 
+                    on_sess=on_sess)
+  t.setDaemon(True)
+  t.start()
+  # '--max-threads'を指定した場合は、thread_numから始めて同時実行数を調整
+  pool = max_threads and cm_pool.AdaptivePool(thread_num, max_threads, logger=logger) or None
+  for i in range(max_threads or thread_num):
     # スレッド生成
-    t = RunSessThread(queue, new_acl, dump_telnet)
+    t = RunSessThread(queue, new_acl, dump_telnet, stragglers=stragglers, target=target, pool=pool, journal=journal, 
+                      deadline=deadline, history=history, verify_policy=verify_policy, verify_ratio=verify_ratio, 
+                      acl_store=acl_store, snapshots=snapshots, on_sess=on_sess)
     t.setDaemon(True)
     t.start()
 
-  for ipaddr in agent_ipaddrs:
+  for item in items:
     # 対象機器のIPアドレスをキューに入れる (待機スレッドがrun()メソッドで取得)
-    queue.put(ipaddr)
+    queue.put(item)
 
   # queueが空になるまでブロック
   queue.join()
+  stragglers.join()
+  journal.close()
+  snapshots.close()
+  history.save()
+  rto_store.save()
+  logger.info("ACLの種類: %d" % (len(acl_store), ))
+  if profiler:
+    profiler.dump()
+    logger.info("プロファイルを出力しました. (%s)" % (profile, ))
 
   logger.info("終了しました.")
 